@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+# Author: Micah Martin (knif3)
+# bench.py
+#
+# Benchmark Sangheili on the loopback. Starts the echo/source targets and the proxy with a pool of
+# 127.0.0.0/8 addresses, drives load through it over SOCKS5 and prints the results as JSON
+#
+#   python3 benchmarks/bench.py --engine asyncio --output results.json
+#   python3 benchmarks/bench.py --churn   # Add and delete an address on lo for every connection
+#
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HOST = "127.0.0.1"
+
+
+def percentile(values, pct):
+    """Nearest rank percentile of a list of numbers"""
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(pct / 100.0 * len(values))) - 1))
+    return values[index]
+
+
+def summarize(latencies):
+    """Returns:
+        dict: p50, p99 and max of the latencies in milliseconds
+    """
+    return {
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+        "max_ms": round(max(latencies) * 1000, 3) if latencies else None,
+    }
+
+
+async def socksConnect(proxy, target):
+    """Open a SOCKS5 CONNECT session to the target through the proxy
+
+    Returns:
+        tuple: (reader, writer) of the established session
+    """
+    reader, writer = await asyncio.open_connection(*proxy)
+    try:
+        writer.write(struct.pack("!BBB", 5, 1, 0))
+        ver, method = struct.unpack("!BB", await reader.readexactly(2))
+        if ver != 5 or method != 0:
+            raise ConnectionError("Proxy refused the greeting")
+        writer.write(struct.pack("!BBBB", 5, 1, 0, 1) + socket.inet_aton(target[0]) +
+                     struct.pack("!H", target[1]))
+        reply = await reader.readexactly(10)
+        if reply[1] != 0:
+            raise ConnectionError("Proxy replied {}".format(reply[1]))
+    except Exception:
+        writer.close()
+        raise
+    return reader, writer
+
+
+async def benchHandshakes(proxy, target, total, concurrency):
+    """Open and close sessions as fast as possible"""
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                _, writer = await socksConnect(proxy, target)
+            except (OSError, asyncio.IncompleteReadError):
+                errors += 1
+                return
+            latencies.append(time.perf_counter() - start)
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(total)))
+    elapsed = time.perf_counter() - start
+    result = {"sessions": total, "concurrency": concurrency, "errors": errors,
+              "handshakes_per_sec": round(len(latencies) / elapsed, 1)}
+    result.update(summarize(latencies))
+    return result
+
+
+async def benchIdle(proxy, target, count, concurrency, pid):
+    """Open count sessions and hold them all open at once"""
+    sessions = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        nonlocal errors
+        async with semaphore:
+            try:
+                sessions.append(await socksConnect(proxy, target))
+            except (OSError, asyncio.IncompleteReadError):
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(count)))
+    elapsed = time.perf_counter() - start
+    # Make sure the oldest sessions still relay
+    alive = 0
+    for reader, writer in sessions[:100]:
+        try:
+            writer.write(b'x')
+            if await asyncio.wait_for(reader.readexactly(1), 5) == b'x':
+                alive += 1
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+    result = {"requested": count, "open": len(sessions), "errors": errors,
+              "seconds_to_open": round(elapsed, 3), "sampled_alive": alive,
+              "server_rss_kb": rssKb(pid), "server_threads": threadCount(pid)}
+    for _, writer in sessions:
+        writer.close()
+    return result
+
+
+async def benchThroughput(proxy, target, size, streams):
+    """Pull size bytes over each of several concurrent sessions"""
+    async def one():
+        reader, writer = await socksConnect(proxy, target)
+        writer.write(struct.pack("!Q", size))
+        received = 0
+        while True:
+            data = await reader.read(262144)
+            if not data:
+                break
+            received += len(data)
+        writer.close()
+        return received
+
+    start = time.perf_counter()
+    received = sum(await asyncio.gather(*(one() for _ in range(streams))))
+    elapsed = time.perf_counter() - start
+    return {"streams": streams, "bytes": received, "seconds": round(elapsed, 3),
+            "mb_per_sec": round(received / elapsed / 1e6, 1)}
+
+
+async def benchLatency(proxy, target, rounds, size=64):
+    """Time round trips of small messages over one established session"""
+    reader, writer = await socksConnect(proxy, target)
+    message = b'p' * size
+    latencies = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        writer.write(message)
+        await reader.readexactly(size)
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+    result = {"rounds": rounds, "message_bytes": size}
+    result.update(summarize(latencies))
+    return result
+
+
+def rssKb(pid):
+    try:
+        with open("/proc/{}/status".format(pid)) as fil:
+            for line in fil:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def threadCount(pid):
+    try:
+        return len(os.listdir("/proc/{}/task".format(pid)))
+    except OSError:
+        return None
+
+
+def waitForPort(port, proc, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("Process exited with {}".format(proc.returncode))
+        try:
+            socket.create_connection((HOST, port), 0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("Nothing listening on port {}".format(port))
+
+
+def raiseFileLimit():
+    try:
+        import resource
+        _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def proxyEnv(args):
+    """The environment to start Sangheili with for these arguments"""
+    env = dict(os.environ)
+    env.update({
+        "server": HOST,
+        "port": str(args.proxy_port),
+        "engine": args.engine,
+        "workers": str(args.workers),
+        "relay_mode": args.relay_mode,
+        "net_device": "lo",
+        "net_base_ip": HOST,
+        "address_list": ",".join("127.0.0.{}".format(i) for i in range(2, 2 + args.addresses)),
+        # Without churn the loopback addresses are used as they are
+        "manage_addresses": "true" if args.churn else "false",
+        "address_linger": "0",
+    })
+    return env
+
+
+def failedTests(results):
+    """Returns:
+        list: the tests in which every session failed, so their numbers mean nothing
+    """
+    failed = []
+    handshake = results.get("handshake")
+    if handshake and handshake["errors"] >= handshake["sessions"]:
+        failed.append("handshake")
+    if "throughput" in results and not results["throughput"]["bytes"]:
+        failed.append("throughput")
+    if "idle" in results and not results["idle"]["open"]:
+        failed.append("idle")
+    return failed
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def runAll(args, pid):
+    proxy = (HOST, args.proxy_port)
+    echo = (HOST, args.echo_port)
+    source = (HOST, args.source_port)
+    results = {}
+    if "handshake" in args.tests:
+        results["handshake"] = await benchHandshakes(proxy, echo, args.handshakes,
+                                                     args.concurrency)
+    if "latency" in args.tests:
+        results["latency"] = await benchLatency(proxy, echo, args.rounds)
+    if "throughput" in args.tests:
+        results["throughput"] = await benchThroughput(proxy, source, args.bulk_mb * 1000000,
+                                                      args.streams)
+    if "idle" in args.tests:
+        results["idle"] = await benchIdle(proxy, echo, args.idle, args.concurrency, pid)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Sangheili on the loopback")
+    parser.add_argument("--engine", default="threading", choices=["threading", "asyncio"])
+    parser.add_argument("--workers", type=int, default=1, help="proxy worker processes")
+    parser.add_argument("--relay-mode", default="auto", choices=["auto", "splice", "buffer"])
+    parser.add_argument("--churn", action="store_true",
+                        help="add and delete a loopback address for every connection")
+    parser.add_argument("--addresses", type=int, default=50, help="size of the address pool")
+    parser.add_argument("--tests", default="handshake,latency,throughput,idle",
+                        help="comma separated tests to run")
+    parser.add_argument("--handshakes", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=2000)
+    parser.add_argument("--bulk-mb", type=int, default=500, help="megabytes per stream")
+    parser.add_argument("--streams", type=int, default=1)
+    parser.add_argument("--idle", type=int, default=2000, help="sessions to hold open")
+    parser.add_argument("--proxy-port", type=int, default=21080)
+    parser.add_argument("--echo-port", type=int, default=29001)
+    parser.add_argument("--source-port", type=int, default=29002)
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+    args.tests = [test.strip() for test in args.tests.split(",")]
+    raiseFileLimit()
+
+    targets = subprocess.Popen([sys.executable, os.path.join(ROOT, "benchmarks", "targets.py"),
+                                "--host", HOST, "--echo-port", str(args.echo_port),
+                                "--source-port", str(args.source_port)])
+    proxy = subprocess.Popen([sys.executable, os.path.join(ROOT, "sangheili.py")], cwd=ROOT,
+                             env=proxyEnv(args), stdout=subprocess.DEVNULL)
+    try:
+        waitForPort(args.echo_port, targets)
+        waitForPort(args.proxy_port, proxy)
+        results = asyncio.run(runAll(args, proxy.pid))
+    finally:
+        proxy.terminate()
+        targets.terminate()
+        proxy.wait()
+        targets.wait()
+
+    report = {
+        "commit": gitCommit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "settings": {"engine": args.engine, "workers": args.workers, "relay_mode": args.relay_mode,
+                     "churn": args.churn, "addresses": args.addresses},
+        "results": results,
+        "failed": failedTests(results),
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as fil:
+            fil.write(output + "\n")
+    else:
+        print(output)
+    if report["failed"]:
+        print("Every session failed in: {}, the run is invalid".format(
+              ", ".join(report["failed"])), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
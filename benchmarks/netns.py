@@ -0,0 +1,500 @@
+#!/usr/bin/env python3
+# Author: Micah Martin (knif3)
+# netns.py
+#
+# Exercise the address management and ARP code on a simulated LAN, built from two network
+# namespaces joined by a veth pair, and print the results as JSON. Needs root and iproute2
+#
+#   lan:   10.77.0.1 on lan0, the targets and the simulated neighbors that answer ARP
+#   proxy: 10.77.0.2 on sh0, Sangheili adding and deleting its addresses for real
+#
+#   sudo python3 benchmarks/netns.py --neighbors 100 --addresses 50 --output netns.json
+#   sudo python3 benchmarks/netns.py --tests churn --net-backend ip --connections 1000
+#
+
+import argparse
+import ast
+import ctypes
+import glob
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from ipaddress import IPv4Network
+
+from bench import gitCommit, summarize
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from src.arp import ARP_FRAME, ETH_P_ARP  # noqa: E402
+
+LAN_NS = "sangheili-lan"
+PROXY_NS = "sangheili-proxy"
+LAN_DEV = "lan0"
+PROXY_DEV = "sh0"
+CLONE_NEWNET = 0x40000000
+BROADCAST = b'\xff' * 6
+
+
+def run(*command):
+    subprocess.check_call(command, stdout=subprocess.DEVNULL)
+
+
+def buildLan(network):
+    """Create the namespaces and the veth pair between them, replacing any left over
+
+    Returns:
+        tuple: the gateway (lan) and proxy addresses
+    """
+    tearDown()
+    hosts = network.hosts()
+    gateway, proxy = str(next(hosts)), str(next(hosts))
+    run("ip", "netns", "add", LAN_NS)
+    run("ip", "netns", "add", PROXY_NS)
+    run("ip", "link", "add", LAN_DEV, "netns", LAN_NS, "type", "veth",
+        "peer", "name", PROXY_DEV, "netns", PROXY_NS)
+    for ns, dev, ip in ((LAN_NS, LAN_DEV, gateway), (PROXY_NS, PROXY_DEV, proxy)):
+        run("ip", "-n", ns, "link", "set", "lo", "up")
+        run("ip", "-n", ns, "addr", "add", "{}/{}".format(ip, network.prefixlen), "dev", dev)
+        run("ip", "-n", ns, "link", "set", dev, "up")
+    # Sangheili finds its own address by routing towards the internet
+    run("ip", "-n", PROXY_NS, "route", "add", "default", "via", gateway)
+    return gateway, proxy
+
+
+def tearDown():
+    for ns in (LAN_NS, PROXY_NS):
+        subprocess.call(["ip", "netns", "del", ns], stderr=subprocess.DEVNULL)
+
+
+def enterNamespace(name):
+    """Move this process into a network namespace. Must be called before starting any threads"""
+    with open("/run/netns/" + name) as fil:
+        if hasattr(os, "setns"):
+            os.setns(fil.fileno(), CLONE_NEWNET)
+            return
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.setns(fil.fileno(), CLONE_NEWNET) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+
+def fakeMac(ip):
+    """A locally administered MAC that is the same for an address every run"""
+    return b'\x02\x4e' + socket.inet_aton(ip)
+
+
+class Neighbors(object):
+    """Hosts on the simulated LAN that answer ARP requests for their addresses, and can claim
+    an address out of the blue like a host that was given a duplicate
+
+    Args:
+        dev (str): the lan side of the veth pair
+        addresses (iterable): the addresses the neighbors own
+    """
+    def __init__(self, dev, addresses):
+        self.addresses = set(addresses)
+        self.answered = 0
+        self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ARP))
+        self.sock.bind((dev, ETH_P_ARP))
+        threading.Thread(target=self._run, name="Neighbors", daemon=True).start()
+
+    def _run(self):
+        buf = bytearray(2048)
+        while True:
+            try:
+                size = self.sock.recv_into(buf)
+            except OSError:
+                return
+            if size < ARP_FRAME.size:
+                continue
+            _, _, _, _, _, _, _, op, sha, spa, _, tpa = ARP_FRAME.unpack_from(buf)
+            ip = socket.inet_ntoa(tpa)
+            if op != 1 or ip not in self.addresses:
+                continue
+            mac = fakeMac(ip)
+            self.sock.send(ARP_FRAME.pack(sha, mac, ETH_P_ARP, 1, 0x0800, 6, 4, 2, mac, tpa,
+                                          sha, spa))
+            self.answered += 1
+
+    def claim(self, ip):
+        """Announce that a new host has the address (a gratuitous ARP reply)"""
+        self.addresses.add(ip)
+        mac, packed = fakeMac(ip), socket.inet_aton(ip)
+        self.sock.send(ARP_FRAME.pack(BROADCAST, mac, ETH_P_ARP, 1, 0x0800, 6, 4, 2, mac, packed,
+                                      BROADCAST, packed))
+
+
+class Whoami(object):
+    """A target that tells each client the address it connected from, then holds the
+    connection open until the client closes it"""
+    def __init__(self, host, port):
+        self.server = socket.create_server((host, port), backlog=4096)
+        threading.Thread(target=self._run, name="Whoami", daemon=True).start()
+
+    def _run(self):
+        while True:
+            conn, addr = self.server.accept()
+            threading.Thread(target=self._handle, args=(conn, addr), daemon=True).start()
+
+    @staticmethod
+    def _handle(conn, addr):
+        try:
+            conn.sendall(addr[0].encode() + b'\n')
+            while conn.recv(4096):
+                pass
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+
+class Proxy(object):
+    """Run Sangheili in the proxy namespace and keep what it prints
+
+    Args:
+        settings (dict): the environment to start it with, on top of our own
+    """
+    def __init__(self, settings):
+        env = dict(os.environ, PYTHONUNBUFFERED="1")
+        env.update(settings)
+        self.host = settings["server"]
+        self.port = int(settings["port"])
+        self.metrics_port = int(settings.get("metrics_port", 0))
+        self.trace_dir = settings.get("trace_dir")
+        self.lines = []
+        self.started = time.perf_counter()
+        self.proc = subprocess.Popen(["ip", "netns", "exec", PROXY_NS, sys.executable,
+                                      os.path.join(ROOT, "sangheili.py")], cwd=ROOT, env=env,
+                                     stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                     universal_newlines=True)
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        for line in self.proc.stdout:
+            self.lines.append(line.rstrip("\n"))
+
+    def waitReady(self, timeout=300):
+        """Returns:
+            float: seconds from starting the process until it accepted a connection
+        """
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError("Sangheili exited with {}:\n{}".format(
+                                   self.proc.returncode, "\n".join(self.lines[-20:])))
+            try:
+                socket.create_connection((self.host, self.port), 0.5).close()
+                return time.perf_counter() - self.started
+            except OSError:
+                time.sleep(0.01)
+        raise RuntimeError("Sangheili is not listening after {}s".format(timeout))
+
+    def printed(self, prefix=""):
+        """Returns:
+            list: the python list Sangheili printed on a line starting with prefix
+        """
+        for line in self.lines:
+            # Progress dots are printed without a newline in front of the list
+            rest = line[len(prefix):].lstrip(". ")
+            if line.startswith(prefix) and rest.startswith("["):
+                return ast.literal_eval(rest)
+        return []
+
+    def metric(self, name):
+        with urllib.request.urlopen("http://{}:{}/metrics".format(
+                                    self.host, self.metrics_port), timeout=5) as response:
+            for line in response.read().decode().splitlines():
+                if line.startswith(name + " "):
+                    return float(line.split()[1])
+        return None
+
+    def signal(self, signum):
+        self.proc.send_signal(signum)
+
+    def stop(self):
+        self.proc.terminate()
+        try:
+            self.proc.wait(30)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+
+def socksConnect(proxy, target, timeout=10):
+    """Open a SOCKS5 CONNECT session through the proxy
+
+    Returns:
+        socket: the established session
+    """
+    sock = socket.create_connection(proxy, timeout)
+    try:
+        sock.sendall(b'\x05\x01\x00')
+        if sock.recv(2) != b'\x05\x00':
+            raise ConnectionError("Proxy refused the greeting")
+        sock.sendall(b'\x05\x01\x00\x01' + socket.inet_aton(target[0]) +
+                     target[1].to_bytes(2, "big"))
+        reply = sock.recv(10)
+        if len(reply) < 2 or reply[1] != 0:
+            raise ConnectionError("Proxy replied {}".format(reply[1:2]))
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+def whoami(sock):
+    """Returns:
+        str: the outbound address of a session to the Whoami target
+    """
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = sock.recv(64)
+        if not chunk:
+            raise ConnectionError("The target closed the session")
+        data += chunk
+    return data.decode().strip()
+
+
+def proxyAddresses():
+    """Returns:
+        set: the IPv4 addresses configured on the proxy's device right now
+    """
+    output = subprocess.check_output(["ip", "-n", PROXY_NS, "-4", "-o", "addr", "show", "dev",
+                                      PROXY_DEV], universal_newlines=True)
+    return set(line.split()[3].split("/")[0] for line in output.splitlines())
+
+
+def proxySettings(args, proxy_ip, trace_dir, **extra):
+    settings = {
+        "server": proxy_ip,
+        "port": str(args.proxy_port),
+        "net_device": PROXY_DEV,
+        "net_base_ip": proxy_ip,
+        "net_backend": args.net_backend,
+        "address_count": str(args.addresses),
+        "address_cache": "",
+        "address_linger": "0",
+        "arp_rate": str(args.arp_rate),
+        "engine": args.engine,
+        "session_log": "",
+        "metrics_host": proxy_ip,
+        "metrics_port": str(args.metrics_port),
+        # Every session is traced, so add_interface and cleanup_ip are timed by the proxy itself
+        "trace": "true",
+        "trace_slow": "0",
+        "trace_buffer": str(args.connections + 1000),
+        "trace_dir": trace_dir,
+    }
+    settings.update(extra)
+    return settings
+
+
+def benchDiscovery(args, proxy_ip, trace_dir, neighbors):
+    """Start with nothing known about the LAN and find the free addresses with ARP"""
+    proxy = Proxy(proxySettings(args, proxy_ip, trace_dir))
+    try:
+        startup = proxy.waitReady()
+        found = proxy.printed()
+    finally:
+        proxy.stop()
+    return {"requested": args.addresses, "found": len(found),
+            "seconds_to_listen": round(startup, 3),
+            "neighbors_chosen": len(set(found) & neighbors.addresses)}
+
+
+def benchValidation(args, proxy_ip, trace_dir, neighbors, hosts):
+    """Start from a configured list that includes some of the neighbors' addresses"""
+    taken = random.sample(sorted(neighbors.addresses), min(len(neighbors.addresses),
+                                                           args.addresses // 5 or 1))
+    free = [ip for ip in hosts if ip not in neighbors.addresses][:args.addresses - len(taken)]
+    proxy = Proxy(proxySettings(args, proxy_ip, trace_dir, address_list=",".join(free + taken),
+                                validate_addresses="true"))
+    try:
+        startup = proxy.waitReady()
+        rejected = proxy.printed("WARN: Addresses in use by other hosts:")
+    finally:
+        proxy.stop()
+    return {"configured": len(free) + len(taken), "taken": len(taken),
+            "rejected": len(rejected), "missed": len(set(taken) - set(rejected)),
+            "wrongly_rejected": len(set(rejected) - set(taken)),
+            "seconds_to_listen": round(startup, 3)}
+
+
+def benchChurn(args, proxy, target, neighbors):
+    """One session at a time, so every session adds its address and deletes it again"""
+    latencies = []
+    sources = set()
+    errors = 0
+    start = time.perf_counter()
+    for _ in range(args.connections):
+        began = time.perf_counter()
+        try:
+            sock = socksConnect((proxy.host, proxy.port), target)
+            sources.add(whoami(sock))
+            latencies.append(time.perf_counter() - began)
+            sock.close()
+        except OSError:
+            errors += 1
+    elapsed = time.perf_counter() - start
+    time.sleep(0.5)  # Let the proxy finish the last session
+    # The proxy times its own side of every session, dump the traces to read them back
+    spans = proxyPhases(proxy)
+    result = {"connections": args.connections, "errors": errors,
+              "connections_per_sec": round(len(latencies) / elapsed, 1),
+              "addresses_used": len(sources),
+              "neighbor_sources": len(sources & neighbors.addresses),
+              "session_open": summarize(latencies)}
+    for phase in ("new_ip", "add_interface", "connect", "cleanup_ip"):
+        result[phase] = summarize(spans.get(phase, []))
+        result[phase]["count"] = len(spans.get(phase, []))
+    return result
+
+
+def proxyPhases(proxy, timeout=10):
+    """Stop tracing on the proxy and read back how long each phase took
+
+    Returns:
+        dict: phase => list of seconds
+    """
+    pattern = os.path.join(proxy.trace_dir, "trace-*.jsonl")
+    before = set(glob.glob(pattern))
+    written = len([line for line in proxy.lines if line.startswith("Wrote ")])
+    proxy.signal(signal.SIGUSR1)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        # The dump is announced once the file is complete
+        if len([line for line in proxy.lines if line.startswith("Wrote ")]) > written:
+            break
+        time.sleep(0.05)
+    dumps = set(glob.glob(pattern)) - before
+    spans = {}
+    for path in dumps:
+        with open(path) as fil:
+            for line in fil:
+                for name, _, took in json.loads(line)["phases"]:
+                    spans.setdefault(name, []).append(took)
+    # Trace whatever comes next too
+    proxy.signal(signal.SIGUSR1)
+    return spans
+
+
+def benchConflict(args, proxy, target, neighbors):
+    """Have a neighbor claim the address of an open session, and time how long the proxy takes
+    to notice, stop handing it out and take it off the device once the session ends"""
+    conflicts = proxy.metric("sangheili_address_conflicts_total") or 0
+    held = socksConnect((proxy.host, proxy.port), target)
+    victim = whoami(held)
+    claimed = time.perf_counter()
+    neighbors.claim(victim)
+    detected = None
+    while time.perf_counter() - claimed < 10:
+        if (proxy.metric("sangheili_address_conflicts_total") or 0) > conflicts:
+            detected = time.perf_counter() - claimed
+            break
+        time.sleep(0.005)
+    # New sessions must not get the address, even while the old one still holds it
+    reused = 0
+    for _ in range(args.conflict_sessions):
+        try:
+            sock = socksConnect((proxy.host, proxy.port), target)
+            reused += whoami(sock) == victim
+            sock.close()
+        except OSError:
+            pass
+    held.close()
+    closed = time.perf_counter()
+    removed = None
+    while time.perf_counter() - closed < 10:
+        if victim not in proxyAddresses():
+            removed = time.perf_counter() - closed
+            break
+        time.sleep(0.005)
+    return {"detected_ms": round(detected * 1000, 3) if detected is not None else None,
+            "sessions_after": args.conflict_sessions, "reused": reused,
+            "removed_after_close_ms": round(removed * 1000, 3) if removed is not None else None}
+
+
+def runAll(args):
+    network = IPv4Network(args.subnet)
+    gateway, proxy_ip = buildLan(network)
+    enterNamespace(LAN_NS)
+    hosts = [str(ip) for ip in network.hosts()][2:]
+    random.shuffle(hosts)
+    neighbors = Neighbors(LAN_DEV, hosts[:args.neighbors])
+    target = (gateway, args.target_port)
+    Whoami(*target)
+    trace_dir = tempfile.mkdtemp(prefix="sangheili-netns-")
+    results = {}
+    if "discovery" in args.tests:
+        results["discovery"] = benchDiscovery(args, proxy_ip, trace_dir, neighbors)
+    if "validation" in args.tests:
+        results["validation"] = benchValidation(args, proxy_ip, trace_dir, neighbors, hosts)
+    if "churn" in args.tests or "conflict" in args.tests:
+        proxy = Proxy(proxySettings(args, proxy_ip, trace_dir))
+        try:
+            proxy.waitReady()
+            if "churn" in args.tests:
+                results["churn"] = benchChurn(args, proxy, target, neighbors)
+            if "conflict" in args.tests:
+                results["conflict"] = benchConflict(args, proxy, target, neighbors)
+        finally:
+            proxy.stop()
+    results["neighbor_arp_replies"] = neighbors.answered
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark address management on a simulated LAN")
+    parser.add_argument("--tests", default="discovery,validation,churn,conflict",
+                        help="comma separated tests to run")
+    parser.add_argument("--subnet", default="10.77.0.0/24", help="the simulated LAN")
+    parser.add_argument("--neighbors", type=int, default=50,
+                        help="addresses the simulated hosts answer ARP for")
+    parser.add_argument("--addresses", type=int, default=50, help="addresses for the proxy to use")
+    parser.add_argument("--connections", type=int, default=500, help="sessions for the churn test")
+    parser.add_argument("--conflict-sessions", type=int, default=50,
+                        help="sessions to check nobody gets a claimed address")
+    parser.add_argument("--engine", default="threading", choices=["threading", "asyncio"])
+    parser.add_argument("--net-backend", default="auto", choices=["auto", "netlink", "ip"])
+    parser.add_argument("--arp-rate", type=int, default=1000, help="ARP requests per second")
+    parser.add_argument("--proxy-port", type=int, default=1080)
+    parser.add_argument("--metrics-port", type=int, default=9108)
+    parser.add_argument("--target-port", type=int, default=8000)
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+    args.tests = [test.strip() for test in args.tests.split(",")]
+    if os.geteuid() != 0:
+        parser.error("creating network namespaces needs root")
+
+    try:
+        results = runAll(args)
+    finally:
+        tearDown()
+
+    report = {
+        "commit": gitCommit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": sys.version.split()[0],
+        "settings": {"subnet": args.subnet, "neighbors": args.neighbors,
+                     "addresses": args.addresses, "engine": args.engine,
+                     "net_backend": args.net_backend, "arp_rate": args.arp_rate},
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as fil:
+            fil.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
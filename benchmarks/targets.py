@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# Author: Micah Martin (knif3)
+# targets.py
+#
+# Local servers for the benchmarks to connect to through the proxy:
+#   echo:   sends back everything it receives
+#   source: reads an 8 byte length, sends that many bytes and closes
+#
+
+import argparse
+import asyncio
+import struct
+
+CHUNK = b'\0' * 262144
+
+
+async def echo(reader, writer):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def source(reader, writer):
+    try:
+        remaining = struct.unpack("!Q", await reader.readexactly(8))[0]
+        while remaining > 0:
+            writer.write(CHUNK[:remaining])
+            remaining -= len(CHUNK)
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host, echo_port, source_port):
+    echo_server = await asyncio.start_server(echo, host, echo_port, backlog=4096)
+    source_server = await asyncio.start_server(source, host, source_port, backlog=4096)
+    async with echo_server, source_server:
+        await asyncio.gather(echo_server.serve_forever(), source_server.serve_forever())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Echo and source servers for the benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--echo-port", type=int, default=9001)
+    parser.add_argument("--source-port", type=int, default=9002)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.echo_port, args.source_port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
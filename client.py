@@ -4,48 +4,254 @@
 #
 # Connects to the Sangheili server to allow tools to proxy through it. Equivilent to nc -x
 # This tool also allow us to listen on a localhost port and forward that traffic to the proxy
+#
+#   ssh -o ProxyCommand="python3 client.py -x $SOCKS_SERVER:$SOCKS_PORT %h %p" root@10.80.100.1
+#   python3 client.py -x $SOCKS_SERVER:$SOCKS_PORT -l 8443 10.80.100.1 443
+import os
 import sys
+import errno
+import select
 import socket
 import struct
 import argparse
+import threading
 
 SOCKS_VERSION = 5
 SOCKS_METHOD = 0 # No authentication
+BUFFER_SIZE = 262144  # Bytes read at a time in each direction
+
+REPLIES = {
+    1: "general failure",
+    2: "connection not allowed",
+    3: "network unreachable",
+    4: "host unreachable",
+    5: "connection refused",
+    6: "TTL expired",
+    7: "command not supported",
+    8: "address type not supported",
+}
+
 
 def setup_sock(rhost, rport, proxyhost, proxyport=1080, lhost="127.0.0.1", lport=None):
     """Setup the SOCKS5 connection to the remote server.
 
     Args:
-        rhost (str): The remote host to connect to
+        rhost (str): The remote host to connect to, hostnames are resolved by the proxy
         rport (int): the remote port to connect to
         proxyhost (str): The socks server to connect to
         proxyport (int, optional): the socks port to connect to
-        lhost (str, optional): the local host to 
+        lhost (str, optional): the local host to bind to
         lport (int, optional): the local port to bind to if provided
+    Returns:
+        socket.socket: the connected socket, ready to relay data to the remote host
+    """
+    sock = socket.create_connection((proxyhost, proxyport),
+                                    source_address=(lhost, lport) if lport and lhost else None)
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.sendall(struct.pack("!BBB", SOCKS_VERSION, 1, SOCKS_METHOD))
+        ver, method = struct.unpack("!BB", _recvExact(sock, 2))
+        if ver != SOCKS_VERSION or method != SOCKS_METHOD:
+            raise ConnectionError("The proxy does not accept unauthenticated clients")
+        sock.sendall(struct.pack("!BBB", SOCKS_VERSION, 1, 0) + _packAddress(rhost) +
+                     struct.pack("!H", rport))
+        _, reply, _, atype = struct.unpack("!BBBB", _recvExact(sock, 4))
+        if reply != 0:
+            raise ConnectionError("The proxy could not connect to {}:{}: {}".format(
+                                  rhost, rport, REPLIES.get(reply, reply)))
+        # Skip the address the proxy bound to
+        if atype == 1:
+            _recvExact(sock, 4 + 2)
+        elif atype == 4:
+            _recvExact(sock, 16 + 2)
+        else:
+            _recvExact(sock, _recvExact(sock, 1)[0] + 2)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+def _packAddress(host):
+    """Pack a host as a SOCKS5 address type and address"""
+    for family, atype in ((socket.AF_INET, 1), (socket.AF_INET6, 4)):
+        try:
+            return struct.pack("!B", atype) + socket.inet_pton(family, host)
+        except OSError:
+            pass
+    host = host.encode("idna")
+    return struct.pack("!BB", 3, len(host)) + host
+
+
+def _recvExact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("The proxy closed the connection")
+        data += chunk
+    return data
+
+
+class _Direction(object):
+    """One direction of a relay: read from src into a buffer and write it all to dst"""
+    def __init__(self, src, dst, finish, bufsize):
+        self.src = src
+        self.dst = dst
+        self.finish = finish  # Called once src has ended and everything was written to dst
+        self.buf = bytearray(bufsize)
+        self.view = memoryview(self.buf)
+        self.start = self.end = 0
+        self.eof = False
+        self.done = False
+
+
+def relay(local_in, local_out, sock, finish_local, bufsize=BUFFER_SIZE):
+    """Copy data both ways between local file descriptors and the proxy socket, without blocking
+    on either side, until both directions have ended.
+
+    Args:
+        local_in (int): the fd to read local data from
+        local_out (int): the fd to write remote data to (may be the same as local_in)
+        sock (socket.socket): the connection through the proxy
+        finish_local (callable): called when the remote side is done sending
+        bufsize (int, optional): bytes buffered in each direction
     """
-    sock = socket.socket()
-    if lport and lhost:
-        sock.bind((lhost, lport))  # Bind to the local port
-    sock.connect((proxyhost, proxyport))  # Connect to the proxy
-    data = struct.pack("!BBB", SOCKS_VERSION, 1, SOCKS_METHOD)
-    sock.sendall(data)
-    data = sock.recv(4096)  # Get the reply from the server
-    ver, method = struct.unpack("!BB", data)
-    assert ver == SOCKS_VERSION  # Validate server version
-    assert method == SOCKS_METHOD  # Validate server method
-    data = struct.pack("!BBBB", SOCKS_VERSION, 1, 0, 1) + socket.inet_aton(rhost) + struct.pack("!H", rport)
-    sock.sendall(data)
-    sock.recv(4096)
-    loop_socket(sock)
-
-def loop_socket(sock):
-    while True:
-        data = sys.stdin.readline(0)
-        sock.sendall(data)
-        sys.stdout.write(sock.recv(4096))
+    def finish_remote():
+        try:
+            sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+    directions = [_Direction(local_in, sock.fileno(), finish_remote, bufsize),
+                  _Direction(sock.fileno(), local_out, finish_local, bufsize)]
+    blocking = dict((fd, os.get_blocking(fd)) for fd in (local_in, local_out, sock.fileno()))
+    for fd in blocking:
+        os.set_blocking(fd, False)
+    try:
+        while not all(direction.done for direction in directions):
+            events = {}
+            for direction in directions:
+                if direction.done:
+                    continue
+                if direction.start < direction.end:
+                    events[direction.dst] = events.get(direction.dst, 0) | select.POLLOUT
+                else:
+                    events[direction.src] = events.get(direction.src, 0) | select.POLLIN
+            poller = select.poll()
+            for fd, mask in events.items():
+                poller.register(fd, mask)
+            poller.poll()
+            for direction in directions:
+                if not direction.done and not _pump(direction):
+                    # A side went away, there is nothing left to relay
+                    return
+    finally:
+        for fd, mode in blocking.items():
+            try:
+                os.set_blocking(fd, mode)
+            except OSError:
+                pass
+
+
+def _pump(direction):
+    """Move as much data as possible without blocking
+
+    Returns:
+        bool: False if the connection failed
+    """
+    try:
+        if direction.start == direction.end and not direction.eof:
+            count = os.readv(direction.src, [direction.buf])
+            if count == 0:
+                direction.eof = True
+            direction.start, direction.end = 0, count
+        while direction.start < direction.end:
+            direction.start += os.write(direction.dst,
+                                        direction.view[direction.start:direction.end])
+    except (BlockingIOError, InterruptedError):
+        return True
+    except OSError as E:
+        if E.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return True
+        return False
+    if direction.eof:
+        direction.done = True
+        direction.finish()
+    return True
+
+
+def stdio(args):
+    """Relay stdin and stdout to the remote host, for use as an SSH ProxyCommand"""
+    sock = setup_sock(args.host, args.port, args.proxyhost, args.proxyport)
+    try:
+        relay(sys.stdin.fileno(), sys.stdout.fileno(), sock, sys.stdout.close, args.buffer_size)
+    finally:
+        sock.close()
+
+
+def listen(args):
+    """Accept local connections and tunnel each one to the remote host through the proxy"""
+    server = socket.create_server((args.lhost, args.lport), backlog=128)
+    print("Forwarding {}:{} to {}:{} through {}:{}".format(args.lhost, args.lport, args.host,
+          args.port, args.proxyhost, args.proxyport), file=sys.stderr)
+    try:
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=forward, args=(conn, args), daemon=True).start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+def forward(conn, args):
+    """Tunnel one local connection"""
+    try:
+        sock = setup_sock(args.host, args.port, args.proxyhost, args.proxyport)
+    except (OSError, ConnectionError) as E:
+        print("WARN: {}".format(E), file=sys.stderr)
+        conn.close()
+        return
+
+    def finish_local():
+        try:
+            conn.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+    try:
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        relay(conn.fileno(), conn.fileno(), sock, finish_local, args.buffer_size)
+    finally:
+        sock.close()
+        conn.close()
+
 
 def main():
-    pass
+    parser = argparse.ArgumentParser(description="Connect to a host through a Sangheili proxy")
+    parser.add_argument("host", help="the remote host to connect to")
+    parser.add_argument("port", type=int, help="the remote port to connect to")
+    parser.add_argument("-x", "--proxy", metavar="HOST[:PORT]",
+                        default=os.environ.get("SOCKS_SERVER", "127.0.0.1"),
+                        help="the socks server (default $SOCKS_SERVER or 127.0.0.1)")
+    parser.add_argument("-l", "--lport", type=int,
+                        help="listen on this local port instead of using stdin and stdout")
+    parser.add_argument("--lhost", default="127.0.0.1", help="the local address to listen on")
+    parser.add_argument("--buffer-size", type=int, default=BUFFER_SIZE,
+                        help="bytes buffered in each direction")
+    args = parser.parse_args()
+    proxyhost, _, proxyport = args.proxy.rpartition(":")
+    if not proxyhost or not proxyport.isdigit():
+        proxyhost, proxyport = args.proxy, None
+    args.proxyhost = proxyhost.strip("[]")
+    args.proxyport = int(proxyport or os.environ.get("SOCKS_PORT", 1080))
+    try:
+        if args.lport:
+            listen(args)
+        else:
+            stdio(args)
+    except (OSError, ConnectionError) as E:
+        print("ERROR: {}".format(E), file=sys.stderr)
+        sys.exit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -5,26 +5,121 @@
 # Serve a SOCKS proxy and assign a random IP address to use for the outbound connection
 #
 
+import signal
+import socket
+import time
 from socketserver import ThreadingMixIn, TCPServer
 
-from src import config
+from src import config, metrics
+from src.limits import REJECT, SHUTDOWN_TIMEOUT, getAdmission
 from src.session import SocksSession
-from src.networking import net_init
+from src.sessionlog import getSessionLog
+from src.tracing import installSignals
+from src.networking import net_init, net_start, net_close
 
 class ThreadingTCPServer(ThreadingMixIn, TCPServer):
-    pass
+    # Sessions can stay open for hours, so server_close() ends them instead of waiting
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+    reuse_port = False  # Set to share the port between worker processes
+    accepted = {}  # id(request) => when it was accepted, for the accept latency metric
+    sessions = set()  # The SocksSession of every open session
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        TCPServer.server_bind(self)
+
+    def process_request(self, request, client_address):
+        if not getAdmission().admit():
+            # Too many sessions, turn the client away without starting a thread for it
+            try:
+                request.send(REJECT, socket.MSG_DONTWAIT)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        self.accepted[id(request)] = time.monotonic()
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def server_close(self):
+        """Stop listening, then end every open session and give them a moment to give back
+        their addresses before those are deleted
+        """
+        TCPServer.server_close(self)
+        sessions = list(self.sessions)
+        for session in sessions:
+            session.expire("shutdown")
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        for session in sessions:
+            session.thread.join(max(0, deadline - time.monotonic()))
+
+def serve(worker=None):
+    """Serve the proxy until interrupted
+
+    Args:
+        worker (int, optional): the index of this worker process, if running several
+    """
+    if config.config.get("metrics_port"):
+        # Every worker serves its own metrics on the next port up
+        metrics.startServer(config.config.get("metrics_host", "127.0.0.1"),
+                            config.config.get("metrics_port") + (worker or 0))
+
+    # Every worker logs to its own file, and traces itself when signalled
+    getSessionLog(worker)
+    installSignals()
+
+    host = config.config.get("server", "0.0.0.0")
+    port = int(config.config.get("port", 1080))
+    if config.config.get("engine") == "asyncio":
+        from src.asyncserver import serve_forever
+        serve_forever(host, port, reuse_port=worker is not None)
+        return
+
+    # Set up the server and start listening
+    ThreadingTCPServer.reuse_port = worker is not None
+    ThreadingTCPServer.address_family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    server = ThreadingTCPServer((host, port), SocksSession)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+def monitor(index):
+    """Watch the network and keep the addresses up to date for the workers, until killed
+
+    Args:
+        index (int): the index after the last worker's, for the metrics port
+    """
+    if config.config.get("metrics_port"):
+        metrics.startServer(config.config.get("metrics_host", "127.0.0.1"),
+                            config.config.get("metrics_port") + index)
+    net_start()
+    while True:
+        signal.pause()
+
+def _terminate(signum, frame):
+    raise SystemExit(0)
 
 def main():
     # Set up all the networking stuff
     net_init()
 
-    # Set up the server and start listening
-    server = ThreadingTCPServer((config.config.get("server", "0.0.0.0"), config.config.get("port",
-    1080)), SocksSession)
+    # Take our addresses off the interface however we are stopped
+    signal.signal(signal.SIGTERM, _terminate)
     try:
-        server.serve_forever()
+        workers = config.config.get("workers", 1)
+        if workers > 1:
+            from src.workers import Supervisor
+            Supervisor(workers, serve, monitor).run()
+        else:
+            net_start()
+            serve()
     except KeyboardInterrupt:
-        server.server_close()
+        pass
+    finally:
+        net_close()
 
 if __name__ == '__main__':
     main()
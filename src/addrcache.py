@@ -0,0 +1,130 @@
+# Author: Micah Martin (knif3)
+# addrcache.py
+#
+# Remember which addresses were verified free so a restart doesn't have to probe them all again
+#
+
+import json
+import os
+import threading
+import time
+
+
+class AddressCache(object):
+    """A JSON file of ARP results, keyed by device and subnet.
+
+    For every address we keep when it was last found free (or taken), so on startup recently
+    verified addresses can be used straight away.
+
+    Args:
+        path (str): the file to keep the results in
+        dev (str): the device the addresses were probed on
+        subnet (str): the subnet they belong to, ie "192.168.1.0/24"
+        max_age (float, optional): seconds a result is trusted for
+    """
+    def __init__(self, path, dev, subnet, max_age=3600):
+        self.path = path
+        self.key = "{} {}".format(dev, subnet)
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._data = {}
+        self.free = {}  # ip => when it was last verified free
+        self.taken = {}  # ip => when it was last seen in use
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as fil:
+                self._data = json.load(fil)
+        except (OSError, ValueError):
+            self._data = {}
+        entry = self._data.get(self.key, {})
+        self.free = dict(entry.get("free", {}))
+        self.taken = dict(entry.get("taken", {}))
+
+    def save(self):
+        """Write the cache, replacing the file atomically"""
+        with self._lock:
+            self._data[self.key] = {"free": self.free, "taken": self.taken}
+            tmp = "{}.{}.tmp".format(self.path, os.getpid())
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                with open(tmp, "w") as fil:
+                    json.dump(self._data, fil)
+                os.replace(tmp, self.path)
+            except OSError as E:
+                print("WARN: Cannot save the address cache {}: {}".format(self.path, E))
+
+    def record(self, free=(), taken=()):
+        """Record the result of probing some addresses"""
+        now = time.time()
+        with self._lock:
+            for ip in free:
+                self.free[ip] = now
+                self.taken.pop(ip, None)
+            for ip in taken:
+                self.taken[ip] = now
+                self.free.pop(ip, None)
+
+    def fresh(self):
+        """Returns:
+            set: the addresses verified free within max_age
+        """
+        expires = time.time() - self.max_age
+        with self._lock:
+            free = list(self.free.items())
+        return set(ip for ip, verified in free if verified > expires)
+
+    def recentlyTaken(self):
+        """Returns:
+            set: the addresses seen in use within max_age
+        """
+        expires = time.time() - self.max_age
+        with self._lock:
+            taken = list(self.taken.items())
+        return set(ip for ip, seen in taken if seen > expires)
+
+    def oldestFirst(self, addresses):
+        """Sort addresses so the ones verified longest ago come first"""
+        with self._lock:
+            free = dict(self.free)
+        return sorted(addresses, key=lambda ip: free.get(ip, 0))
+
+
+class Revalidator(object):
+    """Probe addresses again in the background, a small batch at a time.
+
+    Args:
+        cache (AddressCache): where to record the results
+        scanner (ArpScanner): used to probe the addresses
+        addresses (list): the addresses to probe, in order
+        apply (callable): called with the sets of free and taken addresses after each batch
+        batch (int, optional): how many addresses to probe at once
+        pause (float, optional): seconds to wait between batches
+    """
+    def __init__(self, cache, scanner, addresses, apply, batch=32, pause=1):
+        self.cache = cache
+        self.scanner = scanner
+        self.addresses = list(addresses)
+        self.apply = apply
+        self.batch = batch
+        self.pause = pause
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name="Revalidator", daemon=True)
+        thread.start()
+        return thread
+
+    def _run(self):
+        for start in range(0, len(self.addresses), self.batch):
+            batch = set(self.addresses[start:start + self.batch])
+            try:
+                free = self.scanner.scan(batch)
+            except OSError as E:
+                print("WARN: Cannot revalidate addresses: {}".format(E))
+                return
+            taken = batch - free
+            self.cache.record(free, taken)
+            self.cache.save()
+            self.apply(free, taken)
+            time.sleep(self.pause)
@@ -1,25 +1,46 @@
-import sys
+import threading
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 class ArkApiError(Exception):
     pass
 
 class ArkClient(object):
-    def __init__(self, server, username=None, password=None):
+    """Talk to the Ark server over one pooled, keep-alive session
+
+    Args:
+        server (str): the url of the Ark server
+        username (str, optional): log in with this username
+        password (str, optional): log in with this password
+        timeout (float, optional): seconds to wait for the server to connect and to answer
+        retries (int, optional): how many times to retry failed requests, with backoff
+    """
+    def __init__(self, server, username=None, password=None, timeout=10, retries=3):
         self.server = server.rstrip('/') + "/"
         self.token = None
+        self.timeout = timeout
+        self._credentials = None  # Kept to log in again when the token expires
+        self.session = requests.Session()
+        # Only idempotent methods are retried, so a login or registration is never sent twice
+        retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
         if username and password:
             self.login(username, password)
 
-    def _send(self, method, data):
+    def _send(self, method, endpoint, data):
         """Handle the sending of data to the ark server"""
-        endpoint = sys._getframe(1).f_code.co_name  # Calling function name is the endpoint
-        if endpoint != "/login" and "auth-token" not in data:
+        if endpoint != "login" and "auth-token" not in data:
+            data['auth-token'] = self.token
+        resp = self._request(method, endpoint, data)
+        if resp.status_code == 401 and endpoint != "login" and self._credentials:
+            # The token expired, log in again and try once more
+            self.login(*self._credentials)
             data['auth-token'] = self.token
-        if method.lower() == 'post':
-            resp = requests.post(self.server+endpoint, json=data)
-        else:
-            resp = requests.get(self.server+endpoint, json=data)
+            resp = self._request(method, endpoint, data)
         if resp.status_code == 200:
             try:
                 data = resp.json()
@@ -27,7 +48,7 @@ class ArkClient(object):
                     raise ArkApiError(data['error'])
                 return data
             except ValueError:
-                ArkApiError("Server did not send back valid json")
+                raise ArkApiError("Server did not send back valid json")
         elif resp.status_code == 400:
             try:
                 data = resp.json()
@@ -36,35 +57,122 @@ class ArkClient(object):
                 return data
             except ValueError:
                 pass
-            ArkApiError("An invalid request was sent to the server")
+            raise ArkApiError("An invalid request was sent to the server")
+        elif resp.status_code == 401:
+            raise ArkApiError("The server did not accept our credentials")
         elif resp.status_code == 403:
-            ArkApiError("You are not authorized to call this API function")
+            raise ArkApiError("You are not authorized to call this API function")
         raise ArkApiError("Invald response code: {}".format(resp.status_code))
 
+    def _request(self, method, endpoint, data):
+        try:
+            return self.session.request(method.upper(), self.server+endpoint, json=data,
+                                        timeout=self.timeout)
+        except requests.RequestException as E:
+            raise ArkApiError("Cannot reach the server: {}".format(E))
+
     def login(self, username, password):
         data = {
             "username": username,
             "password": password
         }
-        data = self._send("post", data)
+        data = self._send("post", "login", data)
         if "auth-token" in data:
             self.token = data['auth-token']
+            self._credentials = (username, password)
             return True
         return False
-    
+
     def registerHalo(self, haloName, count=None):
         """Register a Halo"""
         data = {
             "haloName": haloName
         }
         if count:   data['count'] = count
-        return self._send("post", data)
-    
-    def getAddresses(self, haloName, count=None, unused=None):
+        return self._send("post", "registerHalo", data)
+
+    def getAddresses(self, haloName, count=None, unused=None, offset=None):
         """Get the addresses for a Halo"""
         data = {'haloName': haloName}
         if count:
             data['count'] = count
         if unused is not None:
             data['unused'] = unused
-        return self._send("get", data)
\ No newline at end of file
+        if offset:
+            data['offset'] = offset
+        return self._send("get", "getAddresses", data)
+
+    def getAllAddresses(self, haloName, page_size=None):
+        """Get every address of a Halo, in pages of page_size for large halos. Stops at a page
+        with nothing new in it, in case the server ignores the offset
+
+        Returns:
+            list: the addresses
+        """
+        if not page_size:
+            return self.getAddresses(haloName).get('addresses', [])
+        addresses = []
+        seen = set()
+        offset = 0
+        while True:
+            page = self.getAddresses(haloName, count=page_size,
+                                     offset=offset).get('addresses', [])
+            offset += len(page)
+            new = [ip for ip in page if ip not in seen]
+            seen.update(new)
+            addresses += new
+            if len(page) < page_size or not new:
+                return addresses
+
+
+class ArkRefresher(object):
+    """Poll the Ark server in the background and apply added and revoked addresses to the pool.
+
+    Runs on its own thread so connection handling never waits on the server. Failed polls are
+    logged and retried on the next interval.
+
+    Args:
+        client (ArkClient): a logged in client
+        haloName (str): the halo to follow
+        update (callable): called with the new address list, returns the sets of added and
+            revoked addresses
+        interval (float, optional): seconds between polls
+        page_size (int, optional): fetch the addresses in pages of this size
+    """
+    def __init__(self, client, haloName, update, interval=300, page_size=None):
+        self.client = client
+        self.haloName = haloName
+        self.update = update
+        self.interval = interval
+        self.page_size = page_size
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="ArkRefresher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def refresh(self):
+        """Fetch the addresses once and update the pool
+
+        Returns:
+            tuple: the sets of added and revoked addresses
+        """
+        addresses = self.client.getAllAddresses(self.haloName, self.page_size)
+        if not addresses:
+            raise ArkApiError("The server returned no addresses for {}".format(self.haloName))
+        return self.update(addresses)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                added, revoked = self.refresh()
+                if added or revoked:
+                    print("Ark addresses updated: {} added, {} revoked".format(
+                          len(added), len(revoked)))
+            except Exception as E:
+                # Keep polling whatever went wrong, the next refresh may well work
+                print("WARN: Cannot refresh addresses from the Ark server: {}".format(E))
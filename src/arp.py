@@ -5,14 +5,21 @@
 # http://dk0d.blogspot.com/2016/07/code-for-sending-arp-request-with-raw.html
 
 #import fcntl
+import select
 import socket
 import struct
+import time
 from threading import Thread, Event
 
+ETH_P_ARP = 0x0806
+# Ethernet header then ARP: dst, src, ethertype, htype, ptype, hlen, plen, op, sha, spa, tha, tpa
+ARP_FRAME = struct.Struct("!6s6sHHHBBH6s4s6s4s")
 
-def isIpTaken(dev, ip):
+
+def isIpTaken(dev, ip, ip_src=None, mac_src=None):
     '''
-    The device to send the ARP to
+    The device to send the ARP to. Pass ip_src and mac_src if they are already known to save
+    looking them up again
     '''
     timeout = 0.25
     # initialize the socket to listen on (0x0003)
@@ -26,7 +33,7 @@ def isIpTaken(dev, ip):
     listener.start()
 
     # Send an arp packet out
-    send_arp(dev, ip)
+    send_arp(dev, ip, mac_src, ip_src)
     # Wait for the thread or kill it
     isdone.wait(timeout=timeout)
     isdone.set()
@@ -88,7 +95,7 @@ def _getIpFromDevice(dev):
     return ip
 
 
-def send_arp(device, ip_dst, mac_src=None):
+def send_arp(device, ip_dst, mac_src=None, ip_src=None):
     '''
     Send an ARP request to the given raw socket
     Args:
@@ -96,11 +103,13 @@ def send_arp(device, ip_dst, mac_src=None):
         ip_src (string): The source IP address
         ip_dst (string): The destination IP address as a string.
         mac_src (bytes, optional): The source MAC address as a byte string
+        ip_src (string, optional): The source IP address, looked up from the device if not given
     Returns:
         bool:   Whether or not the arp packet was sent
     '''
     # Get the IP address
-    ip_src = _getIpFromDevice(device)
+    if not ip_src:
+        ip_src = _getIpFromDevice(device)
     if ip_dst == ip_src:
         return True
     # Create raw socket
@@ -109,8 +118,15 @@ def send_arp(device, ip_dst, mac_src=None):
     sock.bind((device, socket.SOCK_RAW))
     if not mac_src:
         mac_src = sock.getsockname()[4]  # Get the mac from socket (in binary)
-    # Pack everything together into a packet
-    FRAME = (
+    FRAME = _buildArpRequest(mac_src, ip_src, ip_dst)
+    sock.send(FRAME)
+    sock.close()
+
+
+def _buildArpRequest(mac_src, ip_src, ip_dst):
+    """Pack an ARP request for ip_dst into an ethernet frame
+    """
+    return (
     b'\xFF\xFF\xFF\xFF\xFF\xFF' +           # Broadcast mac
     mac_src +                               # Source MAC
     b'\x08\x06' +                           # Type: ARP
@@ -124,8 +140,154 @@ def send_arp(device, ip_dst, mac_src=None):
     b'\x00\x00\x00\x00\x00\x00' +           # A blank mac
     socket.inet_aton(ip_dst)                # Target IP
     )
-    sock.send(FRAME)
-    sock.close()
+
+
+class ArpScanner(object):
+    """Probe many addresses at once with one send socket and one receive socket.
+
+    Requests are sent at a fixed rate while replies are collected in the same loop, then every
+    address that stayed quiet is asked again before it is declared free.
+
+    Args:
+        dev (str): the device to scan on
+        rate (int, optional): ARP requests to send per second
+        window (float, optional): seconds to keep listening after the last request of a pass
+        retries (int, optional): extra passes over the addresses that did not answer
+        ip_src (str, optional): our address on the device, looked up if not given
+        mac_src (bytes, optional): our MAC on the device, looked up if not given
+    """
+    def __init__(self, dev, rate=1000, window=0.5, retries=1, ip_src=None, mac_src=None):
+        self.dev = dev
+        self.rate = rate
+        self.window = window
+        self.retries = retries
+        self.ip_src = ip_src or _getIpFromDevice(dev)
+        self.mac_src = mac_src
+
+    def scan(self, candidates):
+        """Find out which of the candidates are not in use
+
+        Args:
+            candidates (iterable): the ip addresses to probe
+        Returns:
+            set: the addresses nobody answered for
+        """
+        candidates = set(candidates)
+        candidates.discard(self.ip_src)
+        taken = set()
+        recv_sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ARP))
+        send_sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ARP))
+        try:
+            recv_sock.bind((self.dev, ETH_P_ARP))
+            recv_sock.setblocking(False)
+            send_sock.bind((self.dev, ETH_P_ARP))
+            mac_src = self.mac_src or send_sock.getsockname()[4]
+            pending = candidates
+            for _ in range(1 + self.retries):
+                self._sendPass(send_sock, recv_sock, mac_src, pending, taken)
+                pending = pending - taken
+                if not pending:
+                    break
+        finally:
+            recv_sock.close()
+            send_sock.close()
+        return candidates - taken
+
+    def _sendPass(self, send_sock, recv_sock, mac_src, targets, taken):
+        interval = 1.0 / self.rate if self.rate else 0
+        deadline = time.monotonic()
+        for ip in targets:
+            if ip in taken:
+                continue
+            send_sock.send(_buildArpRequest(mac_src, self.ip_src, ip))
+            deadline += interval
+            self._collect(recv_sock, mac_src, taken, deadline)
+        self._collect(recv_sock, mac_src, taken, time.monotonic() + self.window)
+
+    def _collect(self, sock, mac_src, taken, deadline):
+        """Record the sender of every ARP packet from another host seen until the deadline"""
+        while True:
+            timeout = deadline - time.monotonic()
+            if timeout > 0:
+                select.select([sock], [], [], timeout)
+            while True:
+                try:
+                    frame, address = sock.recvfrom(2048)
+                except BlockingIOError:
+                    break
+                # Our own requests, and the kernel's for our live addresses, don't count
+                if address[2] == socket.PACKET_OUTGOING or frame[22:28] == mac_src:
+                    continue
+                # Any ARP traffic from an address, reply or request, means it is in use
+                if len(frame) >= 42 and frame[12:14] == b'\x08\x06':
+                    taken.add(socket.inet_ntoa(frame[28:32]))
+            if deadline - time.monotonic() <= 0:
+                return
+
+
+class ArpMonitor(object):
+    """Passively watch the ARP traffic on a device for other hosts claiming our addresses.
+
+    Uses one long-lived packet socket and a single thread. An address is in conflict when an ARP
+    packet from a MAC that is not ours says it owns the address, or probes for it before taking it.
+    The same socket can answer requests for addresses that are routed to us but not configured on
+    the device (see the "anyip" address mode).
+
+    Args:
+        dev (str): the device to watch
+        watched (callable): called with an ip address, returns True if it is one of ours
+        conflict (callable): called with the ip address and the foreign MAC (as a string) when
+            another host claims one of our addresses, or None to not look for conflicts
+        mac_src (bytes, optional): our MAC on the device, looked up if not given
+        answer (callable, optional): called with the ip address of a request, returns True if
+            we should reply that it is ours
+    """
+    def __init__(self, dev, watched, conflict, mac_src=None, answer=None):
+        self.dev = dev
+        self.watched = watched
+        self.conflict = conflict
+        self.answer = answer
+        self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ARP))
+        self.sock.bind((dev, ETH_P_ARP))
+        self.sock.settimeout(1)
+        self.mac_src = mac_src or self.sock.getsockname()[4]
+        self._stop = Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self._run, name="ArpMonitor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        buf = bytearray(2048)
+        unpack = ARP_FRAME.unpack_from
+        while not self._stop.is_set():
+            try:
+                size = self.sock.recv_into(buf)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if size < ARP_FRAME.size:
+                continue
+            _, _, _, _, ptype, _, plen, op, sha, spa, _, tpa = unpack(buf)
+            if ptype != 0x0800 or plen != 4 or sha == self.mac_src:
+                continue
+            # A probe (RFC 5227) has no sender address yet, but names the one it wants
+            probe = spa == b'\x00\x00\x00\x00'
+            ip = socket.inet_ntoa(tpa if probe else spa)
+            if self.conflict and self.watched(ip):
+                self.conflict(ip, ":".join("{:02x}".format(byte) for byte in sha))
+            elif self.answer and op == 1 and not probe and self.answer(socket.inet_ntoa(tpa)):
+                try:
+                    self.sock.send(ARP_FRAME.pack(sha, self.mac_src, ETH_P_ARP, 1, 0x0800, 6, 4,
+                                                  2, self.mac_src, tpa, sha, spa))
+                except OSError:
+                    pass
+        self.sock.close()
 
 
 if __name__ == "__main__":
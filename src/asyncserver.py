@@ -0,0 +1,403 @@
+# Author: Micah Martin (knif3)
+# asyncserver.py
+#
+# Serve SOCKS proxy requests on a single asyncio event loop instead of a thread per connection
+#
+
+import asyncio
+import signal
+import socket
+import struct
+import time
+
+from . import config, metrics
+from .connector import raceConnectAsync
+from .limits import REJECT, SHUTDOWN_TIMEOUT, SessionTimer, getAdmission
+from .networking import (AddressFamilyUnsupported, PoolExhausted, new_ip, cleanup_ip,
+                         outboundSocket)
+from .resolver import getResolver
+from .sessionlog import getSessionLog
+from .tracing import getTracer, within
+from .udprelay import UdpRelay
+from .session import VERSION, METHOD, HandshakeError, HandshakeParser, packReply
+
+
+class AsyncSocksSession(object):
+    """Handle one incoming SOCKS connection on the event loop.
+
+    This mirrors SocksSession, but every socket operation is awaited so that a single thread can
+    hold tens of thousands of idle tunnels. Blocking helpers (new_ip/cleanup_ip) run in the
+    default executor so they never stall the loop.
+    """
+    BUFFER_SIZE = 65536
+
+    def __init__(self, reader, writer):
+        self._loop = asyncio.get_running_loop()
+        self._src_reader = reader
+        self._src_writer = writer
+        self._dst_reader = None
+        self._dst_writer = None
+        self._remote_addr = None
+        self._remote_port = None
+        self._outbound_ip = None
+        self._outbound_ip6 = None
+        self._early_data = b''
+        self._udp = None
+        self._sent = 0
+        self._received = 0
+        self._source = None  # The outbound address, kept for the log after its lease ends
+        self._error = None
+        self.client_address = writer.get_extra_info("peername")
+        self._chunk = min(self.BUFFER_SIZE, config.config.get("session_buffer_limit") or
+                          self.BUFFER_SIZE)
+
+    async def handle(self):
+        if not getAdmission().admit():
+            # Too many sessions, turn the client away before doing any work for it
+            self._src_writer.write(REJECT)
+            self._src_writer.close()
+            return
+        self._started = time.monotonic()
+        metrics.sessions.inc()
+        metrics.active_sessions.inc()
+        self._phase = self._started
+        self._trace = None
+        self._timer = None
+        handshaking = True
+        try:
+            self._trace = getTracer().begin(self.client_address, self._started)
+            # The loop already keeps a timer heap, so the session timer schedules on it
+            self._timer = SessionTimer(
+                self.expire, lambda: self._sent + self._received,
+                idle=config.config.get("handshake_timeout", 10),
+                lifetime=config.config.get("session_max_lifetime", 0),
+                schedule=lambda when, callback: self._loop.call_later(
+                    max(0, when - time.monotonic()), callback))
+            self._limitBuffers(self._src_writer)
+            started = await self.startSession()
+            getAdmission().handshakeDone()
+            handshaking = False
+            if started:
+                # UDP associations have their own idle timeout
+                self._timer.setIdle(0 if self._udp else
+                                    config.config.get("session_idle_timeout", 3600))
+                await self.handleSession()
+            else:
+                metrics.session_errors.inc()
+                self._error = self._error or "handshake failed"
+        except (asyncio.IncompleteReadError, ConnectionError) as err:
+            metrics.session_errors.inc()
+            self._error = "{}: {}".format(type(err).__name__, err)
+        finally:
+            if self._timer:
+                self._timer.cancel()
+            getAdmission().release(handshaking)
+            if self._timer and self._timer.expired:
+                self._error = "expired ({})".format("handshake" if handshaking else
+                                                    self._timer.expired)
+            await self.close()
+            ended = metrics.phases["session"].time(self._started)
+            metrics.active_sessions.dec()
+            if self._udp:
+                self._sent, self._received = self._udp.sent, self._udp.received
+            getSessionLog().record(self.client_address, (self._remote_addr, self._remote_port),
+                                   self._source, self._sent, self._received,
+                                   ended - self._started, self._error,
+                                   "udp" if self._udp else "connect")
+            if self._trace:
+                getTracer().finish(self._trace, (self._remote_addr, self._remote_port), ended,
+                                   self._error)
+
+    async def startSession(self):
+        """Start the SOCKS5 session. See SocksSession.startSession for the details of RFC1928
+
+        Returns:
+            bool: Whether or not the socks proxy was to our spec.
+        """
+        parser = HandshakeParser()
+        try:
+            if not await self._readUntil(parser, lambda: parser.methods is not None):
+                return False
+        except HandshakeError:
+            await self.endSession(0)  # End session with unsupported VERSION
+            return False
+        if METHOD not in parser.methods:
+            await self.endSession(0)  # End session with unsupported method
+            return False
+
+        # Choose the method we plan on using and send it back to the server
+        self._src_writer.write(struct.pack("!BB", VERSION, METHOD))
+
+        # Start figuring out what the client wants to do
+        try:
+            if not await self._readUntil(parser, lambda: parser.request is not None):
+                return False
+        except HandshakeError as err:
+            self._error = str(err)
+            await self._reply(err.reply)
+            return False
+        cmd, _, self._remote_addr, self._remote_port = parser.request
+        self._early_data = parser.leftover()
+        self._phase = self._mark("handshake")
+        # Handle the client command
+        if cmd == 3:
+            return await self.startAssociation()
+        if cmd != 1:  # Only CONNECT and UDP ASSOCIATE are supported
+            await self._reply(7)
+            return False
+        try:
+            await self.connectRemote()
+            bndaddr, bndport = self._dst_writer.get_extra_info("sockname")[:2]
+            await self._reply(0, bndaddr, bndport)
+        except AddressFamilyUnsupported as err:
+            self._error = str(err)
+            await self._reply(8)  # Address type not supported
+            return False
+        except PoolExhausted as err:
+            self._error = str(err)
+            await self._reply(1)  # General failure
+            return False
+        except Exception as err:
+            self._error = str(err)
+            await self._reply(5)  # Return connection refused
+            return False
+        return True
+
+    async def startAssociation(self):
+        """Set up a UDP ASSOCIATE, see SocksSession.startAssociation
+
+        Returns:
+            bool: Whether or not the association was set up
+        """
+        try:
+            self._outbound_ip = await self._loop.run_in_executor(None, within, self._trace, new_ip)
+            try:
+                self._outbound_ip6 = await self._loop.run_in_executor(
+                    None, within, self._trace, new_ip, None, socket.AF_INET6)
+            except AddressFamilyUnsupported:
+                pass
+            self._phase = self._mark("new_ip")
+            self._source = self._outbound_ip
+            self._udp = UdpRelay(self.client_address[0], self._remote_port,
+                                 self._src_writer.get_extra_info("sockname")[0], self._outbound_ip,
+                                 self._outbound_ip6)
+        except (PoolExhausted, OSError) as err:
+            self._error = str(err)
+            await self._reply(1)  # General failure
+            return False
+        await self._reply(0, *self._udp.address)
+        return True
+
+    async def _readUntil(self, parser, done):
+        """Feed the parser from the client until done() is true
+
+        Returns:
+            bool: False if the client closed the connection first
+        """
+        while not done():
+            data = await self._src_reader.read(4096)
+            if not data:
+                return False
+            parser.feed(data)
+        return True
+
+    async def _reply(self, code, bndaddr="0.0.0.0", bndport=0):
+        """Send the reply to the client's request"""
+        self._src_writer.write(packReply(code, bndaddr, bndport))
+        await self._src_writer.drain()
+
+    async def handleSession(self):
+        if self._udp:
+            await self.handleAssociation()
+            return
+        if self._early_data:
+            # The client did not wait for our reply before sending its payload
+            self._dst_writer.write(self._early_data)
+            self._sent += len(self._early_data)
+        await asyncio.gather(
+            self._pipe(self._src_reader, self._dst_writer, "_sent"),
+            self._pipe(self._dst_reader, self._src_writer, "_received"),
+        )
+        self._traceRelay()
+        metrics.recordBytes(self._sent, self._received)
+
+    async def handleAssociation(self):
+        """Relay datagrams from the event loop until the client hangs up or goes idle"""
+        idle = config.config.get("udp_idle_timeout", 120)
+        self._loop.add_reader(self._udp.client_sock, self._udp.drainClient)
+        for sock in self._udp.remote_socks:
+            self._loop.add_reader(sock, self._udp.drainRemote, sock)
+        try:
+            while True:
+                remaining = self._udp.last_active + idle - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    if not await asyncio.wait_for(self._src_reader.read(4096), remaining):
+                        break
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._loop.remove_reader(self._udp.client_sock)
+            for sock in self._udp.remote_socks:
+                self._loop.remove_reader(sock)
+        self._traceRelay()
+        metrics.recordBytes(self._udp.sent, self._udp.received)
+
+    async def _pipe(self, reader, writer, counter):
+        """Copy data from the reader to the writer until EOF, then pass the EOF along"""
+        try:
+            while True:
+                data = await reader.read(self._chunk)
+                if not data:
+                    break
+                if counter == "_received" and not self._received:
+                    self._mark("first_byte")
+                setattr(self, counter, getattr(self, counter) + len(data))
+                writer.write(data)
+                await writer.drain()
+            if writer.can_write_eof():
+                writer.write_eof()
+        except (ConnectionError, OSError):
+            # One side went away, tear down both directions
+            self._src_writer.transport.abort()
+            if self._dst_writer:
+                self._dst_writer.transport.abort()
+
+    def _mark(self, phase):
+        """Time a phase of the session that ended just now, see SocksSession._mark"""
+        now = metrics.phases[phase].time(self._phase)
+        if self._trace:
+            self._trace.span(phase, self._phase, now)
+        return now
+
+    def _traceRelay(self):
+        if self._trace:
+            self._trace.span("relay", self._phase, time.monotonic())
+
+    def expire(self, reason):
+        """Called by the session timer to end a session that is idle or too old"""
+        for writer in (self._src_writer, self._dst_writer):
+            if writer:
+                writer.transport.abort()
+
+    def _limitBuffers(self, writer):
+        """Stop reading from one side while the other has 'session_buffer_limit' bytes queued"""
+        limit = config.config.get("session_buffer_limit")
+        if limit:
+            writer.transport.set_write_buffer_limits(high=limit)
+
+    async def endSession(self, reason=0):
+        """End the SOCKS session due to an error."""
+        if reason == 0:
+            reply = struct.pack("!BB", VERSION, 255)  # Unsupported version or auth method
+        self._src_writer.write(reply)
+        await self._src_writer.drain()
+
+    async def connectRemote(self):
+        """Connect to the remote host from the chosen outbound IP address"""
+        remote = (await getResolver().resolveAsync(self._remote_addr), self._remote_port)
+        family = socket.AF_INET6 if ":" in remote[0] else socket.AF_INET
+        self._outbound_ip = await self._loop.run_in_executor(None, within, self._trace, new_ip,
+                                                             self._remote_addr, family)
+        self._source = self._outbound_ip
+        self._phase = self._mark("new_ip")
+        timeout = config.config.get("connect_timeout", 10)
+        if config.config.get("connect_strategy") == "race":
+            # The racer owns our lease now and gives us back the address that won
+            ip, self._outbound_ip = self._outbound_ip, None
+            sock, self._outbound_ip = await raceConnectAsync(
+                remote, ip, attempts=config.config.get("connect_attempts", 2),
+                stagger=config.config.get("connect_stagger", 0.25), timeout=timeout)
+        else:
+            sock = outboundSocket(self._outbound_ip)
+            sock.setblocking(False)
+            try:
+                await asyncio.wait_for(self._loop.sock_connect(sock, remote), timeout)
+            except Exception:
+                sock.close()
+                raise
+        self._source = self._outbound_ip
+        self._phase = self._mark("connect")
+        self._dst_reader, self._dst_writer = await asyncio.open_connection(
+            sock=sock, limit=self._chunk)
+        self._limitBuffers(self._dst_writer)
+
+    async def close(self):
+        """Clean up the sockets"""
+        for writer in (self._src_writer, self._dst_writer):
+            if writer:
+                writer.close()
+        if self._udp:
+            self._udp.close()
+        for attr in ("_outbound_ip", "_outbound_ip6"):
+            ip = getattr(self, attr)
+            if ip:
+                setattr(self, attr, None)
+                await self._loop.run_in_executor(None, within, self._trace, cleanup_ip, ip)
+
+
+async def _serve(host, port, reuse_port=False):
+    limit = min(AsyncSocksSession.BUFFER_SIZE, config.config.get("session_buffer_limit") or
+                AsyncSocksSession.BUFFER_SIZE)
+    sessions = {}  # AsyncSocksSession => the task handling it
+
+    async def handle(reader, writer):
+        session = AsyncSocksSession(reader, writer)
+        sessions[session] = asyncio.current_task()
+        try:
+            await session.handle()
+        finally:
+            del sessions[session]
+
+    server = await asyncio.start_server(
+        handle, host, port, backlog=4096, reuse_address=True, reuse_port=reuse_port, limit=limit)
+    # Serve until told to stop. Workers leave SIGINT to the supervisor
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    signals = [signal.SIGTERM]
+    if signal.getsignal(signal.SIGINT) is not signal.SIG_IGN:
+        signals.append(signal.SIGINT)
+    for signum in signals:
+        loop.add_signal_handler(signum, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        for signum in signals:
+            loop.remove_signal_handler(signum)
+    # Stop listening, then end every open session and let them give back their addresses
+    server.close()
+    for session in list(sessions):
+        session.expire("shutdown")
+    if sessions:
+        await asyncio.wait(list(sessions.values()), timeout=SHUTDOWN_TIMEOUT)
+
+
+def _raiseFileLimit():
+    """Every tunnel holds two descriptors, so allow as many as the hard limit permits"""
+    try:
+        import resource
+        _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def serve_forever(host, port, reuse_port=False):
+    """Run the asyncio SOCKS server until interrupted. Uses uvloop if it is installed
+
+    Args:
+        host (str): the address to listen on
+        port (int): the port to listen on
+        reuse_port (bool, optional): share the port with other worker processes
+    """
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+    _raiseFileLimit()
+    try:
+        asyncio.run(_serve(host, port, reuse_port))
+    except KeyboardInterrupt:
+        pass
@@ -2,13 +2,120 @@
 import os
 import copy
 
+TRUE_VALUES = ["true", "yes", "1", "t"]
+
+
+def _getBool(name, default='false'):
+    """Read a boolean setting from the environment"""
+    return os.environ.get(name, default).lower().strip() in TRUE_VALUES
+
+
+def _getInt(name, default):
+    """Read an integer setting from the environment, falling back to the default"""
+    try:
+        return int(os.environ.get(name, str(default)))
+    except:
+        return default
+
+
+def _getFloat(name, default):
+    """Read a decimal setting from the environment, falling back to the default"""
+    try:
+        return float(os.environ.get(name, str(default)))
+    except:
+        return default
+
+
 # Read the config from the environment
 config = dict(os.environ)
-config['reserve_addresses'] = os.environ.get("reserve_addresses", 'false').lower().strip() in ["true", "yes", "1", "t"]
-config['validate_addresses'] = os.environ.get("validate_addresses", 'false').lower().strip() in ["true", "yes", "1", "t"]
-try:
-    config['address_count'] = int(os.environ.get("address_count", "30"))
-except:
-    config['address_count'] = 30
+config['reserve_addresses'] = _getBool("reserve_addresses")
+config['validate_addresses'] = _getBool("validate_addresses")
+config['address_count'] = _getInt("address_count", 30)
+# Set manage_addresses to false if the addresses are already usable and must never be added or deleted
+config['manage_addresses'] = _getBool("manage_addresses", 'true')
+if 'address_list' in os.environ:
+    config['address_list'] = [ip.strip() for ip in os.environ['address_list'].split(",") if ip.strip()]
+# "alias" adds each outbound address to the device, "anyip" routes all of 'anyip_subnet' locally
+config['address_mode'] = os.environ.get("address_mode", "alias").lower().strip()
+# Connect to IPv6 hosts from random addresses of this prefix ("" for IPv4 only), and how many
+# addresses checked with NDP to keep ready (0 to use them unchecked)
+config['ipv6_prefix'] = os.environ.get("ipv6_prefix", "").strip()
+config['ipv6_ready'] = _getInt("ipv6_ready", 64)
+# Which server engine to run the proxy with ("threading" or "asyncio")
+config['engine'] = os.environ.get("engine", "threading").lower().strip()
+# How to relay session data ("auto", "splice" or "buffer") and the per direction buffer size
+config['relay_mode'] = os.environ.get("relay_mode", "auto").lower().strip()
+config['relay_buffer_size'] = _getInt("relay_buffer_size", 65536)
+# How interface addresses are managed ("auto", "netlink" or "ip")
+config['net_backend'] = os.environ.get("net_backend", "auto").lower().strip()
+# Seconds an unused address stays on the interface, and the most addresses configured at once
+config['address_linger'] = _getInt("address_linger", 30)
+config['address_max_live'] = _getInt("address_max_live", 0)
+# ARP discovery: requests per second, seconds to wait for replies, and retries for silent hosts
+config['arp_rate'] = _getInt("arp_rate", 1000)
+config['arp_window'] = _getFloat("arp_window", 0.5)
+config['arp_retries'] = _getInt("arp_retries", 1)
+# Seconds to cache resolved hostnames (and failed lookups), and how many names to keep
+config['dns_ttl'] = _getInt("dns_ttl", 300)
+config['dns_negative_ttl'] = _getInt("dns_negative_ttl", 30)
+config['dns_cache_size'] = _getInt("dns_cache_size", 4096)
+# How to connect to the remote host: "single" tries one outbound address, "race" starts up to
+# 'connect_attempts' connections (at least one) from different addresses 'connect_stagger' seconds
+# apart
+config['connect_strategy'] = os.environ.get("connect_strategy", "single").lower().strip()
+config['connect_attempts'] = max(_getInt("connect_attempts", 2), 1)
+config['connect_stagger'] = _getFloat("connect_stagger", 0.25)
+config['connect_timeout'] = _getFloat("connect_timeout", 10)
+# Serve Prometheus metrics on this port (0 to disable)
+config['metrics_port'] = _getInt("metrics_port", 0)
+config['metrics_host'] = os.environ.get("metrics_host", "127.0.0.1")
+# How many worker processes to accept connections with (1 runs in a single process)
+config['workers'] = _getInt("workers", 1)
+# Ark server: seconds between address refreshes (0 to disable), request timeout and page size
+config['address_refresh'] = _getInt("address_refresh", 300)
+config['ark_timeout'] = _getFloat("ark_timeout", 10)
+config['ark_page_size'] = _getInt("ark_page_size", 0)
+# Where to save ARP results ("" to disable), how many seconds they are trusted, and how many stale
+# addresses to probe at a time in the background
+config['address_cache'] = os.environ.get("address_cache",
+                                         "/var/lib/sangheili/address_cache.json").strip()
+config['address_cache_age'] = _getInt("address_cache_age", 3600)
+config['address_cache_batch'] = _getInt("address_cache_batch", 32)
+# Watch ARP traffic for other hosts taking our addresses
+config['arp_monitor'] = _getBool("arp_monitor", 'true')
+# How outbound addresses are chosen ("random", "round-robin", "least-active" or "sticky"), the most
+# sessions per address (0 for no limit) and how long "sticky" keeps a destination on one address
+config['address_policy'] = os.environ.get("address_policy", "random").lower().strip()
+config['address_session_cap'] = _getInt("address_session_cap", 0)
+config['address_sticky_ttl'] = _getInt("address_sticky_ttl", 300)
+# Seconds a UDP ASSOCIATE may go without datagrams before it is closed
+config['udp_idle_timeout'] = _getInt("udp_idle_timeout", 120)
+# Refuse connections past this many open sessions or unfinished handshakes (0 for no limit)
+config['max_sessions'] = _getInt("max_sessions", 10000)
+config['max_handshakes'] = _getInt("max_handshakes", 512)
+# Seconds a session may take to handshake, go without traffic, or stay open at all (0 for no
+# limit), and the most bytes it buffers per direction
+config['handshake_timeout'] = _getInt("handshake_timeout", 10)
+config['session_idle_timeout'] = _getInt("session_idle_timeout", 3600)
+config['session_max_lifetime'] = _getInt("session_max_lifetime", 0)
+config['session_buffer_limit'] = _getInt("session_buffer_limit", 262144)
+# Where to log one record per session ("-" for stdout, "" to disable), as "text" or "json", the
+# fraction of successful sessions to log, how many records may wait to be written, and the size to
+# rotate the file at (0 to never) keeping how many old files
+config['session_log'] = os.environ.get("session_log", "-").strip()
+config['session_log_format'] = os.environ.get("session_log_format", "text").lower().strip()
+config['session_log_sample'] = _getFloat("session_log_sample", 1.0)
+config['session_log_queue'] = _getInt("session_log_queue", 10000)
+config['session_log_max_bytes'] = _getInt("session_log_max_bytes", 104857600)
+config['session_log_backups'] = _getInt("session_log_backups", 5)
+# Trace the phases of every session from the start (SIGUSR1 toggles it), how many finished sessions
+# to keep, report sessions slower than this many seconds (0 to never), and where trace dumps and
+# profiles go. SIGUSR2 samples the stacks of every thread for 'profile_seconds'
+config['trace'] = _getBool("trace")
+config['trace_buffer'] = _getInt("trace_buffer", 1024)
+config['trace_slow'] = _getFloat("trace_slow", 1.0)
+config['trace_dir'] = os.environ.get("trace_dir", "/tmp").strip()
+config['profile_seconds'] = _getInt("profile_seconds", 30)
+config['profile_interval'] = _getFloat("profile_interval", 0.005)
 #with open("config.yml") as fil:
 #    config = yaml.load(fil)
@@ -0,0 +1,159 @@
+# Author: Micah Martin (knif3)
+# connector.py
+#
+# Race connections to the remote host from several outbound addresses and keep the fastest
+#
+
+import asyncio
+import errno
+import os
+import select
+import socket
+import time
+
+from .networking import PoolExhausted, new_ip, cleanup_ip, outboundSocket
+
+
+def raceConnect(remote, first_ip, attempts=2, stagger=0.25, timeout=10):
+    """Connect to the remote host from several outbound addresses, Happy Eyeballs style.
+
+    The first attempt uses first_ip. Every `stagger` seconds, or as soon as an attempt fails,
+    another attempt is started from a newly leased address. The first connection to complete
+    wins; the rest are closed and their leases released.
+
+    The caller hands over its lease on first_ip: if first_ip loses, it is released here.
+
+    Args:
+        remote (tuple): the (address, port) to connect to
+        first_ip (str): the outbound address already leased for the session
+        attempts (int, optional): the most connections to try, first_ip is always tried
+        stagger (float, optional): seconds to wait before starting the next attempt
+        timeout (float, optional): seconds to wait for any connection to complete
+    Returns:
+        tuple: the connected socket and the outbound address it is bound to
+    Raises:
+        OSError: the error of the last failed attempt, or socket.timeout
+    """
+    attempts = max(attempts, 1)
+    deadline = time.monotonic() + timeout
+    pending = {}  # socket => outbound address
+    started = 0
+    next_start = 0
+    error = None
+    try:
+        while True:
+            now = time.monotonic()
+            if started < attempts and (now >= next_start or not pending):
+                try:
+                    ip = first_ip if started == 0 else new_ip(family=_family(first_ip))
+                except PoolExhausted:
+                    # Every other address is busy, make do with the attempts we have
+                    attempts = started
+                    continue
+                started += 1
+                next_start = now + stagger
+                try:
+                    sock = _socketFrom(ip)
+                except OSError as E:
+                    error = E
+                    cleanup_ip(ip)
+                    continue
+                code = sock.connect_ex(remote)
+                if code in (0, errno.EINPROGRESS):
+                    pending[sock] = ip
+                else:
+                    error = OSError(code, os.strerror(code))
+                    sock.close()
+                    cleanup_ip(ip)
+                continue
+            if not pending:
+                raise error
+            if now >= deadline:
+                raise socket.timeout("Timed out connecting to {}".format(remote))
+            wait = deadline - now
+            if started < attempts:
+                wait = min(wait, next_start - now)
+            # poll() rather than select(), which fails for descriptors past 1024
+            poller = select.poll()
+            sockets = {}
+            for sock in pending:
+                poller.register(sock, select.POLLOUT)
+                sockets[sock.fileno()] = sock
+            for fd, _ in poller.poll(max(wait, 0) * 1000):
+                sock = sockets[fd]
+                ip = pending.pop(sock)
+                code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if code == 0:
+                    sock.setblocking(True)
+                    return sock, ip
+                error = OSError(code, os.strerror(code))
+                sock.close()
+                cleanup_ip(ip)
+    finally:
+        # Close the losers and give their addresses back
+        for sock, ip in pending.items():
+            sock.close()
+            cleanup_ip(ip)
+
+
+async def raceConnectAsync(remote, first_ip, attempts=2, stagger=0.25, timeout=10):
+    """The event loop version of raceConnect(). The socket returned is non-blocking"""
+    loop = asyncio.get_running_loop()
+    attempts = max(attempts, 1)
+    deadline = loop.time() + timeout
+    pending = {}  # task => (socket, outbound address)
+    started = 0
+    error = None
+    try:
+        while True:
+            if started < attempts:
+                if started == 0:
+                    ip = first_ip
+                else:
+                    try:
+                        ip = await loop.run_in_executor(None, new_ip, None,
+                                                        _family(first_ip))
+                    except PoolExhausted:
+                        # Every other address is busy, make do with the attempts we have
+                        attempts = started
+                        continue
+                started += 1
+                try:
+                    sock = _socketFrom(ip)
+                except OSError as E:
+                    error = E
+                    await loop.run_in_executor(None, cleanup_ip, ip)
+                    continue
+                pending[loop.create_task(loop.sock_connect(sock, remote))] = (sock, ip)
+            if not pending:
+                raise error
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise socket.timeout("Timed out connecting to {}".format(remote))
+            wait = min(stagger, remaining) if started < attempts else remaining
+            done, _ = await asyncio.wait(pending, timeout=wait,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                sock, ip = pending.pop(task)
+                if task.exception() is None:
+                    return sock, ip
+                error = task.exception()
+                sock.close()
+                await loop.run_in_executor(None, cleanup_ip, ip)
+    finally:
+        for task, (sock, ip) in pending.items():
+            task.cancel()
+            sock.close()
+            await loop.run_in_executor(None, cleanup_ip, ip)
+
+
+def _family(ip):
+    """Every attempt connects from an address of the same family as the first"""
+    return socket.AF_INET6 if ":" in ip else socket.AF_INET
+
+
+def _socketFrom(ip):
+    """Create a non-blocking socket bound to the outbound address"""
+    sock = outboundSocket(ip)
+    sock.setblocking(False)
+    return sock
@@ -0,0 +1,219 @@
+# Author: Micah Martin (knif3)
+# limits.py
+#
+# Keep what sessions can hold on to bounded: admission control and session timeouts
+#
+
+import heapq
+import itertools
+import threading
+import time
+
+from . import config, metrics
+
+# The SOCKS greeting reply that refuses every method, sent to connections we turn away
+REJECT = b'\x05\xff'
+# Seconds to wait for open sessions to clean up after they are ended on shutdown
+SHUTDOWN_TIMEOUT = 5
+
+
+class Admission(object):
+    """Count open sessions and unfinished handshakes, and turn new connections away past the
+    limits so a flood can't exhaust threads, descriptors or addresses.
+
+    Args:
+        max_sessions (int, optional): the most sessions open at once (0 for no limit)
+        max_handshakes (int, optional): the most sessions still in their handshake (0 for no limit)
+    """
+    def __init__(self, max_sessions=0, max_handshakes=0):
+        self.max_sessions = max_sessions
+        self.max_handshakes = max_handshakes
+        self.active = 0
+        self.handshaking = 0
+        self._lock = threading.Lock()
+
+    def admit(self):
+        """Returns:
+            bool: True if the connection may start a session, which must then be released
+        """
+        with self._lock:
+            if ((self.max_sessions and self.active >= self.max_sessions) or
+                    (self.max_handshakes and self.handshaking >= self.max_handshakes)):
+                metrics.sessions_rejected.inc()
+                return False
+            self.active += 1
+            self.handshaking += 1
+            return True
+
+    def handshakeDone(self):
+        with self._lock:
+            self.handshaking -= 1
+
+    def release(self, handshaking=False):
+        """A session admitted by admit() has ended
+
+        Args:
+            handshaking (bool, optional): it ended before handshakeDone() was called
+        """
+        with self._lock:
+            self.active -= 1
+            if handshaking:
+                self.handshaking -= 1
+
+
+class _Timer(object):
+    __slots__ = ("callback", "_heap")
+
+    def __init__(self, callback, heap):
+        self.callback = callback
+        self._heap = heap
+
+    def cancel(self):
+        self._heap._cancel(self)
+
+
+class TimerHeap(object):
+    """Run callbacks at their deadlines from one background thread.
+
+    Every session's timeouts share this heap instead of each socket keeping its own timer.
+    Cancelling a timer only marks it, and once the cancelled timers make up half of the heap it
+    is rebuilt without them, so sessions that end long before their timeouts don't pile up.
+    """
+    def __init__(self):
+        self._heap = []  # (when, sequence, timer)
+        self._cancelled = 0  # Cancelled timers still in the heap
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def schedule(self, when, callback):
+        """Call callback() at the time.monotonic() `when`
+
+        Returns:
+            object: a timer with a cancel() method
+        """
+        timer = _Timer(callback, self)
+        with self._cond:
+            heapq.heappush(self._heap, (when, next(self._sequence), timer))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="Timers", daemon=True)
+                self._thread.start()
+            elif self._heap[0][2] is timer:
+                self._cond.notify()
+        return timer
+
+    def _cancel(self, timer):
+        with self._cond:
+            if timer.callback is None:
+                return  # Already run or cancelled
+            timer.callback = None
+            self._cancelled += 1
+            if self._cancelled * 2 > len(self._heap):
+                self._heap = [entry for entry in self._heap if entry[2].callback]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    wait = self._heap[0][0] - time.monotonic() if self._heap else None
+                    if wait is not None and wait <= 0:
+                        break
+                    self._cond.wait(wait)
+                _, _, timer = heapq.heappop(self._heap)
+                callback, timer.callback = timer.callback, None
+                if callback is None:
+                    self._cancelled -= 1
+            if callback:
+                try:
+                    callback()
+                except Exception as E:
+                    print("WARN: Timer callback failed: {}".format(E))
+
+
+class SessionTimer(object):
+    """Expire a session that goes idle or has been open too long.
+
+    Activity is read from `progress` when the timer comes due, so relaying data never touches the
+    timer. A session expires between `idle` and twice `idle` seconds after its last byte.
+
+    Args:
+        expire (callable): called with the reason ("idle" or "lifetime") to tear the session down
+        progress (callable): returns a number that changes whenever the session relays data
+        idle (float, optional): seconds without progress before expiring (0 for no limit)
+        lifetime (float, optional): seconds the session may be open at all (0 for no limit)
+        schedule (callable, optional): schedule(when, callback) returning a cancellable timer,
+            the shared TimerHeap by default
+    """
+    def __init__(self, expire, progress, idle=0, lifetime=0, schedule=None):
+        self.expire = expire
+        self.progress = progress
+        self.idle = idle
+        self.lifetime = lifetime
+        self.expired = None  # Why the session expired, if it did
+        self._schedule = schedule or getTimers().schedule
+        self._started = self._active = time.monotonic()
+        self._seen = progress()
+        self._timer = None
+        self._arm()
+
+    def setIdle(self, idle):
+        """Change the idle timeout, counting from now"""
+        self.idle = idle
+        self._active = time.monotonic()
+        self._seen = self.progress()
+        self.cancel()
+        self._arm()
+
+    def cancel(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+    def _arm(self):
+        deadlines = []
+        if self.idle:
+            deadlines.append(self._active + self.idle)
+        if self.lifetime:
+            deadlines.append(self._started + self.lifetime)
+        if deadlines:
+            self._timer = self._schedule(min(deadlines), self._check)
+
+    def _check(self):
+        now = time.monotonic()
+        seen = self.progress()
+        if seen != self._seen:
+            self._seen = seen
+            self._active = now
+        if self.lifetime and now >= self._started + self.lifetime:
+            self.expired = "lifetime"
+        elif self.idle and now >= self._active + self.idle:
+            self.expired = "idle"
+        else:
+            self._arm()
+            return
+        self._timer = None
+        metrics.sessions_expired.inc()
+        self.expire(self.expired)
+
+
+_admission = None
+_timers = None
+
+
+def getAdmission():
+    """Get the admission control shared by every session, created from the config on first use"""
+    global _admission
+    if _admission is None:
+        _admission = Admission(max_sessions=config.config.get("max_sessions", 0),
+                               max_handshakes=config.config.get("max_handshakes", 0))
+    return _admission
+
+
+def getTimers():
+    """Get the timer heap shared by every session"""
+    global _timers
+    if _timers is None:
+        _timers = TimerHeap()
+    return _timers
@@ -0,0 +1,246 @@
+# Author: Micah Martin (knif3)
+# metrics.py
+#
+# Count what the proxy is doing and serve it in the Prometheus text format
+#
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import TCPServer, ThreadingMixIn
+
+# Default histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                   10, 30, 60, 300, 3600)
+# Default histogram buckets, in bytes
+SIZE_BUCKETS = (1024, 16384, 131072, 1048576, 16777216, 134217728, 1073741824)
+# Lock stripes per metric. Prime, so that thread idents (aligned addresses) use all of them
+STRIPES = 31
+
+
+class _Striped(object):
+    """A list of numbers split over a fixed number of lock stripes. Each thread updates the
+    stripe its ident maps to, so threads rarely wait on each other and nothing is kept per thread
+    """
+    def __init__(self, size):
+        self._size = size
+        self._locks = [threading.Lock() for _ in range(STRIPES)]
+        self._stripes = [[0] * size for _ in range(STRIPES)]
+
+    def _stripe(self):
+        """Returns:
+            tuple: the lock and values of the calling thread's stripe
+        """
+        index = threading.get_ident() % STRIPES
+        return self._locks[index], self._stripes[index]
+
+    def _snapshot(self):
+        totals = [0] * self._size
+        for lock, values in zip(self._locks, self._stripes):
+            with lock:
+                for index, value in enumerate(values):
+                    totals[index] += value
+        return totals
+
+
+class Counter(_Striped):
+    """A number that only goes up"""
+    kind = "counter"
+
+    def __init__(self, name, help, labels=None):
+        _Striped.__init__(self, 1)
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+
+    def inc(self, amount=1):
+        lock, values = self._stripe()
+        with lock:
+            values[0] += amount
+
+    def samples(self):
+        return [(self.name, self.labels, self._snapshot()[0])]
+
+
+class Gauge(Counter):
+    """A number that goes up and down, or is read from a function when collected"""
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=None, func=None):
+        Counter.__init__(self, name, help, labels)
+        self.func = func
+
+    def dec(self, amount=1):
+        lock, values = self._stripe()
+        with lock:
+            values[0] -= amount
+
+    def samples(self):
+        if self.func:
+            return [(self.name, self.labels, self.func())]
+        return Counter.samples(self)
+
+
+class Histogram(_Striped):
+    """Count observations into buckets"""
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=None, buckets=LATENCY_BUCKETS):
+        # One slot per bucket plus +Inf, then the sum
+        _Striped.__init__(self, len(buckets) + 2)
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.buckets = tuple(buckets)
+
+    def observe(self, value):
+        index = 0
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            index += 1
+        lock, values = self._stripe()
+        with lock:
+            values[index] += 1
+            values[-1] += value
+
+    def time(self, start):
+        """Observe the seconds since start (a time.monotonic() value)
+
+        Returns:
+            float: the current time.monotonic(), to start timing the next phase
+        """
+        now = time.monotonic()
+        self.observe(now - start)
+        return now
+
+    def samples(self):
+        values = self._snapshot()
+        samples = []
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), values):
+            total += count
+            labels = dict(self.labels, le=str(bound))
+            samples.append((self.name + "_bucket", labels, total))
+        samples.append((self.name + "_sum", self.labels, values[-1]))
+        samples.append((self.name + "_count", self.labels, total))
+        return samples
+
+
+class Registry(object):
+    """Keep every metric so they can be rendered together"""
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Returns:
+            str: every metric in the Prometheus text format
+        """
+        lines = []
+        seen = set()
+        with self._lock:
+            metrics = list(self._metrics)
+        for metric in metrics:
+            if metric.name not in seen:
+                seen.add(metric.name)
+                lines.append("# HELP {} {}".format(metric.name, metric.help))
+                lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                if labels:
+                    name += "{" + ",".join('{}="{}"'.format(k, v) for k, v in labels.items()) + "}"
+                lines.append("{} {}".format(name, value))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, **labels):
+    return REGISTRY.register(Counter(name, help, labels))
+
+
+def gauge(name, help, func=None, **labels):
+    return REGISTRY.register(Gauge(name, help, labels, func))
+
+
+def histogram(name, help, buckets=LATENCY_BUCKETS, **labels):
+    return REGISTRY.register(Histogram(name, help, labels, buckets))
+
+
+# The metrics the sessions update
+sessions = counter("sangheili_sessions_total", "Connections accepted")
+session_errors = counter("sangheili_session_errors_total", "Sessions that failed before relaying")
+active_sessions = gauge("sangheili_active_sessions", "Sessions currently open")
+bytes_in = counter("sangheili_bytes_total", "Bytes relayed", direction="in")
+bytes_out = counter("sangheili_bytes_total", "Bytes relayed", direction="out")
+session_bytes_in = histogram("sangheili_session_bytes", "Bytes relayed per session",
+                             SIZE_BUCKETS, direction="in")
+session_bytes_out = histogram("sangheili_session_bytes", "Bytes relayed per session",
+                              SIZE_BUCKETS, direction="out")
+address_conflicts = counter("sangheili_address_conflicts_total",
+                            "Addresses quarantined because another host claimed them")
+sessions_rejected = counter("sangheili_sessions_rejected_total",
+                            "Connections turned away by admission control")
+sessions_expired = counter("sangheili_sessions_expired_total",
+                           "Sessions ended by the handshake, idle or lifetime timeout")
+log_records_dropped = counter("sangheili_log_records_dropped_total",
+                              "Session log records dropped because the queue was full")
+_PHASES = ("accept", "handshake", "new_ip", "bind", "connect", "first_byte", "session")
+phases = dict((phase, histogram("sangheili_phase_seconds", "Seconds spent in each session phase",
+                                phase=phase)) for phase in _PHASES)
+
+
+def recordBytes(sent, received):
+    """Record the bytes relayed by a finished session
+
+    Args:
+        sent (int): bytes from the client to the remote host
+        received (int): bytes from the remote host to the client
+    """
+    bytes_out.inc(sent)
+    bytes_in.inc(received)
+    session_bytes_out.observe(sent)
+    session_bytes_in.observe(received)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        # HTTPServer looks up the FQDN of the host, which stalls startup without working DNS
+        TCPServer.server_bind(self)
+        self.server_name, self.server_port = self.server_address[:2]
+
+
+def startServer(host="127.0.0.1", port=9108):
+    """Serve /metrics from a background thread
+
+    Returns:
+        HTTPServer: the running server
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="MetricsServer", daemon=True)
+    thread.start()
+    return server
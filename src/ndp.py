@@ -0,0 +1,232 @@
+# Author: Micah Martin (knif3)
+# ndp.py
+#
+# IPv6 Neighbor Discovery (RFC 4861): check that addresses are free and answer for the ones we use
+#
+
+import ctypes
+import select
+import socket
+import struct
+import time
+from threading import Thread, Event
+
+ETH_P_IPV6 = 0x86dd
+NEIGHBOR_SOLICIT = 135
+NEIGHBOR_ADVERT = 136
+ADVERT_FLAGS = 0x60000000  # Solicited and Override
+UNSPECIFIED = b'\x00' * 16
+
+# Socket options that not every Python exposes (linux/if_packet.h, asm/socket.h)
+SOL_PACKET = 263
+PACKET_ADD_MEMBERSHIP = 1
+PACKET_MR_ALLMULTI = 2
+SO_ATTACH_FILTER = 26
+
+ETHERNET = struct.Struct("!6s6sH")  # dst, src, ethertype
+IPV6 = struct.Struct("!IHBB16s16s")  # version/class/flow, payload length, next header, hop limit, src, dst
+NEIGHBOR = struct.Struct("!BBHI16s")  # type, code, checksum, flags, target
+LINK_OPTION = struct.Struct("!BB6s")  # type (1 source, 2 target link-layer address), length, MAC
+PACKET_MREQ = struct.Struct("iHH8s")  # ifindex, type, address length, address
+
+# Classic BPF for the monitor: only ICMPv6 neighbor solicitations and advertisements without
+# extension headers reach userspace, not every IPv6 packet the proxy relays
+_FILTER = [
+    (0x30, 0, 0, ETHERNET.size + 6),    # ldb [next header]
+    (0x15, 0, 4, socket.IPPROTO_ICMPV6),  # jeq ICMPv6, or drop
+    (0x30, 0, 0, ETHERNET.size + IPV6.size),  # ldb [ICMPv6 type]
+    (0x15, 1, 0, NEIGHBOR_SOLICIT),     # jeq solicitation, accept
+    (0x15, 0, 1, NEIGHBOR_ADVERT),      # jeq advertisement, accept, or drop
+    (0x06, 0, 0, 0xffff),               # ret accept
+    (0x06, 0, 0, 0),                    # ret drop
+]
+
+
+def solicitedNode(packed):
+    """Returns:
+        bytes: the solicited-node multicast address for an address (ff02::1:ffXX:XXXX)
+    """
+    return b'\xff\x02' + b'\x00' * 9 + b'\x01\xff' + packed[13:]
+
+
+def _checksum(src, dst, payload):
+    """The ICMPv6 checksum, over the pseudo header and the message"""
+    data = src + dst + struct.pack("!I3xB", len(payload), socket.IPPROTO_ICMPV6) + payload
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack("!{}H".format(len(data) // 2), data))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+class NdpScanner(object):
+    """Probe many IPv6 addresses for other owners with neighbor solicitations, the NDP
+    counterpart of ArpScanner.
+
+    Solicitations are sent at a fixed rate from one raw ICMPv6 socket, which also collects the
+    advertisements. Every address that stayed quiet is asked again before it is declared free.
+
+    Args:
+        dev (str): the device to scan on
+        rate (int, optional): solicitations to send per second
+        window (float, optional): seconds to keep listening after the last solicitation of a pass
+        retries (int, optional): extra passes over the addresses that did not answer
+        mac_src (bytes, optional): our MAC on the device, sent as the source link-layer address
+    """
+    def __init__(self, dev, rate=1000, window=0.5, retries=1, mac_src=None):
+        self.dev = dev
+        self.rate = rate
+        self.window = window
+        self.retries = retries
+        self.mac_src = mac_src
+
+    def scan(self, candidates):
+        """Find out which of the candidates are not in use
+
+        Args:
+            candidates (iterable): the IPv6 addresses to probe
+        Returns:
+            set: the addresses nobody answered for
+        """
+        candidates = set(candidates)
+        taken = set()
+        index = socket.if_nametoindex(self.dev)
+        sock = socket.socket(socket.AF_INET6, socket.SOCK_RAW, socket.IPPROTO_ICMPV6)
+        try:
+            # Neighbor discovery messages must arrive with a hop limit of 255
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_HOPS, 255)
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_IF, index)
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_LOOP, 0)
+            sock.setblocking(False)
+            pending = candidates
+            for _ in range(1 + self.retries):
+                self._sendPass(sock, index, pending, taken)
+                pending = pending - taken
+                if not pending:
+                    break
+        finally:
+            sock.close()
+        return candidates - taken
+
+    def _sendPass(self, sock, index, targets, taken):
+        interval = 1.0 / self.rate if self.rate else 0
+        deadline = time.monotonic()
+        option = LINK_OPTION.pack(1, 1, self.mac_src) if self.mac_src else b''
+        for ip in targets:
+            if ip in taken:
+                continue
+            packed = socket.inet_pton(socket.AF_INET6, ip)
+            # The kernel fills in the checksum of raw ICMPv6 messages
+            message = NEIGHBOR.pack(NEIGHBOR_SOLICIT, 0, 0, 0, packed) + option
+            try:
+                sock.sendto(message, (socket.inet_ntop(socket.AF_INET6, solicitedNode(packed)),
+                                      0, 0, index))
+            except OSError:
+                pass
+            deadline += interval
+            self._collect(sock, taken, deadline)
+        self._collect(sock, taken, time.monotonic() + self.window)
+
+    def _collect(self, sock, taken, deadline):
+        """Record the target of every advertisement seen until the deadline"""
+        while True:
+            timeout = deadline - time.monotonic()
+            if timeout > 0:
+                select.select([sock], [], [], timeout)
+            while True:
+                try:
+                    message = sock.recv(2048)
+                except BlockingIOError:
+                    break
+                if len(message) >= NEIGHBOR.size and message[0] == NEIGHBOR_ADVERT:
+                    taken.add(socket.inet_ntop(socket.AF_INET6, message[8:24]))
+            if deadline - time.monotonic() <= 0:
+                return
+
+
+class NdpMonitor(object):
+    """Watch the neighbor discovery traffic on a device, the NDP counterpart of ArpMonitor.
+
+    Answers solicitations for the addresses we use but never configure (they are routed to us
+    locally), and reports other hosts that advertise one of them or probe for it before taking it
+    (duplicate address detection). One packet socket with a kernel filter sees only neighbor
+    discovery, and it asks for all multicast frames so solicitations for any of our addresses
+    arrive without joining a group per address.
+
+    Args:
+        dev (str): the device to watch
+        watched (callable): called with an IPv6 address, returns True if it is one of ours
+        conflict (callable): called with the address and the foreign MAC (as a string) when
+            another host claims one of our addresses, or None to not look for conflicts
+        mac_src (bytes, optional): our MAC on the device, looked up if not given
+    """
+    def __init__(self, dev, watched, conflict=None, mac_src=None):
+        self.dev = dev
+        self.watched = watched
+        self.conflict = conflict
+        self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_IPV6))
+        self.sock.bind((dev, ETH_P_IPV6))
+        self.sock.settimeout(1)
+        self.mac_src = mac_src or self.sock.getsockname()[4]
+        self._attachFilter()
+        self.sock.setsockopt(SOL_PACKET, PACKET_ADD_MEMBERSHIP, PACKET_MREQ.pack(
+                             socket.if_nametoindex(dev), PACKET_MR_ALLMULTI, 0, b''))
+        self._stop = Event()
+        self._thread = None
+
+    def _attachFilter(self):
+        program = b''.join(struct.pack("HBBI", *op) for op in _FILTER)
+        self._program = ctypes.create_string_buffer(program)  # Must outlive the socket option
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, struct.pack(
+                                 "HP", len(_FILTER), ctypes.addressof(self._program)))
+        except OSError as E:
+            print("WARN: Cannot filter the neighbor discovery traffic on {}: {}".format(self.dev, E))
+
+    def start(self):
+        self._thread = Thread(target=self._run, name="NdpMonitor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        buf = bytearray(2048)
+        header = ETHERNET.size + IPV6.size
+        while not self._stop.is_set():
+            try:
+                size = self.sock.recv_into(buf)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if size < header + NEIGHBOR.size:
+                continue
+            _, mac, _ = ETHERNET.unpack_from(buf)
+            _, _, next_header, hops, src, _ = IPV6.unpack_from(buf, ETHERNET.size)
+            kind, _, _, _, target = NEIGHBOR.unpack_from(buf, header)
+            if mac == self.mac_src or next_header != socket.IPPROTO_ICMPV6 or hops != 255:
+                continue
+            ip = socket.inet_ntop(socket.AF_INET6, target)
+            if not self.watched(ip):
+                continue
+            if kind == NEIGHBOR_ADVERT or src == UNSPECIFIED:
+                # Someone else has the address, or is about to take it
+                if self.conflict:
+                    self.conflict(ip, ":".join("{:02x}".format(byte) for byte in mac))
+            elif kind == NEIGHBOR_SOLICIT:
+                self._advertise(mac, src, target)
+        self.sock.close()
+
+    def _advertise(self, mac, dst, target):
+        """Tell the host that asked that the target address is at our MAC"""
+        message = NEIGHBOR.pack(NEIGHBOR_ADVERT, 0, 0, ADVERT_FLAGS, target) + \
+            LINK_OPTION.pack(2, 1, self.mac_src)
+        message = message[:2] + struct.pack("!H", _checksum(target, dst, message)) + message[4:]
+        frame = (ETHERNET.pack(mac, self.mac_src, ETH_P_IPV6) +
+                 IPV6.pack(6 << 28, len(message), socket.IPPROTO_ICMPV6, 255, target, dst) + message)
+        try:
+            self.sock.send(frame)
+        except OSError:
+            pass
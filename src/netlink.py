@@ -0,0 +1,280 @@
+# Author: Micah Martin (knif3)
+# netlink.py
+#
+# Add, delete and list interface addresses (and the AnyIP route) by talking rtnetlink directly
+# instead of running `ip`
+#
+
+import os
+import socket
+import struct
+import threading
+from ipaddress import ip_interface
+
+# Netlink message types and flags (linux/netlink.h, linux/rtnetlink.h)
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+NLM_F_REQUEST = 0x001
+NLM_F_MULTI = 0x002
+NLM_F_ACK = 0x004
+NLM_F_DUMP = 0x300
+NLM_F_REPLACE = 0x100
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+
+# Address attributes (linux/if_addr.h)
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_LABEL = 3
+IFA_BROADCAST = 4
+
+# Route attributes and values (linux/rtnetlink.h)
+RTA_DST = 1
+RTA_OIF = 4
+RT_TABLE_LOCAL = 255
+RTPROT_BOOT = 3
+RT_SCOPE_UNIVERSE = 0
+RT_SCOPE_LINK = 253
+RT_SCOPE_HOST = 254
+RTN_LOCAL = 2
+
+NLMSG_HDR = struct.Struct("=LHHLL")     # length, type, flags, sequence, pid
+IFADDRMSG = struct.Struct("=BBBBI")     # family, prefixlen, flags, scope, index
+RTMSG = struct.Struct("=BBBBBBBBI")     # family, dst_len, src_len, tos, table, protocol, scope, type, flags
+RTATTR_HDR = struct.Struct("=HH")       # length, type
+NLMSG_ERR = struct.Struct("=i")         # The errno at the front of an NLMSG_ERROR
+BATCH_BYTES = 8192  # Bytes of requests to send at once, the acks of each must fit the socket buffer
+
+
+class NetlinkError(Exception):
+    def __init__(self, errno):
+        Exception.__init__(self, "{} ({})".format(os.strerror(errno), errno))
+        self.errno = errno
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def _scope(ip):
+    """The scope `ip addr add` gives an address: the kernel refuses loopback addresses with any
+    but host scope"""
+    if ip.is_loopback:
+        return RT_SCOPE_HOST
+    if ip.version == 6 and ip.is_link_local:
+        return RT_SCOPE_LINK
+    return RT_SCOPE_UNIVERSE
+
+
+def _attr(kind, data):
+    """Pack a single rtattr, padded to the netlink alignment"""
+    length = RTATTR_HDR.size + len(data)
+    return RTATTR_HDR.pack(length, kind) + data + b'\0' * (_align(length) - length)
+
+
+class NetlinkBackend(object):
+    """Manage interface addresses through a single, persistent rtnetlink socket.
+
+    Every call is one sendto and a recv or two, so adding or removing an address takes
+    microseconds instead of a fork/exec of `ip`. addAddresses and delAddresses pack many requests
+    into each send, for reserving or releasing a whole pool at once.
+    """
+    def __init__(self):
+        self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        self._sock.bind((0, 0))
+        self._lock = threading.Lock()
+        self._seq = 0
+
+    def addAddress(self, ip, prefixlen, dev, label=None):
+        """Add an address to a device, like `ip addr add ip/prefixlen brd + dev dev label label`
+
+        Args:
+            ip (str): the address to add
+            prefixlen (int): the prefix length of the network
+            dev (str): the device to add the address to
+            label (str, optional): the full label, ie "eth0:ark1"
+        """
+        self._request(RTM_NEWADDR, NLM_F_CREATE | NLM_F_EXCL,
+                      self._newBody(ip, prefixlen, dev, label))
+
+    def addAddresses(self, addresses):
+        """Add many addresses with as few system calls as possible
+
+        Args:
+            addresses (list): (ip, prefixlen, dev, label) for every address
+        Returns:
+            dict: ip => NetlinkError for every address that could not be added
+        """
+        return self._batch([(RTM_NEWADDR, NLM_F_CREATE | NLM_F_EXCL,
+                             self._newBody(ip, prefixlen, dev, label), ip)
+                            for ip, prefixlen, dev, label in addresses])
+
+    def delAddress(self, ip, prefixlen, dev):
+        """Delete an address from a device
+
+        Args:
+            ip (str): the address to delete
+            prefixlen (int): the prefix length of the network
+            dev (str): the device the address is on
+        """
+        self._request(RTM_DELADDR, 0, self._delBody(ip, prefixlen, dev))
+
+    def delAddresses(self, addresses):
+        """Delete many addresses with as few system calls as possible
+
+        Args:
+            addresses (list): (ip, prefixlen, dev) for every address
+        Returns:
+            dict: ip => NetlinkError for every address that could not be deleted
+        """
+        return self._batch([(RTM_DELADDR, 0, self._delBody(ip, prefixlen, dev), ip)
+                            for ip, prefixlen, dev in addresses])
+
+    def _newBody(self, ip, prefixlen, dev, label=None):
+        iface = ip_interface("{}/{}".format(ip, prefixlen))
+        family = socket.AF_INET if iface.version == 4 else socket.AF_INET6
+        packed = iface.ip.packed
+        attrs = _attr(IFA_LOCAL, packed) + _attr(IFA_ADDRESS, packed)
+        if iface.version == 4:
+            attrs += _attr(IFA_BROADCAST, iface.network.broadcast_address.packed)
+            if label:
+                attrs += _attr(IFA_LABEL, label.encode() + b'\0')
+        return IFADDRMSG.pack(family, prefixlen, 0, _scope(iface.ip),
+                              socket.if_nametoindex(dev)) + attrs
+
+    def _delBody(self, ip, prefixlen, dev):
+        iface = ip_interface("{}/{}".format(ip, prefixlen))
+        family = socket.AF_INET if iface.version == 4 else socket.AF_INET6
+        body = IFADDRMSG.pack(family, prefixlen, 0, _scope(iface.ip), socket.if_nametoindex(dev))
+        return body + _attr(IFA_LOCAL, iface.ip.packed)
+
+    def addLocalRoute(self, network, dev):
+        """Treat every address in a network as our own, like `ip route replace local network dev dev`
+
+        Args:
+            network (IPv4Network): the addresses to route locally
+            dev (str): the device they are reached on
+        """
+        self._request(RTM_NEWROUTE, NLM_F_CREATE | NLM_F_REPLACE, self._routeBody(network, dev))
+
+    def delLocalRoute(self, network, dev):
+        """Remove a route added by addLocalRoute"""
+        self._request(RTM_DELROUTE, 0, self._routeBody(network, dev))
+
+    def _routeBody(self, network, dev):
+        family = socket.AF_INET if network.version == 4 else socket.AF_INET6
+        body = RTMSG.pack(family, network.prefixlen, 0, 0, RT_TABLE_LOCAL, RTPROT_BOOT,
+                          RT_SCOPE_HOST, RTN_LOCAL, 0)
+        return (body + _attr(RTA_DST, network.network_address.packed) +
+                _attr(RTA_OIF, struct.pack("=I", socket.if_nametoindex(dev))))
+
+    def getAddresses(self, dev=None):
+        """List the addresses on the host
+
+        Args:
+            dev (str, optional): only list the addresses of this device
+        Returns:
+            list: (ip, prefixlen, device, label) for every address
+        """
+        index = socket.if_nametoindex(dev) if dev else 0
+        body = IFADDRMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)
+        addresses = []
+        for kind, payload in self._request(RTM_GETADDR, NLM_F_DUMP, body):
+            if kind != RTM_NEWADDR:
+                continue
+            family, prefixlen, _, _, ifindex = IFADDRMSG.unpack_from(payload)
+            if index and ifindex != index:
+                continue
+            attrs = self._parseAttrs(payload[IFADDRMSG.size:])
+            raw = attrs.get(IFA_LOCAL, attrs.get(IFA_ADDRESS))
+            if raw is None:
+                continue
+            name = socket.if_indextoname(ifindex)
+            label = attrs.get(IFA_LABEL, b'').rstrip(b'\0').decode() or name
+            addresses.append((socket.inet_ntop(family, raw), prefixlen, name, label))
+        return addresses
+
+    def _parseAttrs(self, data):
+        attrs = {}
+        offset = 0
+        while offset + RTATTR_HDR.size <= len(data):
+            length, kind = RTATTR_HDR.unpack_from(data, offset)
+            if length < RTATTR_HDR.size:
+                break
+            attrs[kind] = data[offset + RTATTR_HDR.size:offset + length]
+            offset += _align(length)
+        return attrs
+
+    def _batch(self, requests):
+        """Send many requests, packed into as few sends as fit BATCH_BYTES, and wait for every
+        acknowledgement before sending the next batch so the replies never overflow the socket
+
+        Args:
+            requests (list): (type, flags, body, key) for every request
+        Returns:
+            dict: key => NetlinkError for every request that failed
+        """
+        errors = {}
+        with self._lock:
+            start = 0
+            while start < len(requests):
+                data = b''
+                pending = {}  # sequence => key
+                while start < len(requests) and len(data) < BATCH_BYTES:
+                    kind, flags, body, key = requests[start]
+                    start += 1
+                    self._seq += 1
+                    pending[self._seq] = key
+                    flags |= NLM_F_REQUEST | NLM_F_ACK
+                    data += NLMSG_HDR.pack(NLMSG_HDR.size + len(body), kind, flags, self._seq,
+                                           0) + body
+                self._sock.send(data)
+                while pending:
+                    data = self._sock.recv(65536)
+                    offset = 0
+                    while offset + NLMSG_HDR.size <= len(data):
+                        length, mtype, _, mseq, _ = NLMSG_HDR.unpack_from(data, offset)
+                        payload = data[offset + NLMSG_HDR.size:offset + length]
+                        offset += _align(length)
+                        if mtype != NLMSG_ERROR or mseq not in pending:
+                            continue
+                        key = pending.pop(mseq)
+                        errno = -NLMSG_ERR.unpack_from(payload)[0]
+                        if errno:
+                            errors[key] = NetlinkError(errno)
+        return errors
+
+    def _request(self, kind, flags, body):
+        """Send one request and collect the reply messages until it is acknowledged
+
+        Returns:
+            list: (type, payload) for every message in a dump reply
+        """
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+            flags |= NLM_F_REQUEST | NLM_F_ACK
+            self._sock.send(NLMSG_HDR.pack(NLMSG_HDR.size + len(body), kind, flags, seq, 0) + body)
+            messages = []
+            while True:
+                data = self._sock.recv(65536)
+                offset = 0
+                while offset + NLMSG_HDR.size <= len(data):
+                    length, mtype, mflags, mseq, _ = NLMSG_HDR.unpack_from(data, offset)
+                    payload = data[offset + NLMSG_HDR.size:offset + length]
+                    offset += _align(length)
+                    if mseq != seq:
+                        continue  # A stale reply to an earlier request
+                    if mtype == NLMSG_DONE:
+                        return messages
+                    if mtype == NLMSG_ERROR:
+                        errno = -NLMSG_ERR.unpack_from(payload)[0]
+                        if errno:
+                            raise NetlinkError(errno)
+                        return messages
+                    messages.append((mtype, payload))
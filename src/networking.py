@@ -4,111 +4,1394 @@
 # Get a random IP address to use for the outbound connection
 #
 
+import errno
 import random
+import re
 import socket
 import os
 import struct
+import threading
+import time
+from collections import OrderedDict, deque
 from subprocess import Popen, PIPE
-from ipaddress import IPv4Network
+from ipaddress import IPv4Network, IPv6Address, IPv6Network, ip_address
 
-from . import config
-from .arp import isIpTaken, _getIpFromDevice
+from . import config, metrics
+from .addrcache import AddressCache, Revalidator
+from .selection import getSelector
+from .tracing import traced
+from .arp import ArpMonitor, ArpScanner, isIpTaken, _getIpFromDevice
+from .ndp import NdpMonitor, NdpScanner
 
 LABEL = "ark"  # The label that new IPs are created with
+HALO = "Sangheili"  # The name of our halo on the Ark server
+_ark = None  # The ArkClient, if the addresses come from an Ark server
+MAX_LABELS = 4096  # How many labels we number our virtual interfaces with
+pool = None  # The AddressPool that hands out the outbound addresses
+pool6 = None  # The PrefixPool for connections to IPv6 hosts, if 'ipv6_prefix' is set
+_cache = None  # The AddressCache of ARP results, if 'address_cache' is set
+_revalidate = []  # Cached addresses to probe again in the background once we are serving
+_target = 0  # How many addresses the pool should have when revalidation drops some
+_discovered = False  # The addresses were found on the network, so replacements can be too
+_reserved = set()  # Addresses configured for the whole run, removed by net_close()
+ADD_ATTEMPTS = 3  # How many addresses a session tries to add before giving up
+SLOT_LIVE, SLOT_ADDING, SLOT_DELETING = 1, 2, 3  # The states of a SharedAddressPool slot
+CONFLICT_WARN_INTERVAL = 10  # Seconds between warnings about address conflicts, the rest are counted
+_conflictWarned = float("-inf")  # When we last warned about a conflict
+_conflictsUnreported = 0  # Conflicts since then that were not warned about
+_conflictLock = threading.Lock()
+_anyip = None  # The IPv4Network routed locally in the "anyip" address mode
+IP_FREEBIND = getattr(socket, "IP_FREEBIND", 15)  # Bind to an address the device doesn't have
+IPV6_FREEBIND = getattr(socket, "IPV6_FREEBIND", 78)
+FALLBACK_ERRNOS = (errno.EINVAL, errno.EOPNOTSUPP)  # Netlink errors the `ip` command may not hit
+
+
+class AddressFamilyUnsupported(Exception):
+    """There are no outbound addresses of the family the remote host needs"""
+
+
+class PoolExhausted(Exception):
+    """No address can be handed out: every one already has as many sessions as it is allowed,
+    none is left, or they could not be added to the device"""
+    pass
+
+
+class InterfaceCache(object):
+    """Remember the state of the device so that it is not looked up on every connection.
+
+    Filled once by net_init() and kept up to date as addresses are added and deleted. Labels for
+    new virtual interfaces come from a free list instead of listing the device each time.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.invalidate()
+
+    def invalidate(self):
+        """Forget everything, the next lookup reloads from the system"""
+        with self._lock:
+            self.dev = None
+            self.base_ip = None
+            self.netmask = None
+            self.mac = None
+            self._addresses = {}  # ip => (ip, prefixlen, device, label)
+            self._labels = deque()
+            self._loaded = False
+
+    def load(self, dev=None, base_ip=None):
+        """Read the addresses, labels and MAC of the device
+
+        Args:
+            dev (str, optional): the device to use, found from base_ip if not given
+            base_ip (str, optional): the main address of the device, found from dev if not given
+        """
+        addresses = _getBackend().getAddresses()
+        with self._lock:
+            self._addresses = dict((address[0], address) for address in addresses)
+            if not dev:
+                dev = self._addresses[base_ip][2]
+            if not base_ip:
+                base_ip = _getIpFromDevice(dev)
+            self.dev = dev
+            self.base_ip = base_ip
+            self.netmask = "/{}".format(self._addresses[base_ip][1])
+            self.mac = _getMacFromDevice(dev)
+            used = set(label for _, _, name, label in addresses if name == dev)
+            self._labels = deque(number for number in range(1, MAX_LABELS + 1)
+                                 if "{}:{}{}".format(dev, LABEL, number) not in used)
+            self._loaded = True
+
+    def lookup(self, ip):
+        """Find a configured address
+
+        Returns:
+            tuple: (ip, prefixlen, device, label), or None if the address is not configured
+        """
+        if not self._loaded:
+            return None
+        return self._addresses.get(ip)
+
+    def allocateLabel(self, dev):
+        """Returns:
+            str: an unused label for a new virtual interface on dev
+        """
+        with self._lock:
+            if dev == self.dev and self._labels:
+                return "{}:{}{}".format(dev, LABEL, self._labels.popleft())
+        # Not our device or we ran out, fall back to asking the system
+        labels = _getInterfaceLabels(dev)
+        label = "{}:{}{}".format(dev, LABEL, random.randint(1, MAX_LABELS))
+        while label.split(":", 1)[1] in labels:
+            label = "{}:{}{}".format(dev, LABEL, random.randint(1, MAX_LABELS))
+        return label
+
+    def takeLabels(self, dev, count):
+        """Take labels off the free list for good, for addresses kept track of elsewhere
+
+        Returns:
+            list: up to count label numbers, fewer if the free list runs out
+        """
+        with self._lock:
+            if dev != self.dev:
+                return []
+            return [self._labels.popleft() for _ in range(min(count, len(self._labels)))]
+
+    def addressAdded(self, ip, prefixlen, dev, label):
+        with self._lock:
+            if self._loaded:
+                self._addresses[ip] = (ip, prefixlen, dev, label)
+
+    def addressDeleted(self, ip):
+        with self._lock:
+            address = self._addresses.pop(ip, None)
+            if address and address[2] == self.dev:
+                self._releaseLabel(address[3])
+
+    def releaseLabel(self, label):
+        """Return a label that ended up not being used"""
+        with self._lock:
+            self._releaseLabel(label)
+
+    def ownsLabel(self, label):
+        """Returns:
+            bool: the label is one of ours, ie "eth0:ark12"
+        """
+        prefix = "{}:{}".format(self.dev, LABEL)
+        return label.startswith(prefix) and label[len(prefix):].isdigit()
+
+    def _releaseLabel(self, label):
+        if self.ownsLabel(label):
+            self._labels.append(int(label.split(":", 1)[1][len(LABEL):]))
+
+
+iface = InterfaceCache()  # The cached state of the network device
+
+
+class AddressPool(object):
+    """Lease outbound addresses to sessions and keep track of which are configured on the device.
+
+    Every address has a reference count so that concurrent sessions can share it. Once the last
+    lease is released the address lingers on the interface for `linger` seconds, so a burst of
+    short connections reuses it instead of deleting and adding it again. Idle addresses are
+    evicted oldest first once their linger time is up, and no more than `max_live` addresses are
+    configured at once; past that, new sessions share the addresses that are already up.
+    Addresses another host has claimed are quarantined and never handed out again. Addresses are
+    added and deleted without the lock held, so a slow device never holds up other sessions.
+
+    Which address a session gets is up to the selection policy (see selection.py), and no address
+    is given more than `session_cap` sessions at once.
+
+    Args:
+        addresses (list): the addresses we are allowed to use
+        dev (str): the device the addresses are added to
+        linger (float, optional): seconds to keep an idle address configured
+        max_live (int, optional): the most addresses to configure at once (0 for no limit)
+        reserved (bool, optional): the addresses are always configured, so never add or delete
+        policy (str, optional): how addresses are chosen, see selection.getSelector
+        session_cap (int, optional): the most sessions per address (0 for no limit)
+        sticky_ttl (float, optional): seconds a destination keeps its address with "sticky"
+    """
+    def __init__(self, addresses, dev, linger=30, max_live=0, reserved=False, policy="random",
+                 session_cap=0, sticky_ttl=300):
+        self.addresses = list(OrderedDict.fromkeys(addresses))
+        self.session_cap = session_cap
+        self._selector = getSelector(policy, self.addresses, session_cap, sticky_ttl)
+        self._positions = dict((ip, index) for index, ip in enumerate(self.addresses))
+        self._quarantined = set()
+        self.dev = dev
+        self.linger = linger
+        self.max_live = max_live
+        self.reserved = reserved
+        self._leases = {}  # Live address => number of sessions using it
+        self._idle = OrderedDict()  # Live addresses without leases => when they were released
+        self._inflight = {}  # Addresses being added or deleted => "add" or "delete"
+        self._adding = 0
+        self._doomed = []  # Retired while the lock was held, deleted by _flush()
+        self._lock = threading.Lock()
+        self._settled = threading.Condition(self._lock)  # Notified when an add or delete is done
+        self._reaper = None
+
+    def acquire(self, destination=None):
+        """Lease an address, configuring it on the device if needed
+
+        Args:
+            destination (str, optional): the host the session connects to
+        Returns:
+            str: the address to use
+        Raises:
+            PoolExhausted: every address is at the session cap, or none could be added
+        """
+        failed = []
+        try:
+            while True:
+                self._flush()
+                with self._lock:
+                    self._evictIdle()
+                    ip = self._choose(destination, failed)
+                    if ip in self._inflight:
+                        # Another session is adding or deleting it, choose again once it has
+                        if ip not in self._doomed:
+                            self._settled.wait()
+                        continue
+                    if ip in self._leases:
+                        return self._lease(ip)
+                    self._inflight[ip] = "add"
+                    self._adding += 1
+                # The device is only touched without the lock, so other sessions aren't held up
+                error = self._tryAdd(ip)
+                with self._lock:
+                    del self._inflight[ip]
+                    self._adding -= 1
+                    self._settled.notify_all()
+                    if error is None:
+                        self._leases[ip] = 0
+                        return self._lease(ip)
+                    # Keep it out of the running while we look for another
+                    self._selector.remove(ip)
+                failed.append(ip)
+                if len(failed) >= ADD_ATTEMPTS:
+                    raise PoolExhausted("Cannot add an address: {}".format(error))
+        finally:
+            if failed:
+                with self._lock:
+                    for failure in failed:
+                        if failure in self._positions:
+                            self._selector.add(failure)
+            self._flush()
+
+    def release(self, ip):
+        """Give back a lease. The address stays configured until it has been idle for a while
+        """
+        with self._lock:
+            self._selector.released(ip)
+            if ip not in self._leases:
+                return
+            self._leases[ip] = max(self._leases[ip] - 1, 0)
+            if self._leases[ip] == 0:
+                self._idle[ip] = time.monotonic()
+            self._evictIdle()
+        self._flush()
+
+    def __contains__(self, ip):
+        return ip in self._positions and ip not in self._quarantined
+
+    def live(self):
+        """Returns:
+            int: how many addresses are currently configured
+        """
+        return len(self._leases)
+
+    def active(self):
+        """Returns:
+            int: how many addresses have at least one lease
+        """
+        return len(self._leases) - len(self._idle)
+
+    def evict(self, ip):
+        """Remove an address from the pool entirely, deleting it if nobody is using it"""
+        with self._lock:
+            self._evict(ip)
+        self._flush()
+
+    def quarantine(self, ip):
+        """Stop handing out an address for good, because another host is using it"""
+        with self._lock:
+            self._quarantined.add(ip)
+            self._evict(ip)
+        self._flush()
+
+    def quarantined(self):
+        """Returns:
+            set: the addresses another host is using
+        """
+        with self._lock:
+            return set(self._quarantined)
+
+    def update(self, addresses):
+        """Start using a new list of addresses. Removed addresses are deleted once they are idle
+
+        Returns:
+            tuple: the sets of added and removed addresses
+        """
+        with self._lock:
+            addresses = [ip for ip in addresses if ip not in self._quarantined]
+            current = set(self.addresses)
+            added = set(addresses) - current
+            removed = current - set(addresses)
+            for ip in removed:
+                self._evict(ip)
+            for ip in OrderedDict.fromkeys(addresses):
+                if ip in added:
+                    self._positions[ip] = len(self.addresses)
+                    self.addresses.append(ip)
+                    self._selector.add(ip)
+        self._flush()
+        return added, removed
+
+    def _evict(self, ip):
+        self._selector.remove(ip)
+        index = self._positions.pop(ip, None)
+        if index is not None:
+            # Move the last address into the gap so removal doesn't shift the list
+            last = self.addresses.pop()
+            if index < len(self.addresses):
+                self.addresses[index] = last
+                self._positions[last] = index
+        if ip in self._idle:
+            del self._idle[ip]
+            del self._leases[ip]
+            self._retire(ip)
+
+    def sweep(self):
+        """Delete every address that has been idle for longer than the linger time"""
+        with self._lock:
+            self._evictIdle()
+        self._flush()
+
+    def close(self):
+        """Delete every address the pool added, all in one batch"""
+        with self._lock:
+            if not self.reserved:
+                _releaseAll(list(self._leases))
+            self._leases.clear()
+            self._idle.clear()
+
+    def startReaper(self, interval=None):
+        """Sweep idle addresses in the background so they don't linger forever without traffic"""
+        if self.reserved or self._reaper:
+            return
+        interval = interval or max(self.linger / 2.0, 0.5)
+
+        def reap():
+            while True:
+                time.sleep(interval)
+                self.sweep()
+        self._reaper = threading.Thread(target=reap, name="AddressPoolReaper", daemon=True)
+        self._reaper.start()
+
+    def _evictIdle(self):
+        # _idle is in release order so the oldest addresses are at the front
+        expires = time.monotonic() - self.linger
+        while self._idle:
+            ip, released = next(iter(self._idle.items()))
+            if released > expires and ip in self._positions:
+                break
+            del self._idle[ip]
+            del self._leases[ip]
+            self._retire(ip)
+
+    def _choose(self, destination, failed):
+        """Pick the address for acquire(). Called with the lock held
+
+        Returns:
+            str: the address, which may not be configured yet
+        Raises:
+            PoolExhausted: there is no address to choose
+        """
+        ip = self._selector.choose(destination)
+        if self.max_live and len(self._leases) + self._adding >= self.max_live and \
+                ip not in self._leases:
+            # No room for another address, share one that is already up
+            candidates = [live for live, count in self._leases.items()
+                          if live in self._positions and
+                          (not self.session_cap or count < self.session_cap)]
+            ip = random.choice(candidates) if candidates else None
+        if ip is None:
+            raise self._exhausted(failed)
+        return ip
+
+    def _lease(self, ip):
+        """Count a session on a live address. Called with the lock held"""
+        self._idle.pop(ip, None)
+        self._leases[ip] += 1
+        self._selector.acquired(ip)
+        return ip
+
+    def _retire(self, ip):
+        """Queue a live address to be deleted once the lock is released. Called with it held"""
+        self._inflight[ip] = "delete"
+        self._doomed.append(ip)
+
+    def _flush(self):
+        """Delete the addresses retired while the lock was held. Called without it"""
+        if not self._doomed:
+            return
+        with self._lock:
+            doomed, self._doomed = self._doomed, []
+        for ip in doomed:
+            self._delAddress(ip)
+        with self._lock:
+            for ip in doomed:
+                del self._inflight[ip]
+            self._settled.notify_all()
+
+    def _exhausted(self, failed=()):
+        """Returns:
+            PoolExhausted: saying why no address could be chosen
+        """
+        if failed:
+            return PoolExhausted("Cannot add {} addresses and there are no others".format(
+                                 len(failed)))
+        if not self.addresses:
+            return PoolExhausted("No addresses left to use ({} quarantined)".format(
+                                 len(self._quarantined)))
+        if self.session_cap:
+            return PoolExhausted("Every address has {} sessions".format(self.session_cap))
+        return PoolExhausted("The {} live addresses are all being removed".format(self.max_live))
+
+    def _tryAdd(self, ip):
+        """Add an address for acquire(). Called without the lock
+
+        Returns:
+            Exception: why the address could not be added, None if it was
+        """
+        try:
+            self._addAddress(ip)
+            return None
+        except Exception as E:
+            print("WARN: Cannot add address {}: {}".format(ip, E))
+            return E
+
+    def _addAddress(self, ip):
+        if self.reserved:
+            return
+        _addVirtualInterface(ip, self.dev)
+
+    def _delAddress(self, ip):
+        if self.reserved:
+            return
+        try:
+            _delVirtualInterface(ip, self.dev)
+        except Exception as E:
+            print("WARN: Cannot delete address {}: {}".format(ip, E))
+
+
+class SharedAddressPool(AddressPool):
+    """An AddressPool whose leases live in shared memory so that forked worker processes never
+    delete an address another worker is still using.
+
+    Leases are counted per worker, so when a worker dies the supervisor can drop exactly the
+    leases it held. Idle addresses are only evicted by sweep(), which the supervisor runs.
+    Addresses are chosen at random, honoring the session cap, whatever the policy.
+
+    The addresses are kept in a fixed number of shared slots, so an update() made in one process
+    is picked up by all the others. Every slot gets its own label before the workers are forked,
+    and the pool adds and deletes its addresses without the interface cache, which is not shared
+    and would go stale.
+
+    Args:
+        workers (int): how many worker processes will share the pool
+        capacity (int, optional): the most addresses the pool can hold, twice as many as it
+            starts with by default
+        See AddressPool for the rest
+    """
+    def __init__(self, addresses, dev, workers, linger=30, max_live=0, reserved=False,
+                 session_cap=0, capacity=None, **kwargs):
+        import multiprocessing
+        AddressPool.__init__(self, addresses, dev, linger, max_live, reserved,
+                             session_cap=session_cap)
+        self.workers = workers
+        self.worker = 0  # Set by each worker after it forks
+        size = self.size = max(capacity or len(self.addresses) * 2, len(self.addresses))
+        self._slots = multiprocessing.RawArray('I', size)  # The address in each slot, 0 if empty
+        self._labels = multiprocessing.RawArray('H', size)  # The label number of each slot
+        self._counts = multiprocessing.RawArray('i', size * workers)  # worker * size + slot
+        self._live = multiprocessing.RawArray('b', size)  # SLOT_LIVE, SLOT_ADDING, ...
+        self._adders = multiprocessing.RawArray('i', size)  # The worker adding a slot, plus one
+        self._banned = multiprocessing.RawArray('b', size)
+        self._released = multiprocessing.RawArray('d', size)  # When the last lease was released
+        self._nlive = multiprocessing.RawValue('i', 0)
+        self._changes = multiprocessing.RawValue('i', 0)  # Bumped whenever the slots change
+        self._seen = -1  # The changes this process has caught up with
+        self._lock = multiprocessing.Lock()
+        self._settled = multiprocessing.Condition(self._lock)
+        for index, ip in enumerate(self.addresses):
+            self._slots[index] = int(ip_address(ip))
+        for index, number in enumerate(iface.takeLabels(dev, size)):
+            self._labels[index] = number
+        self._sync()
+
+    def acquire(self, destination=None):
+        failed = []
+        while True:
+            self._flush()
+            with self._lock:
+                self._sync()
+                index = self._choose(destination, failed)
+                if self._live[index] == SLOT_LIVE:
+                    return self._leaseSlot(index)
+                if self._live[index]:
+                    # Another session is adding or deleting it, choose again once it has
+                    if index not in self._doomed:
+                        self._settled.wait()
+                    continue
+                self._live[index] = SLOT_ADDING
+                self._adders[index] = self.worker + 1
+                self._nlive.value += 1
+                ip = self._ips[index]
+            error = self._tryAdd(ip)
+            with self._lock:
+                self._settled.notify_all()
+                self._adders[index] = 0
+                if error is None:
+                    self._live[index] = SLOT_LIVE
+                    return self._leaseSlot(index)
+                self._live[index] = 0
+                self._nlive.value -= 1
+            failed.append(index)
+            if len(failed) >= ADD_ATTEMPTS:
+                raise PoolExhausted("Cannot add an address: {}".format(error))
+
+    def release(self, ip):
+        with self._lock:
+            self._sync()
+            index = self._index.get(ip)
+            if index is None:
+                return
+            slot = self.worker * self.size + index
+            if self._counts[slot] > 0:
+                self._counts[slot] -= 1
+                if not self._leased(index):
+                    self._released[index] = time.monotonic()
+
+    def releaseWorker(self, worker):
+        """Drop every lease held by a worker that has exited"""
+        now = time.monotonic()
+        with self._lock:
+            for index in range(self.size):
+                slot = worker * self.size + index
+                if self._counts[slot]:
+                    self._counts[slot] = 0
+                    if not self._leased(index):
+                        self._released[index] = now
+                if self._live[index] == SLOT_ADDING and self._adders[index] == worker + 1:
+                    # It died adding the address, which may be up: let sweep() delete it
+                    self._live[index] = SLOT_LIVE
+                    self._adders[index] = 0
+                    self._released[index] = now
+                    self._settled.notify_all()
+
+    def __contains__(self, ip):
+        with self._lock:
+            self._sync()
+            index = self._index.get(ip)
+            return index is not None and not self._banned[index]
+
+    def live(self):
+        return self._nlive.value
+
+    def active(self):
+        return sum(1 for index in range(self.size) if self._leased(index))
+
+    def _evict(self, ip):
+        self._sync()
+        index = self._index.get(ip)
+        if index is None or self._banned[index]:
+            return
+        self._banned[index] = 1
+        self._changes.value += 1
+        if self._live[index] == SLOT_LIVE and not self._leased(index):
+            self._removeLive(index)
+        self._sync()
+
+    def update(self, addresses):
+        """Start using a new list of addresses. New addresses take the empty slots, then those
+        of removed addresses that are no longer configured
+
+        Returns:
+            tuple: the sets of added and removed addresses
+        """
+        added, removed = set(), set()
+        with self._lock:
+            wanted = OrderedDict.fromkeys(ip for ip in addresses if ip not in self._quarantined)
+            self._sync()
+            for ip, index in self._index.items():
+                if ip in wanted and self._banned[index]:
+                    self._banned[index] = 0
+                    added.add(ip)
+                elif ip not in wanted and not self._banned[index]:
+                    self._banned[index] = 1
+                    removed.add(ip)
+                    if self._live[index] == SLOT_LIVE and not self._leased(index):
+                        self._removeLive(index)
+            new = [ip for ip in wanted if ip not in self._index]
+            free = [index for index in range(self.size) if not self._ips[index]]
+            free += [index for index in range(self.size) if self._ips[index] and
+                     self._banned[index] and not self._live[index] and
+                     self._ips[index] not in wanted]
+            for ip, index in zip(new, free):
+                self._slots[index] = int(ip_address(ip))
+                self._banned[index] = 0
+                self._released[index] = 0
+                added.add(ip)
+            if added or removed:
+                self._changes.value += 1
+            self._sync()
+        self._flush()
+        if len(new) > len(free):
+            print("WARN: No room for {} new addresses, restart to use them".format(
+                  len(new) - len(free)))
+        return added, removed
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            live = [index for index in range(self.size) if self._live[index]]
+            if not self.reserved and live:
+                prefixlen = int(config.config['net_netmask'].lstrip("/"))
+                errors = _getBackend().delAddresses([(self._ips[index], prefixlen, self.dev)
+                                                     for index in live])
+                for ip, error in errors.items():
+                    print("WARN: Cannot delete address {}: {}".format(ip, error))
+            for index in live:
+                self._live[index] = 0
+                self._released[index] = 0
+            self._nlive.value = 0
+
+    def _sync(self):
+        """Catch up with the slots other processes changed. Called with the lock held"""
+        if self._seen == self._changes.value:
+            return
+        self._seen = self._changes.value
+        self._ips = [str(ip_address(value)) if value else None for value in self._slots]
+        self._index = dict((ip, index) for index, ip in enumerate(self._ips) if ip)
+        self.addresses = [ip for index, ip in enumerate(self._ips)
+                          if ip and not self._banned[index]]
+
+    def _evictIdle(self):
+        self._sync()
+        expires = time.monotonic() - self.linger
+        for index in range(self.size):
+            if self._live[index] != SLOT_LIVE or not self._released[index]:
+                continue
+            if self._released[index] <= expires or self._banned[index]:
+                self._removeLive(index)
+
+    def _choose(self, destination, failed):
+        if self.max_live and self._nlive.value >= self.max_live:
+            # No room for another address, share one that is already up
+            candidates = [index for index in range(self.size)
+                          if self._live[index] and not self._banned[index]]
+        else:
+            candidates = [index for index in range(self.size)
+                          if self._ips[index] and not self._banned[index]]
+        if self.session_cap:
+            candidates = [index for index in candidates
+                          if self._sessions(index) < self.session_cap]
+        candidates = [index for index in candidates if index not in failed]
+        if not candidates:
+            raise self._exhausted(failed)
+        return random.choice(candidates)
+
+    def _leaseSlot(self, index):
+        """Count a session of this worker on a live slot. Called with the lock held"""
+        self._counts[self.worker * self.size + index] += 1
+        self._released[index] = 0
+        return self._ips[index]
+
+    def _leased(self, index):
+        return any(self._counts[worker * self.size + index] for worker in range(self.workers))
+
+    def _sessions(self, index):
+        return sum(self._counts[worker * self.size + index] for worker in range(self.workers))
+
+    def _removeLive(self, index):
+        """Queue a live slot to be deleted once the lock is released. Called with it held"""
+        self._live[index] = SLOT_DELETING
+        self._released[index] = 0
+        self._nlive.value -= 1
+        self._doomed.append(index)
+
+    def _flush(self):
+        if not self._doomed:
+            return
+        with self._lock:
+            doomed, self._doomed = self._doomed, []
+            # A slot isn't reused while it is being deleted, so its address stays put
+            ips = [self._ips[index] for index in doomed]
+        for ip in ips:
+            self._delAddress(ip)
+        with self._lock:
+            for index in doomed:
+                self._live[index] = 0
+            self._settled.notify_all()
+
+    def _addAddress(self, ip):
+        if self.reserved:
+            return
+        number = self._labels[self._index[ip]]
+        # Past the free labels, slots use the device's own
+        label = "{}:{}{}".format(self.dev, LABEL, number) if number else self.dev
+        _addVirtualInterface(ip, self.dev, label)
+
+    def _delAddress(self, ip):
+        if self.reserved:
+            return
+        try:
+            _delVirtualInterface(ip, self.dev, int(config.config['net_netmask'].lstrip("/")))
+        except Exception as E:
+            print("WARN: Cannot delete address {}: {}".format(ip, E))
+
+
+class PrefixPool(object):
+    """Lease random addresses from an IPv6 prefix, generated when they are needed.
+
+    A /64 has far too many addresses to list, so nothing is enumerated: every session gets a fresh
+    random address, and only the leased and quarantined ones are remembered. The prefix is routed
+    to us locally, so no address is ever added to the device. With a scanner, addresses are checked
+    with NDP before they are handed out; a background thread keeps up to `ready` checked addresses
+    on hand so sessions don't wait for the probes.
+
+    Anyone on the link can claim addresses of the prefix, so the quarantine is bounded: addresses
+    are let go after `quarantine_ttl` seconds, or oldest first past `quarantine_size`. A random
+    address is all but never generated twice anyway.
+
+    Args:
+        prefix (str): the prefix to generate addresses in, ie "2001:db8:1:2::/64"
+        scanner (NdpScanner, optional): used to make sure no other host has an address
+        ready (int, optional): how many checked addresses to keep on hand
+        quarantine_size (int, optional): the most quarantined addresses to remember
+        quarantine_ttl (float, optional): seconds to keep an address quarantined
+    """
+    def __init__(self, prefix, scanner=None, ready=64, quarantine_size=4096, quarantine_ttl=3600):
+        self.network = IPv6Network(prefix, strict=False)
+        self.scanner = scanner
+        self.ready = ready
+        self.quarantine_size = quarantine_size
+        self.quarantine_ttl = quarantine_ttl
+        self._bits = self.network.max_prefixlen - self.network.prefixlen
+        self._base = int(self.network.network_address)
+        self._leases = {}  # Address => number of sessions using it
+        self._quarantined = OrderedDict()  # Address => when it expires, oldest first
+        self._ready = deque()
+        self._lock = threading.Lock()
+        self._refiller = None
+
+    def acquire(self, destination=None):
+        """Lease a random address
+
+        Returns:
+            str: the address to use
+        Raises:
+            PoolExhausted: no free address was found
+        """
+        with self._lock:
+            ip = None
+            while self._ready and ip is None:
+                ip = self._ready.popleft()
+                if self._isQuarantined(ip):
+                    ip = None
+            if self.scanner and len(self._ready) < self.ready // 2 and not self._refiller:
+                self._refiller = threading.Thread(target=self._refill, name="PrefixRefill",
+                                                  daemon=True)
+                self._refiller.start()
+            if ip is None and not self.scanner:
+                ip = self._generate()
+        if ip is None:
+            # Nothing checked on hand, probe a few now
+            free = self.scanner.scan(self._candidates(4))
+            if not free:
+                raise PoolExhausted("No free address found in {}".format(self.network))
+            ip = free.pop()
+            with self._lock:
+                self._ready.extend(free)
+        with self._lock:
+            self._leases[ip] = self._leases.get(ip, 0) + 1
+        return ip
+
+    def release(self, ip):
+        with self._lock:
+            count = self._leases.get(ip, 0) - 1
+            if count > 0:
+                self._leases[ip] = count
+            else:
+                self._leases.pop(ip, None)
+
+    def __contains__(self, ip):
+        """Every address of the prefix is ours, apart from those another host has claimed"""
+        try:
+            return IPv6Address(ip) in self.network and not self._isQuarantined(ip)
+        except ValueError:
+            return False
+
+    def live(self):
+        return len(self._leases)
+
+    def active(self):
+        return len(self._leases)
+
+    def quarantine(self, ip):
+        """Stop handing out an address for a while, because another host is using it"""
+        with self._lock:
+            self._quarantine(ip)
+
+    def close(self):
+        pass
+
+    def _quarantine(self, ip):
+        """Called with the lock held"""
+        now = time.monotonic()
+        self._quarantined.pop(ip, None)
+        self._quarantined[ip] = now + self.quarantine_ttl
+        while self._quarantined:
+            oldest, expires = next(iter(self._quarantined.items()))
+            if expires > now and len(self._quarantined) <= self.quarantine_size:
+                break
+            del self._quarantined[oldest]
+
+    def _isQuarantined(self, ip):
+        expires = self._quarantined.get(ip)
+        return expires is not None and expires > time.monotonic()
+
+    def _generate(self):
+        while True:
+            host = random.getrandbits(self._bits)
+            ip = str(IPv6Address(self._base | host))
+            # Skip the subnet-router anycast address and anything in use
+            if (host and ip not in self._leases and not self._isQuarantined(ip) and
+                    not iface.lookup(ip)):
+                return ip
+
+    def _candidates(self, count):
+        with self._lock:
+            return set(self._generate() for _ in range(count))
+
+    def _refill(self):
+        try:
+            while True:
+                with self._lock:
+                    missing = self.ready - len(self._ready)
+                if missing <= 0:
+                    return
+                candidates = self._candidates(missing)
+                free = self.scanner.scan(candidates)
+                with self._lock:
+                    for ip in candidates - free:
+                        self._quarantine(ip)
+                    self._ready.extend(free)
+        except OSError as E:
+            print("WARN: Cannot check IPv6 addresses: {}".format(E))
+        finally:
+            self._refiller = None
+
 
 ## Functions that are to be called by other (sub)modules
 def net_init():
-    """Set up the networking stuff
+    """Set up the networking stuff. No threads are started, see net_start()
     """
     if 'net_device' in config.config:
-        config.config['net_base_ip'] = _getIpFromDevice(config.config['net_device'])
+        iface.load(dev=config.config['net_device'], base_ip=config.config.get('net_base_ip'))
     else:
-        config.config['net_base_ip'] = _getIp()
-        config.config['net_device'] = _getInterfaceNameFromIp(config.config['net_base_ip'])
-    config.config['net_netmask'] = _getSubnetMaskFromIp(config.config['net_base_ip'])  # Subnet mask
+        iface.load(base_ip=_getIp())
+    config.config['net_device'] = iface.dev
+    config.config['net_base_ip'] = iface.base_ip
+    config.config['net_netmask'] = iface.netmask  # Subnet mask
 
     _loadHosts()
 
+    global pool
+    settings = dict(linger=config.config.get('address_linger', 30),
+                    max_live=config.config.get('address_max_live', 0),
+                    reserved=(config.config.get('reserve_addresses', False) or
+                              not config.config.get('manage_addresses', True) or
+                              _anyip is not None),
+                    policy=config.config.get('address_policy', 'random'),
+                    session_cap=config.config.get('address_session_cap', 0),
+                    sticky_ttl=config.config.get('address_sticky_ttl', 300))
+    if config.config.get('workers', 1) > 1:
+        # Worker processes are forked after this, so keep the leases in shared memory
+        pool = SharedAddressPool(config.config['net_addresses'], config.config['net_device'],
+                                 config.config['workers'], **settings)
+    else:
+        pool = AddressPool(config.config['net_addresses'], config.config['net_device'],
+                           **settings)
+    if config.config.get('ipv6_prefix'):
+        _initPrefix()
+    metrics.gauge("sangheili_live_addresses", "Addresses configured on the device",
+                  func=lambda: pool.live())
+    metrics.gauge("sangheili_pool_utilization", "Fraction of the pool with active sessions",
+                  func=lambda: pool.active() / float(len(pool.addresses) or 1))
+
 
-def new_ip():
-    """Get a new, random IP address to use for outbound connections
+def net_start():
+    """Start the background threads that watch the network and keep the addresses up to date.
+    With several workers this is called in a process of its own, so that the supervisor never
+    forks with threads running
     """
-    new_ip = random.choice(config.config.get('net_addresses'))
-    if not config.config.get("reserve_addresses", False):
-        _addVirtualInterface(new_ip, config.config.get('net_device'))
-    return new_ip
+    if not isinstance(pool, SharedAddressPool):
+        # The supervisor sweeps a shared pool itself
+        pool.startReaper()
+    conflict = _addressConflict if config.config.get('arp_monitor', True) else None
+    if config.config.get('arp_monitor', True) or _anyip:
+        # The routed addresses are not on the device, so we answer ARP for them ourselves
+        try:
+            ArpMonitor(config.config['net_device'], pool.__contains__, conflict,
+                       mac_src=iface.mac, answer=pool.__contains__ if _anyip else None).start()
+        except OSError as E:
+            print("WARN: Cannot watch the ARP traffic: {}".format(E))
+    if pool6:
+        # Neighbours find the random addresses through us, nothing else would answer for them
+        try:
+            NdpMonitor(config.config['net_device'], pool6.__contains__, conflict,
+                       mac_src=iface.mac).start()
+        except OSError as E:
+            print("WARN: Cannot watch the neighbor discovery traffic: {}".format(E))
+    if _revalidate:
+        Revalidator(_cache, _getScanner(), _revalidate, _applyValidation,
+                    batch=config.config.get('address_cache_batch', 32)).start()
+    if _ark and config.config.get('address_refresh', 300):
+        from .arkclient import ArkRefresher
+        ArkRefresher(_ark, HALO, _updateAddresses, interval=config.config.get('address_refresh', 300),
+                     page_size=config.config.get('ark_page_size', 0)).start()
+
+
+def net_close():
+    """Remove every address we configured. Called once on shutdown"""
+    if pool:
+        pool.close()
+    if _reserved:
+        _releaseAll(list(_reserved))
+    if not config.config.get('manage_addresses', True):
+        return
+    for network in (_anyip, pool6 and pool6.network):
+        if not network:
+            continue
+        try:
+            _getBackend().delLocalRoute(network, config.config['net_device'])
+        except Exception as E:
+            print("WARN: Cannot remove the route for {}: {}".format(network, E))
+
 
+def _updateAddresses(addresses):
+    """Apply a new address list from the Ark server to the pool
+
+    Returns:
+        tuple: the sets of added and revoked addresses
+    """
+    added, removed = pool.update(addresses)
+    if config.config.get('reserve_addresses', False) and config.config.get('manage_addresses', True):
+        # The pool never touches reserved addresses, so configure them here
+        _reserveAll(added, config.config['net_device'])
+        _releaseAll(removed)
+    config.config['net_addresses'] = list(pool.addresses)
+    return added, removed
+
+
+def _applyValidation(free, taken):
+    """Drop addresses that turned out to be in use and top the pool back up from the free ones
+    """
+    current = list(pool.addresses)
+    addresses = [ip for ip in current if ip not in taken]
+    missing = _target - len(addresses)
+    addresses += [ip for ip in free if ip not in current][:max(missing, 0)]
+    if set(addresses) != set(current) and addresses:
+        added, removed = _updateAddresses(addresses)
+        if removed:
+            print("WARN: Addresses in use by other hosts:", sorted(removed))
+
+
+def _addressConflict(ip, mac):
+    """Another host claimed one of our addresses, stop using it and find a replacement"""
+    global _conflictWarned, _conflictsUnreported
+    metrics.address_conflicts.inc()
+    with _conflictLock:
+        now = time.monotonic()
+        warn = now - _conflictWarned >= CONFLICT_WARN_INTERVAL
+        if warn:
+            unreported, _conflictWarned, _conflictsUnreported = _conflictsUnreported, now, 0
+        else:
+            _conflictsUnreported += 1
+    if warn:
+        print("WARN: {} is in use by {}, quarantining it{}".format(ip, mac,
+              " ({} more conflicts since the last warning)".format(unreported) if unreported
+              else ""))
+    if ":" in ip:
+        # A prefix has plenty of other addresses, nothing to replace
+        pool6.quarantine(ip)
+        return
+    pool.quarantine(ip)
+    threading.Thread(target=_backfill, args=(ip,), name="Backfill", daemon=True).start()
 
+
+def _backfill(ip):
+    if config.config.get('reserve_addresses', False) and config.config.get('manage_addresses', True):
+        _releaseAll([ip])
+    if _cache:
+        _cache.record(taken=[ip])
+        _cache.save()
+    config.config['net_addresses'] = list(pool.addresses)
+    missing = _target - len(pool.addresses)
+    if not _discovered or missing <= 0:
+        return
+    # Try what the cache says is free first, then anything else on the subnet
+    known = set(pool.addresses) | pool.quarantined() | {iface.base_ip}
+    hosts = []
+    if _cache:
+        hosts = [host for host in _cache.fresh() if host not in known]
+        known |= _cache.recentlyTaken()
+    others = [host.exploded for host in IPv4Network(iface.base_ip + iface.netmask, strict=False).hosts()]
+    random.shuffle(others)
+    hosts += [host for host in others if host not in known and host not in hosts]
+    candidates = set(hosts[:max(missing * 4, 16)])
+    try:
+        free = _getScanner().scan(candidates)
+    except OSError as E:
+        print("WARN: Cannot find a replacement for {}: {}".format(ip, E))
+        return
+    if _cache:
+        _cache.record(free, candidates - free)
+        _cache.save()
+    _applyValidation(free, set())
+
+
+def new_ip(destination=None, family=socket.AF_INET):
+    """Get a new IP address to use for outbound connections, chosen by the 'address_policy'.
+    IPv6 addresses are random ones from the 'ipv6_prefix'
+
+    Args:
+        destination (str, optional): the host the connection is for, used by the "sticky" policy
+        family (int, optional): socket.AF_INET or socket.AF_INET6, the family of the remote host
+    Raises:
+        AddressFamilyUnsupported: there are no IPv6 addresses to use
+    """
+    if family == socket.AF_INET6:
+        if pool6 is None:
+            raise AddressFamilyUnsupported("Set 'ipv6_prefix' to connect to IPv6 hosts")
+        return pool6.acquire(destination)
+    return pool.acquire(destination)
+
+
+@traced("cleanup_ip")
 def cleanup_ip(ip):
     """Signal that we are done with an IP address
     """
-    # If we are not just saving all the addresses, then delete it
-    if not config.config.get("reserve_addresses", False):
-        _delVirtualInterface(ip)
+    # The pool deletes the address once nobody has used it for a while
+    (pool6 if ":" in ip else pool).release(ip)
+
+
+def outboundSocket(ip, kind=socket.SOCK_STREAM):
+    """Create a socket bound to an outbound address from new_ip(). In the "anyip" address mode
+    the address is not on any device, so the socket is marked IP_FREEBIND
+
+    Args:
+        ip (str): the outbound address
+        kind (int, optional): socket.SOCK_STREAM or socket.SOCK_DGRAM
+    Raises:
+        OSError: the address can't be bound, the connection must not leave from another one
+    """
+    if ":" in ip:
+        # Addresses from the IPv6 prefix are never on the device either
+        sock = socket.socket(socket.AF_INET6, kind)
+        try:
+            sock.setsockopt(socket.IPPROTO_IPV6, IPV6_FREEBIND, 1)
+            sock.bind((ip, 0))
+        except OSError:
+            sock.close()
+            raise
+        return sock
+    sock = socket.socket(socket.AF_INET, kind)
+    try:
+        if _anyip:
+            sock.setsockopt(socket.SOL_IP, IP_FREEBIND, 1)
+        sock.bind((ip, 0))
+    except OSError:
+        sock.close()
+        raise
+    return sock
 
 
 ## Functions that are used internally not to be called by other modules
-def _addVirtualInterface(ip, dev):
+class IpCommandBackend(object):
+    """Manage interface addresses by running the `ip` command. Used when netlink is unavailable
+    """
+    def addAddress(self, ip, prefixlen, dev, label=None):
+        command = "ip addr add {}/{} brd + dev {}".format(ip, prefixlen, dev)
+        if label:
+            command += " label {}".format(label)
+        res = execute(command)
+        if res.get('status', 255) != 0:
+            raise Exception("Cannot add interface: {}\n{}".format(
+                            res.get('stderr', ''), command))
+
+    def delAddress(self, ip, prefixlen, dev):
+        res = execute("ip addr del {}/{} dev {}".format(ip, prefixlen, dev))
+        if res.get('status', 255) != 0:
+            raise Exception("Cannot delete interface: {}".format(
+                            res.get('stderr', '')))
+
+    def addAddresses(self, addresses):
+        """Add many addresses with a single `ip -batch`
+
+        Returns:
+            dict: ip => Exception for every address that could not be added
+        """
+        return self._batch(["addr add {}/{} brd + dev {}{}".format(
+                            ip, prefixlen, dev, " label {}".format(label) if label else "")
+                            for ip, prefixlen, dev, label in addresses],
+                           [address[0] for address in addresses])
+
+    def delAddresses(self, addresses):
+        """Delete many addresses with a single `ip -batch`
+
+        Returns:
+            dict: ip => Exception for every address that could not be deleted
+        """
+        return self._batch(["addr del {}/{} dev {}".format(ip, prefixlen, dev)
+                            for ip, prefixlen, dev in addresses],
+                           [address[0] for address in addresses])
+
+    def _batch(self, commands, keys):
+        """Run `ip` commands from one process, carrying on past failures"""
+        try:
+            proc = Popen(["ip", "-force", "-batch", "-"], stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                         close_fds=True)
+            _, stderr = proc.communicate(("\n".join(commands) + "\n").encode())
+        except OSError as E:
+            return dict((key, E) for key in keys)
+        # Each failure is reported as its error message followed by "Command failed -:<line>"
+        errors = {}
+        message = []
+        for line in stderr.decode("utf-8", "replace").splitlines():
+            match = re.match(r"Command failed -:(\d+)", line)
+            if not match:
+                message.append(line.strip())
+                continue
+            index = int(match.group(1)) - 1
+            if 0 <= index < len(keys):
+                errors[keys[index]] = Exception(" ".join(message) or line)
+            message = []
+        return errors
+
+    def addLocalRoute(self, network, dev):
+        res = execute("ip route replace local {} dev {}".format(network, dev))
+        if res.get('status', 255) != 0:
+            raise Exception("Cannot route {} locally: {}".format(network, res.get('stderr', '')))
+
+    def delLocalRoute(self, network, dev):
+        res = execute("ip route del local {} dev {}".format(network, dev))
+        if res.get('status', 255) != 0:
+            raise Exception("Cannot delete the route for {}: {}".format(
+                            network, res.get('stderr', '')))
+
+    def getAddresses(self, dev=None):
+        command = "ip -o addr show"
+        if dev:
+            command += " dev {}".format(dev)
+        res = execute(command)
+        if res.get('status', 255) != 0:
+            raise Exception("Cannot list addresses: {}".format(res.get('stderr', '')))
+        addresses = []
+        for line in res['stdout'].splitlines():
+            words = line.split("\\")[0].split()
+            if len(words) < 4 or words[2] not in ("inet", "inet6"):
+                continue
+            name = words[1].split("@")[0]
+            ip, prefixlen = words[3].split("/")
+            # The label is the last word if it is an alias of the device
+            label = words[-1] if words[-1].startswith(name + ":") else name
+            addresses.append((ip, int(prefixlen), name, label))
+        return addresses
+
+
+_backend = None
+
+
+def _resetBackend():
+    """A forked worker must not share the parent's netlink socket, it would read its replies"""
+    global _backend
+    _backend = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_resetBackend)
+
+
+class AutoBackend(object):
+    """The "auto" 'net_backend': netlink, until it rejects a request that the `ip` command carries
+    out. Every request goes to `ip` from then on, with a warning, instead of failing quietly
+
+    Args:
+        netlink (NetlinkBackend): the backend to try first
+    """
+    def __init__(self, netlink):
+        self.backend = netlink
+        self._ip = IpCommandBackend()
+
+    def __getattr__(self, name):
+        method = getattr(self.backend, name)
+        if self.backend is self._ip:
+            return method
+
+        def call(*args):
+            try:
+                result = method(*args)
+            except Exception as E:
+                if getattr(E, "errno", None) not in FALLBACK_ERRNOS:
+                    raise
+                result = getattr(self._ip, name)(*args)
+                self._fallBack(name, E)
+                return result
+            if not isinstance(result, dict):
+                return result
+            # Batches report failures per address, retry the rejected ones with `ip`
+            rejected = [item for item in args[0]
+                        if getattr(result.get(item[0]), "errno", None) in FALLBACK_ERRNOS]
+            if rejected:
+                retried = getattr(self._ip, name)(rejected)
+                if len(retried) < len(rejected):
+                    self._fallBack(name, result[rejected[0][0]])
+                for item in rejected:
+                    result.pop(item[0])
+                    if item[0] in retried:
+                        result[item[0]] = retried[item[0]]
+            return result
+        return call
+
+    def _fallBack(self, name, error):
+        if self.backend is not self._ip:
+            print("WARN: netlink refused {} ({}) where the ip command did not, using ip "
+                  "from now on".format(name, error))
+            self.backend = self._ip
+
+
+def _getBackend():
+    """Get the address backend chosen by 'net_backend': "netlink", "ip" or "auto" (netlink if we
+    can open a netlink socket and it does what the `ip` command would, otherwise `ip`)
+    """
+    global _backend
+    if _backend is None:
+        choice = config.config.get("net_backend", "auto")
+        if choice in ("auto", "netlink"):
+            try:
+                from .netlink import NetlinkBackend
+                _backend = NetlinkBackend()
+            except (AttributeError, OSError):
+                if choice == "netlink":
+                    raise
+            if _backend and choice == "auto":
+                _backend = AutoBackend(_backend)
+        if _backend is None:
+            _backend = IpCommandBackend()
+    return _backend
+
+
+@traced("add_interface")
+def _addVirtualInterface(ip, dev, label=None):
     '''
     add a virtual interface with the specified IP address
 
     Args:
         ip (str): The ip address to add
         dev (str): The dev to add the virtual interface to
+        label (str, optional): the label to use. The caller then keeps track of the address,
+            it is left out of the interface cache
     
     Returns:
         dict: the label of the new interface
     '''
+    prefixlen = int(config.config['net_netmask'].lstrip("/"))
+    if label:
+        _getBackend().addAddress(ip, prefixlen, dev, label)
+        return label
     # Generate a label for the virtual interface
-    label = "{}:{}{}".format(dev, LABEL, random.randint(1, 1000))
-    while label in _getInterfaceLabels(dev):
-        label = "{}:{}{}".format(dev, LABEL, random.randint(1, 1000))
-    netmask = config.config['net_netmask']
+    label = iface.allocateLabel(dev)
     # Add the interface
-    command = "ip addr add {}{} brd + dev {} label {}"
-    command = command.format(ip, netmask, dev, label)
-    res = execute(command)
-    if res.get('status', 255) != 0:
-        raise Exception("Cannot add interface: {}\n{}".format(
-                        res.get('stderr', ''), command))
+    try:
+        _getBackend().addAddress(ip, prefixlen, dev, label)
+    except Exception:
+        iface.releaseLabel(label)
+        raise
+    iface.addressAdded(ip, prefixlen, dev, label)
     return label
 
 
-def _delVirtualInterface(ip, dev=None):
+def _delVirtualInterface(ip, dev=None, prefixlen=None):
     '''
     delete a virtual interface with the specified IP address
 
     Args:
         ip (str): The ip address of the virtual interface
         dev (str, optional): the dev name
+        prefixlen (int, optional): the prefix length, for an address the interface cache does
+            not keep track of
     '''
-    if not dev:
-        dev = _getInterfaceNameFromIp(ip)
-    else:
-        dev += ":*"
-    netmask = _getSubnetMaskFromIp(ip)
-    res = execute("ip addr del {}{} dev {}".format(ip, netmask, dev))
-    if res.get('status', 255) != 0:
-        raise Exception("Cannot delete interface: {}".format(
-                        res.get('stderr', '')))
+    if prefixlen is not None:
+        _getBackend().delAddress(ip, prefixlen, dev)
+        return True
+    _, prefixlen, name, _ = _findAddress(ip)
+    _getBackend().delAddress(ip, prefixlen, dev or name)
+    iface.addressDeleted(ip)
     return True
 
 
+def _reserveAll(addresses, dev):
+    """Configure many addresses in one batch. Addresses that already carry one of our labels
+    (left by an earlier run) are adopted as they are
+
+    Args:
+        addresses (iterable): the addresses to configure
+        dev (str): the device to add them to
+    """
+    prefixlen = int(config.config['net_netmask'].lstrip("/"))
+    batch = []
+    for ip in addresses:
+        existing = iface.lookup(ip)
+        if existing:
+            if existing[2] == dev and iface.ownsLabel(existing[3]):
+                _reserved.add(ip)
+            else:
+                print("WARN: Address exists:", ip)
+            continue
+        batch.append((ip, prefixlen, dev, iface.allocateLabel(dev)))
+    errors = _getBackend().addAddresses(batch) if batch else {}
+    for ip, prefixlen, dev, label in batch:
+        if ip in errors:
+            iface.releaseLabel(label)
+            print("WARN: Cannot add address {}: {}".format(ip, errors[ip]))
+        else:
+            iface.addressAdded(ip, prefixlen, dev, label)
+            _reserved.add(ip)
+
+
+def _releaseAll(addresses):
+    """Delete many addresses in one batch, skipping any that are not configured"""
+    batch = []
+    for ip in addresses:
+        _reserved.discard(ip)
+        address = iface.lookup(ip)
+        if address:
+            batch.append((ip, address[1], address[2]))
+    errors = _getBackend().delAddresses(batch) if batch else {}
+    for ip, _, _ in batch:
+        if ip in errors:
+            print("WARN: Cannot delete address {}: {}".format(ip, errors[ip]))
+        else:
+            iface.addressDeleted(ip)
+
+
 def _getInterfaceLabels(dev):
     '''
     return the labels of all virtual interfaces for a dev
     '''
-    # The command to list all the labels assigned to an interface
-    command = "".join(("ip a show dev {0} | grep -Eo '{0}:[a-zA-Z0-9:]+'",
-                       " | cut -d':' -f2-"))
-    # command = "ip a show dev {0}"
-    command = command.format(dev)
-    res = execute(command)
-    try:
-        labels = res['stdout'].strip().split()
-        return labels
-    except Exception:
-        raise Exception("Cannot get labels: {}".format(res.get('stderr', '')))
+    labels = []
+    for _, _, _, label in _getBackend().getAddresses(dev):
+        if label.startswith(dev + ":"):
+            labels.append(label.split(":", 1)[1])
+    return labels
+
+
+def _findAddress(ip):
+    """Find an address on the host, checking the interface cache first
+
+    Returns:
+        tuple: (ip, prefixlen, device, label)
+    """
+    address = iface.lookup(ip)
+    if address:
+        return address
+    for address in _getBackend().getAddresses():
+        if address[0] == ip:
+            return address
+    raise Exception("Cannot find an interface with the address {}".format(ip))
 
 
 def _getIp(host="1.1.1.1"):
@@ -124,6 +1407,17 @@ def _getIp(host="1.1.1.1"):
     return ip
 
 
+def _getMacFromDevice(dev):
+    """Get the MAC address of a device as bytes
+    """
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
+    try:
+        sock.bind((dev, 0))
+        return sock.getsockname()[4]
+    finally:
+        sock.close()
+
+
 def _getSubnetMaskFromIp(ip):
     """Get the subnet mask for the given IP
 
@@ -132,11 +1426,7 @@ def _getSubnetMaskFromIp(ip):
     Returns:
         str: the subnet mask
     """
-    res = execute("ip addr | grep -oE '{}/[^ ]+'".format(ip))  # Get three lines of output
-    if res.get('status', 255) != 0:
-        raise Exception("Cannot find default interface: {}".format(res.get('stderr', '')))
-    mask = res['stdout'].split("/")[-1].strip()
-    return "/" + mask
+    return "/{}".format(_findAddress(ip)[1])
 
 
 def _getInterfaceNameFromIp(ip):
@@ -147,13 +1437,7 @@ def _getInterfaceNameFromIp(ip):
     Returns:
         str: the interface name
     """
-    res = execute("ip addr | grep '{}' -B2".format(ip))  # Get three lines of output
-    if res.get('status', 255) != 0:
-        raise Exception("Cannot find default interface: {}".format(res.get('stderr', '')))
-    dev = res['stdout'].split()[-1].strip()
-    if dev == "dynamic":
-        dev = res['stdout'].split("\n")[0].split()[1].strip(":")
-    return dev
+    return _findAddress(ip)[2]
 
 
 def execute(args):
@@ -173,43 +1457,182 @@ def execute(args):
     return retval
 
 
+def _getScanner():
+    return ArpScanner(config.config['net_device'], rate=config.config.get('arp_rate', 1000),
+                      window=config.config.get('arp_window', 0.5),
+                      retries=config.config.get('arp_retries', 1),
+                      ip_src=iface.base_ip, mac_src=iface.mac)
+
+
+def _getCache():
+    """Load the ARP results saved for this device and subnet, if 'address_cache' is set"""
+    global _cache
+    if _cache is None and config.config.get('address_cache'):
+        subnet = IPv4Network(config.config['net_base_ip'] + config.config['net_netmask'],
+                             strict=False)
+        _cache = AddressCache(config.config['address_cache'], config.config['net_device'],
+                              str(subnet), max_age=config.config.get('address_cache_age', 3600))
+    return _cache
+
+
 def _findHosts():
+    global _target, _discovered
+    _discovered = True
     # Get all the possible hosts in the network
     hosts = [ip.exploded for ip in IPv4Network(config.config['net_base_ip']+config.config['net_netmask'], strict=False).hosts()]
     random.shuffle(hosts)
-    count = config.config.get('address_count', 50)
-    print("Discovering {} addresses to use...".format(count))
+    count = _target = config.config.get('address_count', 50)
     addresses = set()
-    # Keep looping until we run out of ip addresses or have found enough
-    for ip in hosts:
-        if ip not in addresses:
-            if not isIpTaken(config.config['net_device'], ip):
-                addresses.add(ip)
-                print(".", end="", flush=True)
-        if len(addresses) == count:
+    cache = _getCache()
+    if cache:
+        fresh = cache.fresh()
+        if len(fresh) >= count:
+            config.config['net_addresses'] = random.sample(sorted(fresh), count)
+            print("Using {} addresses verified in the last {} seconds".format(count, cache.max_age))
+            # Check the addresses we use first, then the rest so the next start can use them
+            _revalidate[:] = (cache.oldestFirst(config.config['net_addresses']) +
+                              cache.oldestFirst(set(cache.free) - set(config.config['net_addresses'])))
+            return
+        # Only probe what we don't already know about
+        addresses |= fresh
+        known = fresh | cache.recentlyTaken()
+        hosts = [ip for ip in hosts if ip not in known]
+    print("Discovering {} addresses to use...".format(count - len(addresses)))
+    scanner = _getScanner()
+    # Probe a few times more candidates than we need per batch, busy networks will fill some
+    batch = max(count * 4, 256)
+    # Keep scanning until we run out of ip addresses or have found enough
+    for start in range(0, len(hosts), batch):
+        if len(addresses) >= count:
             break
-    config.config['net_addresses'] = list(addresses)
-    print(addresses)
-        
+        candidates = set(hosts[start:start + batch])
+        free = scanner.scan(candidates)
+        addresses |= free
+        if cache:
+            cache.record(free, candidates - free)
+        print(".", end="", flush=True)
+    if cache:
+        cache.save()
+    config.config['net_addresses'] = list(addresses)[:count]
+    print(config.config['net_addresses'])
+
+
+def _validateHosts():
+    """Make sure none of the configured addresses are in use by another host.
+
+    Addresses verified within 'address_cache_age' are used straight away. If there are any, the
+    others are probed in the background and join the pool once they are found free.
+    """
+    global _target
+    addresses = config.config['net_addresses']
+    _target = len(addresses)
+    cache = _getCache()
+    fresh = cache.fresh() if cache else set()
+    verified = [ip for ip in addresses if ip in fresh]
+    stale = [ip for ip in addresses if ip not in fresh]
+    if not stale:
+        return
+    if verified and config.config.get('workers', 1) <= 1:
+        print("Using {} verified addresses, validating {} more in the background".format(
+              len(verified), len(stale)))
+        config.config['net_addresses'] = verified
+        _revalidate[:] = stale
+        return
+    print("Validating {} addresses...".format(len(stale)))
+    free = _getScanner().scan(stale)
+    if cache:
+        cache.record(free, set(stale) - free)
+        cache.save()
+    taken = [ip for ip in stale if ip not in free]
+    if taken:
+        print("WARN: Addresses in use by other hosts:", taken)
+    config.config['net_addresses'] = [ip for ip in addresses if ip not in taken]
+    if not config.config['net_addresses']:
+        raise ValueError("Every configured address is in use by another host")
+
+
+def _loadAnyIp():
+    """Check the subnet to route locally in the "anyip" address mode
+
+    Returns:
+        IPv4Network: the subnet from 'anyip_subnet'
+    """
+    if not config.config.get('anyip_subnet'):
+        raise ValueError("'anyip_subnet' must be set to use the anyip address mode")
+    network = IPv4Network(config.config['anyip_subnet'], strict=False)
+    lan = IPv4Network(config.config['net_base_ip'] + config.config['net_netmask'], strict=False)
+    if lan.subnet_of(network):
+        # Every neighbour, the gateway included, would look like one of our own addresses
+        raise ValueError("'anyip_subnet' {} must not cover the whole network of {}".format(
+                         network, config.config['net_device']))
+    return network
+
+
+def _anyIpHosts():
+    """Every address in the AnyIP subnet that is not already in use"""
+    known = {iface.base_ip}
+    cache = _getCache()
+    if cache:
+        known |= cache.recentlyTaken()
+    return [host.exploded for host in _anyip.hosts()
+            if host.exploded not in known and not iface.lookup(host.exploded)]
+
+
+def _routeAnyIp():
+    """Route the whole AnyIP subnet to this host, so any address in it can be bound"""
+    dev = config.config['net_device']
+    _getBackend().addLocalRoute(_anyip, dev)
+    print("Routed {} ({} addresses) locally on {}".format(
+          _anyip, len(config.config['net_addresses']), dev))
+    try:
+        with open("/proc/sys/net/ipv4/conf/{}/arp_ignore".format(dev)) as fil:
+            if fil.read().strip() != "0":
+                print("WARN: arp_ignore is set on {}, only Sangheili will answer ARP for "
+                      "{}".format(dev, _anyip))
+    except OSError:
+        pass
+
+
+def _initPrefix():
+    """Route the 'ipv6_prefix' to this host and lease random addresses from it"""
+    global pool6
+    dev = config.config['net_device']
+    scanner = None
+    if config.config.get('ipv6_ready', 64):
+        scanner = NdpScanner(dev, rate=config.config.get('arp_rate', 1000),
+                             window=config.config.get('arp_window', 0.5),
+                             retries=config.config.get('arp_retries', 1), mac_src=iface.mac)
+    pool6 = PrefixPool(config.config['ipv6_prefix'], scanner,
+                       ready=config.config.get('ipv6_ready', 64))
+    if config.config.get('manage_addresses', True):
+        _getBackend().addLocalRoute(pool6.network, dev)
+        print("Routed {} locally on {}".format(pool6.network, dev))
+
 
 def _loadHosts():
     """Figure out which hosts we are allowed to use based on the config.config.
     Update config.config['net_addresses'] with the hosts
     """
+    global _anyip
+    if config.config.get('address_mode') == "anyip":
+        _anyip = _loadAnyIp()
 
     if config.config.get('address_server', False):
         #raise NotImplementedError("'address_server' is not yet implemented")
         from .arkclient import ArkClient, ArkApiError
-        client = ArkClient(config.config.get("address_server"))
+        global _ark
+        client = _ark = ArkClient(config.config.get("address_server"),
+                                  timeout=config.config.get("ark_timeout", 10))
         user = os.environ.get("ARK_USERNAME", "admin")
         passw = os.environ.get("ARK_PASSWORD", "changeme")
         client.login(user, passw)
         addresses = config.config.get("address_count", 30)
         try:
-            reg = client.registerHalo("Sangheili", addresses)
+            reg = client.registerHalo(HALO, addresses)
+            config.config['net_addresses'] = reg['addresses']
         except ArkApiError as E:
-            reg = client.getAddresses("Sangheili")
-        config.config['net_addresses']= reg['addresses']
+            config.config['net_addresses'] = client.getAllAddresses(
+                HALO, config.config.get("ark_page_size", 0))
         if config.config['net_addresses']:
             print("Loaded addresses from ArkServer '{}'".format(
                   config.config.get("address_server")))
@@ -226,6 +1649,9 @@ def _loadHosts():
             raise ValueError("If 'address_list' is specified, it must be a (non-empty) list of ip addresses")
         config.config['net_addresses'] = config.config['address_list']
         del config.config['address_list']
+    elif _anyip:
+        # The whole subnet is ours, no need to look for free addresses one by one
+        config.config['net_addresses'] = _anyIpHosts()
     else:
         # Default to just searching the net for IPs, but warn
         if not config.config.get('address_count', False):
@@ -233,11 +1659,29 @@ def _loadHosts():
         # Find the ip addresses that we are allowed to use from the network itself
         _findHosts()
 
-    # Add all the virtual interfaces
-    if config.config.get('reserve_addresses', False):
-        for ip in config.config['net_addresses']:
-            try:
-                _addVirtualInterface(ip, config.config['net_device'])
-            except:
-                print("WARN: Address exists:", ip)
-                pass
+    # Discovered addresses have just been checked, the others may be in use by now
+    if config.config.get('validate_addresses', False) and not _discovered:
+        _validateHosts()
+
+    if _anyip:
+        outside = [ip for ip in config.config['net_addresses'] if ip_address(ip) not in _anyip]
+        if outside:
+            print("WARN: Addresses outside of {} are not used:".format(_anyip), outside)
+            config.config['net_addresses'] = [ip for ip in config.config['net_addresses']
+                                              if ip not in outside]
+
+    if not config.config.get('manage_addresses', True):
+        return
+    if _anyip:
+        _routeAnyIp()
+    elif config.config.get('reserve_addresses', False):
+        # Add all the virtual interfaces at once
+        start = time.monotonic()
+        _reserveAll(config.config['net_addresses'], config.config['net_device'])
+        print("Reserved {} addresses in {:.3f}s".format(len(_reserved), time.monotonic() - start))
+    else:
+        # Addresses an earlier run left behind would look taken to the pool, so remove them
+        stale = [ip for ip in config.config['net_addresses']
+                 if iface.lookup(ip) and iface.ownsLabel(iface.lookup(ip)[3])]
+        if stale:
+            _releaseAll(stale)
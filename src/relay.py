@@ -0,0 +1,177 @@
+# Author: Micah Martin (knif3)
+# relay.py
+#
+# Move bytes between the client and the remote host as cheaply as possible
+#
+
+import os
+import select
+import socket
+
+from . import config
+
+# fcntl command to resize a pipe (linux/fcntl.h)
+F_SETPIPE_SZ = 1031
+
+
+def relay(src_sock, dst_sock, firstByte=None, counts=None):
+    """Relay data between two connected sockets until both directions have finished.
+
+    When one side shuts down its sending half, the shutdown is passed on to the other side and
+    the opposite direction keeps flowing until it ends too. An error on either side ends both.
+
+    The relay mode is taken from the config: "splice" moves the data through a kernel pipe so
+    the payload never reaches userspace, "buffer" copies through preallocated buffers, and
+    "auto" (the default) uses splice when the platform supports it. Either way a session never
+    buffers more than 'relay_buffer_size' (capped by 'session_buffer_limit') bytes per direction:
+    a slow receiver stops us reading from the sender.
+
+    Args:
+        src_sock (socket): the client socket
+        dst_sock (socket): the remote socket
+        firstByte (callable, optional): called once when the remote host first sends data
+        counts (list, optional): [client to remote, remote to client] byte counts, updated as
+            data is relayed so others can watch the progress
+    Returns:
+        tuple: the number of bytes sent (client to remote, remote to client)
+    """
+    mode = config.config.get("relay_mode", "auto")
+    size = config.config.get("relay_buffer_size", 65536)
+    if config.config.get("session_buffer_limit"):
+        size = min(size, config.config["session_buffer_limit"])
+    if counts is None:
+        counts = [0, 0]
+    if mode in ("auto", "splice") and hasattr(os, "splice"):
+        return splice_relay(src_sock, dst_sock, size, firstByte, counts)
+    return buffer_relay(src_sock, dst_sock, size, firstByte, counts)
+
+
+def buffer_relay(src_sock, dst_sock, size=65536, firstByte=None, counts=None):
+    """Relay data using recv_into on one preallocated buffer per direction
+
+    Args:
+        src_sock (socket): the client socket
+        dst_sock (socket): the remote socket
+        size (int, optional): the size of each buffer
+        firstByte (callable, optional): called once when the remote host first sends data
+        counts (list, optional): byte counts to update, see relay()
+    Returns:
+        tuple: the number of bytes sent (client to remote, remote to client)
+    """
+    counts = [0, 0] if counts is None else counts
+    buffers = {
+        src_sock: (memoryview(bytearray(size)), dst_sock, 0),
+        dst_sock: (memoryview(bytearray(size)), src_sock, 1),
+    }
+    poller = _Poller(src_sock, dst_sock)
+    try:
+        while poller:
+            # wait until client or remote is available for read
+            for sock in poller.wait():
+                view, peer, index = buffers[sock]
+                count = sock.recv_into(view)
+                if count <= 0:
+                    poller.remove(sock)
+                    _shutdown(peer)
+                    continue
+                if firstByte and index == 1:
+                    firstByte()
+                    firstByte = None
+                _sendAll(peer, view[:count])
+                counts[index] += count
+    except OSError:
+        pass  # One side went away, tear down both directions
+    return counts[0], counts[1]
+
+
+class _Poller(object):
+    """Wait for sockets to be readable with poll(), which unlike select() has no limit on
+    descriptor numbers. False once every socket has been removed
+    """
+    def __init__(self, *socks):
+        self._poll = select.poll()
+        self._sockets = {}
+        for sock in socks:
+            self._poll.register(sock, select.POLLIN)
+            self._sockets[sock.fileno()] = sock
+
+    def wait(self):
+        """Block until some sockets are readable and return them"""
+        return [self._sockets[fd] for fd, _ in self._poll.poll() if fd in self._sockets]
+
+    def remove(self, sock):
+        self._poll.unregister(sock)
+        del self._sockets[sock.fileno()]
+
+    def __bool__(self):
+        return bool(self._sockets)
+
+
+def _shutdown(sock):
+    """Pass an end of stream on: we will send nothing more, but may still receive"""
+    try:
+        sock.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+
+
+def _sendAll(sock, view):
+    """Send the whole view, resuming after any short writes"""
+    while view:
+        sent = sock.send(view)
+        view = view[sent:]
+
+
+def splice_relay(src_sock, dst_sock, size=65536, firstByte=None, counts=None):
+    """Relay data with splice() through one pipe per direction so no payload is copied into
+    userspace
+
+    Args:
+        src_sock (socket): the client socket
+        dst_sock (socket): the remote socket
+        size (int, optional): the pipe size to request and the most to move per splice
+        firstByte (callable, optional): called once when the remote host first sends data
+        counts (list, optional): byte counts to update, see relay()
+    Returns:
+        tuple: the number of bytes sent (client to remote, remote to client)
+    """
+    counts = [0, 0] if counts is None else counts
+    pipes = {}
+    try:
+        for sock, peer, index in ((src_sock, dst_sock, 0), (dst_sock, src_sock, 1)):
+            rpipe, wpipe = os.pipe()
+            pipes[sock] = (rpipe, wpipe, peer, index)
+            _setPipeSize(wpipe, size)
+        poller = _Poller(src_sock, dst_sock)
+        while poller:
+            for sock in poller.wait():
+                rpipe, wpipe, peer, index = pipes[sock]
+                count = os.splice(sock.fileno(), wpipe, size)
+                if count <= 0:
+                    poller.remove(sock)
+                    _shutdown(peer)
+                    continue
+                if firstByte and index == 1:
+                    firstByte()
+                    firstByte = None
+                # Drain the pipe into the other socket, splice may move less than asked for
+                pending = count
+                while pending:
+                    pending -= os.splice(rpipe, peer.fileno(), pending)
+                counts[index] += count
+    except OSError:
+        pass  # One side went away, tear down both directions
+    finally:
+        for rpipe, wpipe, _, _ in pipes.values():
+            os.close(rpipe)
+            os.close(wpipe)
+    return counts[0], counts[1]
+
+
+def _setPipeSize(fd, size):
+    """Try to grow a pipe so one splice can move a whole buffer"""
+    try:
+        import fcntl
+        fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except (ImportError, OSError):
+        pass
@@ -0,0 +1,129 @@
+# Author: Micah Martin (knif3)
+# resolver.py
+#
+# Resolve the hostnames that SOCKS clients ask us to connect to, caching the answers
+#
+
+import socket
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from ipaddress import ip_address
+
+from . import config
+
+
+class Resolver(object):
+    """Resolve hostnames on a small thread pool with a bounded TTL cache.
+
+    Both answers and failures are cached (failures for a shorter time), and concurrent lookups
+    of the same name share a single query.
+
+    Args:
+        ttl (int, optional): seconds to cache a successful lookup
+        negative_ttl (int, optional): seconds to cache a failed lookup
+        max_size (int, optional): the most names to keep in the cache
+        workers (int, optional): how many lookups can run at once
+        family (int, optional): the address family to resolve
+    """
+    def __init__(self, ttl=300, negative_ttl=30, max_size=4096, workers=8,
+                 family=socket.AF_INET):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.family = family
+        self._cache = OrderedDict()  # name => (expires, address or (exception type, args))
+        self._pending = {}  # name => Future for lookups in flight
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix="Resolver")
+
+    def resolve(self, host):
+        """Resolve a hostname, blocking until the answer is known
+
+        Args:
+            host (str): the name to resolve
+        Returns:
+            str: the address
+        Raises:
+            socket.gaierror: if the name does not resolve
+            UnicodeError: if the name is not a valid hostname
+        """
+        return self.lookup(host).result()
+
+    async def resolveAsync(self, host):
+        """Resolve a hostname without blocking the event loop. See resolve()"""
+        import asyncio
+        return await asyncio.wrap_future(self.lookup(host))
+
+    def lookup(self, host):
+        """Start resolving a hostname
+
+        Returns:
+            Future: resolves to the address, finished already if the answer was cached
+        """
+        try:
+            ip_address(host)
+            return self._finished(host)  # Already an address
+        except ValueError:
+            pass
+        with self._lock:
+            cached = self._cache.get(host)
+            if cached and cached[0] > time.monotonic():
+                self._cache.move_to_end(host)
+                return self._finished(cached[1])
+            future = self._pending.get(host)
+            if future is None:
+                future = self._executor.submit(self._query, host)
+                self._pending[host] = future
+            return future
+
+    def _query(self, host):
+        answer = error = None
+        try:
+            infos = socket.getaddrinfo(host, None, self.family, socket.SOCK_STREAM)
+            answer, ttl = infos[0][4][0], self.ttl
+        except Exception as E:
+            # Names that can't even be encoded (a label too long, say) fail like unknown ones.
+            # Only the type and args are cached, raising the same exception object every time
+            # would keep growing its traceback
+            error = E
+            answer, ttl = (type(E), E.args), self.negative_ttl
+        finally:
+            with self._lock:
+                self._pending.pop(host, None)
+                if answer is not None:
+                    self._cache[host] = (time.monotonic() + ttl, answer)
+                    self._cache.move_to_end(host)
+                    while len(self._cache) > self.max_size:
+                        self._cache.popitem(last=False)
+        if error is not None:
+            raise error
+        return answer
+
+    def _finished(self, answer):
+        future = Future()
+        if isinstance(answer, tuple):
+            error, args = answer
+            future.set_exception(error(*args))
+        else:
+            future.set_result(answer)
+        return future
+
+
+_resolver = None
+
+
+def getResolver():
+    """Get the resolver shared by every session, created from the config on first use. Names
+    resolve to IPv6 addresses too once there is an 'ipv6_prefix' to connect from
+    """
+    global _resolver
+    if _resolver is None:
+        _resolver = Resolver(ttl=config.config.get("dns_ttl", 300),
+                             negative_ttl=config.config.get("dns_negative_ttl", 30),
+                             max_size=config.config.get("dns_cache_size", 4096),
+                             family=(socket.AF_UNSPEC if config.config.get("ipv6_prefix")
+                                     else socket.AF_INET))
+    return _resolver
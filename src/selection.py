@@ -0,0 +1,231 @@
+# Author: Micah Martin (knif3)
+# selection.py
+#
+# Policies for choosing which outbound address a new session uses
+#
+
+import random
+import time
+from collections import OrderedDict
+
+
+class IndexedSet(object):
+    """A set that can also return a random member, or the member at a position, in O(1).
+
+    Removing a member moves the last one into its place, so the order is not stable.
+    """
+    def __init__(self, items=()):
+        self._items = []
+        self._positions = {}
+        for item in items:
+            self.add(item)
+
+    def add(self, item):
+        if item not in self._positions:
+            self._positions[item] = len(self._items)
+            self._items.append(item)
+
+    def discard(self, item):
+        index = self._positions.pop(item, None)
+        if index is None:
+            return
+        last = self._items.pop()
+        if index < len(self._items):
+            self._items[index] = last
+            self._positions[last] = index
+
+    def choice(self):
+        return random.choice(self._items)
+
+    def __getitem__(self, index):
+        return self._items[index]
+
+    def __contains__(self, item):
+        return item in self._positions
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+
+class Selector(object):
+    """Count the active sessions on every address and choose one for a new session.
+
+    Addresses with `cap` sessions are not chosen until one of them ends. Subclasses implement
+    choose() and may keep their own structures up to date through _added, _removed and _moved.
+
+    Args:
+        addresses (iterable, optional): the addresses to choose from
+        cap (int, optional): the most sessions per address (0 for no limit)
+    """
+    def __init__(self, addresses=(), cap=0):
+        self.cap = cap
+        self.active = {}  # ip => sessions using it
+        self.open = IndexedSet()  # The addresses under the cap
+        for ip in addresses:
+            self.add(ip)
+
+    def add(self, ip):
+        if ip in self.active:
+            return
+        self.active[ip] = 0
+        self.open.add(ip)
+        self._added(ip)
+
+    def remove(self, ip):
+        count = self.active.pop(ip, None)
+        if count is None:
+            return
+        self.open.discard(ip)
+        self._removed(ip, count)
+
+    def acquired(self, ip):
+        if ip not in self.active:
+            return
+        count = self.active[ip] + 1
+        self.active[ip] = count
+        if self.cap and count >= self.cap:
+            self.open.discard(ip)
+        self._moved(ip, count - 1, count)
+
+    def released(self, ip):
+        if not self.active.get(ip):
+            return
+        count = self.active[ip] - 1
+        self.active[ip] = count
+        if not self.cap or count < self.cap:
+            self.open.add(ip)
+        self._moved(ip, count + 1, count)
+
+    def choose(self, destination=None):
+        """Returns:
+            str: the address for a session to destination, or None if all are at the cap
+        """
+        raise NotImplementedError
+
+    def _added(self, ip):
+        pass
+
+    def _removed(self, ip, count):
+        pass
+
+    def _moved(self, ip, old, new):
+        pass
+
+
+class RandomSelector(Selector):
+    """Any address under the cap, uniformly at random"""
+    def choose(self, destination=None):
+        return self.open.choice() if self.open else None
+
+
+class RoundRobinSelector(Selector):
+    """Each address under the cap in turn"""
+    def __init__(self, addresses=(), cap=0):
+        self._next = 0
+        Selector.__init__(self, addresses, cap)
+
+    def choose(self, destination=None):
+        if not self.open:
+            return None
+        self._next = (self._next + 1) % len(self.open)
+        return self.open[self._next]
+
+
+class LeastActiveSelector(Selector):
+    """A random address among those with the fewest sessions.
+
+    Addresses are kept in buckets by their session count, and the lowest non-empty bucket is
+    tracked as counts change, so choosing never looks at every address.
+    """
+    def __init__(self, addresses=(), cap=0):
+        self._buckets = {}  # sessions => IndexedSet of addresses
+        self._min = 0
+        Selector.__init__(self, addresses, cap)
+
+    def choose(self, destination=None):
+        if not self._buckets:
+            return None
+        # Every bucket is at or above _min, so this stops at the lowest one
+        while self._min not in self._buckets:
+            self._min += 1
+        if self.cap and self._min >= self.cap:
+            return None
+        return self._buckets[self._min].choice()
+
+    def _added(self, ip):
+        self._buckets.setdefault(0, IndexedSet()).add(ip)
+        self._min = 0
+
+    def _removed(self, ip, count):
+        self._bucketDiscard(ip, count)
+
+    def _moved(self, ip, old, new):
+        self._bucketDiscard(ip, old)
+        self._buckets.setdefault(new, IndexedSet()).add(ip)
+        self._min = min(self._min, new)
+
+    def _bucketDiscard(self, ip, count):
+        bucket = self._buckets.get(count)
+        if bucket is not None:
+            bucket.discard(ip)
+            if not bucket:
+                del self._buckets[count]
+
+
+class StickySelector(LeastActiveSelector):
+    """Keep using the same address for a destination while it has been used in the last `ttl`
+    seconds. New destinations get the least active address.
+
+    Args:
+        ttl (float, optional): seconds a destination keeps its address after its last session
+        See Selector for the rest
+    """
+    def __init__(self, addresses=(), cap=0, ttl=300):
+        self.ttl = ttl
+        self._sticky = OrderedDict()  # destination => (ip, expires), soonest to expire first
+        LeastActiveSelector.__init__(self, addresses, cap)
+
+    def choose(self, destination=None):
+        now = time.monotonic()
+        while self._sticky:
+            oldest, (_, expires) = next(iter(self._sticky.items()))
+            if expires > now:
+                break
+            del self._sticky[oldest]
+        if destination is None:
+            return LeastActiveSelector.choose(self)
+        ip, _ = self._sticky.pop(destination, (None, 0))
+        if ip not in self.open:
+            # New, expired, removed from the pool or at the cap
+            ip = LeastActiveSelector.choose(self)
+        if ip is not None:
+            self._sticky[destination] = (ip, now + self.ttl)
+        return ip
+
+
+POLICIES = {
+    "random": RandomSelector,
+    "round-robin": RoundRobinSelector,
+    "least-active": LeastActiveSelector,
+    "sticky": StickySelector,
+}
+
+
+def getSelector(policy, addresses=(), cap=0, sticky_ttl=300):
+    """Create the selector for a policy name
+
+    Args:
+        policy (str): "random", "round-robin", "least-active" or "sticky"
+        addresses (iterable, optional): the addresses to choose from
+        cap (int, optional): the most sessions per address (0 for no limit)
+        sticky_ttl (float, optional): seconds a destination keeps its address with "sticky"
+    """
+    if policy not in POLICIES:
+        raise ValueError("Unknown address policy '{}', use one of: {}".format(
+                         policy, ", ".join(sorted(POLICIES))))
+    if policy == "sticky":
+        return StickySelector(addresses, cap, sticky_ttl)
+    return POLICIES[policy](addresses, cap)
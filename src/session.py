@@ -6,107 +6,354 @@
 
 import struct
 import socket
-import select
+import threading
+import time
+from ipaddress import ip_address
 from socketserver import StreamRequestHandler
 
-from .networking import new_ip, cleanup_ip
+from . import config, metrics
+from .connector import raceConnect
+from .limits import SessionTimer, getAdmission
+from .networking import (AddressFamilyUnsupported, PoolExhausted, new_ip, cleanup_ip,
+                         outboundSocket)
+from .relay import relay
+from .resolver import getResolver
+from .sessionlog import getSessionLog
+from .tracing import activate, getTracer
+from .udprelay import UdpRelay
 
 
 # SOCKS Settings
 VERSION = 5     # Version 5
 METHOD = 0      # No authentication
 
+
+def packReply(code, bndaddr="0.0.0.0", bndport=0):
+    """Pack the reply to a request, with the bound address as IPv4 or IPv6
+
+    Args:
+        code (int): the reply code, 0 for success
+        bndaddr (str, optional): the address we bound for the client
+        bndport (int, optional): the port we bound for the client
+    """
+    address = ip_address(bndaddr.split("%")[0])
+    if address.version == 6 and address.ipv4_mapped:
+        # An IPv4 client of a dual stack listener
+        address = address.ipv4_mapped
+    return (struct.pack("!BBBB", VERSION, code, 0, 1 if address.version == 4 else 4) +
+            address.packed + struct.pack("!H", bndport))
+
+
+class HandshakeError(Exception):
+    """The client sent something we can't handle. reply is the SOCKS reply code to send back"""
+    def __init__(self, message, reply=1):
+        Exception.__init__(self, message)
+        self.reply = reply
+
+
+class HandshakeParser(object):
+    """Incrementally parse the client's greeting and request from whatever bytes have arrived.
+
+    Feed it data as it is received. Once the greeting is complete `methods` is set, and once the
+    request is complete `request` is set to (cmd, atype, address, port). Any bytes after the
+    request are early payload, see leftover().
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.methods = None
+        self.request = None
+
+    def feed(self, data):
+        """Add received data and parse as many messages as it completes
+
+        Raises:
+            HandshakeError: if a message is invalid
+        """
+        self.buffer += data
+        if self.methods is None:
+            self._parseGreeting()
+        if self.methods is not None and self.request is None:
+            self._parseRequest()
+
+    def leftover(self):
+        """Returns:
+            bytes: the data received after the request, which should be sent on to the remote host
+        """
+        data = bytes(self.buffer)
+        del self.buffer[:]
+        return data
+
+    def _parseGreeting(self):
+        buf = self.buffer
+        if len(buf) < 2:
+            return
+        if buf[0] != VERSION:
+            raise HandshakeError("Unsupported SOCKS version {}".format(buf[0]))
+        end = 2 + buf[1]
+        if len(buf) < end:
+            return
+        self.methods = set(buf[2:end])
+        del buf[:end]
+
+    def _parseRequest(self):
+        buf = self.buffer
+        if len(buf) < 4:
+            return
+        ver, cmd, _, atype = buf[:4]
+        if ver != VERSION:
+            raise HandshakeError("Unsupported SOCKS version {}".format(ver))
+        if atype == 1:  # IPv4
+            start, length = 4, 4
+        elif atype == 3:  # DOMAINNAME
+            if len(buf) < 5:
+                return
+            start, length = 5, buf[4]
+        elif atype == 4:  # IPv6
+            start, length = 4, 16
+        else:
+            raise HandshakeError("Unsupported address type {}".format(atype), reply=8)
+        end = start + length + 2
+        if len(buf) < end:
+            return
+        raw = bytes(buf[start:start + length])
+        if atype == 1:
+            address = socket.inet_ntoa(raw)
+        elif atype == 3:
+            try:
+                address = raw.decode()
+            except UnicodeError:
+                raise HandshakeError("The domain name is not valid UTF-8", reply=8)
+        else:
+            address = socket.inet_ntop(socket.AF_INET6, raw)
+        port = struct.unpack_from("!H", buf, start + length)[0]
+        self.request = (cmd, atype, address, port)
+        del buf[:end]
+
+
 class SocksSession(StreamRequestHandler):
     def handle(self):
-        print('Accepting connection from {}'.format(self.client_address), end="")
+        self._started = time.monotonic()
+        accepted = getattr(self.server, "accepted", {}).pop(id(self.request), None)
+        if accepted:
+            metrics.phases["accept"].observe(self._started - accepted)
+        metrics.sessions.inc()
+        metrics.active_sessions.inc()
         self._src_sock = self.connection
         self._dst_sock = None
         self._remote_addr = None
         self._remote_port = None
-        self._outbound_ip = new_ip()
-        if self.startSession():
-            self.handleSession()
+        self._outbound_ip = None
+        self._outbound_ip6 = None
+        self._early_data = b''
+        self._udp = None
+        self._phase = self._started
+        self._counts = [0, 0]
+        self._sent = self._received = 0
+        self._source = None  # The outbound address, kept for the log after its lease ends
+        self._error = None
+        self._trace = None
+        self._timer = None
+        # The server admitted this connection, so the session has to be released when it ends
+        handshaking = True
+        try:
+            self._trace = getTracer().begin(self.client_address, self._started)
+            activate(self._trace)
+            self._timer = SessionTimer(self.expire, lambda: self._counts[0] + self._counts[1],
+                                       idle=config.config.get("handshake_timeout", 10),
+                                       lifetime=config.config.get("session_max_lifetime", 0))
+            # Let the server end the session and wait for this thread when it shuts down
+            self.thread = threading.current_thread()
+            getattr(self.server, "sessions", set()).add(self)
+            started = self.startSession()
+            getAdmission().handshakeDone()
+            handshaking = False
+            if started:
+                # UDP associations have their own idle timeout
+                self._timer.setIdle(0 if self._udp else
+                                    config.config.get("session_idle_timeout", 3600))
+                self.handleSession()
+            else:
+                metrics.session_errors.inc()
+                self._error = self._error or "handshake failed"
+        except Exception as err:
+            self._error = "{}: {}".format(type(err).__name__, err)
+            raise
+        finally:
+            if self._timer:
+                self._timer.cancel()
+            getAdmission().release(handshaking)
+            self.close()
+            getattr(self.server, "sessions", set()).discard(self)
+            ended = metrics.phases["session"].time(self._started)
+            metrics.active_sessions.dec()
+            if self._timer and self._timer.expired:
+                self._error = "expired ({})".format("handshake" if handshaking else
+                                                    self._timer.expired)
+            getSessionLog().record(self.client_address, (self._remote_addr, self._remote_port),
+                                   self._source, self._sent, self._received,
+                                   ended - self._started, self._error,
+                                   "udp" if self._udp else "connect")
+            if self._trace:
+                getTracer().finish(self._trace, (self._remote_addr, self._remote_port), ended,
+                                   self._error)
+                activate(None)
 
     def startSession(self):
         """Start the SOCKS5 session. This includes unpacking the data sent to the server and making sure
-        that the settings are correct. We will only support IPv4 with No authentication
+        that the settings are correct. We support No authentication, the CONNECT and UDP ASSOCIATE
+        commands, and IPv4, domain name and IPv6 destination addresses
 
         We implement these settings according to RFC1928
         https://www.ietf.org/rfc/rfc1928.txt
 
+        The client's messages are read into one buffer as they arrive, so a greeting and request sent
+        back to back cost a single recv, and anything sent after the request is kept as early payload.
+
         Returns:
             bool: Whether or not the socks proxy was to our spec.
         """
-        # Get the first two bytes from the server and unpack them
-        data = self._src_sock.recv(2)
-        ver, nmethods = struct.unpack("!BB", data)
-        if ver != VERSION:
+        parser = HandshakeParser()
+        try:
+            if not self._readUntil(parser, lambda: parser.methods is not None):
+                return False
+        except HandshakeError:
             self.endSession(0)  # End session with unsupported VERSION
-        # Get all the supported client methods
-        data = self._src_sock.recv(nmethods)
-        methods = set()
-        for b in data:
-            methods.add(b)
-        if 0 not in methods:
+            return False
+        if METHOD not in parser.methods:
             self.endSession(0)  # End session with unsupported method
-        
+            return False
+
         # Choose the method we plan on using and send it back to the server
-        reply = struct.pack("!BB", ver, METHOD)
+        reply = struct.pack("!BB", VERSION, METHOD)
         self._src_sock.sendall(reply)
 
         # Start figuring out what the client wants to do
-        data = self._src_sock.recv(4)
-        ver, cmd, _, atype = struct.unpack("!BBBB", data)
-        # Get remote addr
-        if atype == 1:  # IPv4
-            data = self._src_sock.recv(4)
-            self._remote_addr = socket.inet_ntoa(data)
-        elif atype == 3: # DOMAINNAME
-            data = self._src_sock.recv(1)
-            length = struct.unpack("!B", data) # Length of domain
-            self._remote_addr = self._src_sock.recv(length)
-        else:
-            self.close()
-        # Get remote port
-        data = self._src_sock.recv(2)
-        self._remote_port = struct.unpack('!H', data)[0]
+        try:
+            if not self._readUntil(parser, lambda: parser.request is not None):
+                return False
+        except HandshakeError as err:
+            self._error = str(err)
+            self._src_sock.sendall(packReply(err.reply))
+            return False
+        cmd, _, self._remote_addr, self._remote_port = parser.request
+        self._early_data = parser.leftover()
+        self._phase = self._mark("handshake")
         # Handle the client command
+        if cmd == 3:
+            return self.startAssociation()
+        if cmd != 1:  # Only CONNECT and UDP ASSOCIATE are supported
+            self._src_sock.sendall(packReply(7))
+            return False
         try:
-            if cmd == 1:  # CONNECT
-                self.connectRemote()
-                bndaddr, bndport = self._dst_sock.getsockname()
-                bndaddr = struct.unpack("!I", socket.inet_aton(bndaddr))[0]
-            else:
-                self.close()
-            reply = struct.pack("!BBBBIH", ver, 0, 0, atype, bndaddr, bndport)
-            self._src_sock.sendall(reply)
+            self.connectRemote()
+            self._src_sock.sendall(packReply(0, *self._dst_sock.getsockname()[:2]))
+        except AddressFamilyUnsupported as err:
+            self._error = str(err)
+            self._src_sock.sendall(packReply(8)) # Address type not supported
+            return False
+        except PoolExhausted as err:
+            self._error = str(err)
+            self._src_sock.sendall(packReply(1)) # General failure
+            return False
         except Exception as err:
-            print(":", err)
-            reply = struct.pack("!BBBBIH", ver, 5, 0, atype, 0, 0) # Return connection refused
-            self._src_sock.sendall(reply)
-            self.close()
+            self._error = str(err)
+            self._src_sock.sendall(packReply(5)) # Return connection refused
             return False
         return True
+
+    def startAssociation(self):
+        """Set up a UDP ASSOCIATE. The client's datagrams are relayed from one outbound address
+        for as long as this connection stays open.
+
+        Returns:
+            bool: Whether or not the association was set up
+        """
+        try:
+            self._outbound_ip = new_ip()
+            try:
+                # Datagrams to IPv6 hosts go out from an address of their own
+                self._outbound_ip6 = new_ip(family=socket.AF_INET6)
+            except AddressFamilyUnsupported:
+                pass
+            self._phase = self._mark("new_ip")
+            self._source = self._outbound_ip
+            # Receive the client's datagrams on the address it reached us on
+            self._udp = UdpRelay(self.client_address[0], self._remote_port,
+                                 self._src_sock.getsockname()[0], self._outbound_ip,
+                                 self._outbound_ip6)
+        except (PoolExhausted, OSError) as err:
+            self._error = str(err)
+            self._src_sock.sendall(packReply(1)) # General failure
+            return False
+        self._src_sock.sendall(packReply(0, *self._udp.address))
+        return True
+
+    def _readUntil(self, parser, done):
+        """Feed the parser from the client until done() is true
+
+        Returns:
+            bool: False if the client closed the connection first
+        """
+        while not done():
+            data = self._src_sock.recv(4096)
+            if not data:
+                return False
+            parser.feed(data)
+        return True
     
     def handleSession(self):
-        print(" => ('{}', {})".format(self._remote_addr, self._remote_port))
-        while True:
-            # wait until client or remote is available for read
-            r, _, _ = select.select([self._src_sock, self._dst_sock], [], [])
-            if self._src_sock in r:
-                data = self._src_sock.recv(4096)
-                if self._dst_sock.send(data) <= 0:
-                    break
-            if self._dst_sock in r:
-                data = self._dst_sock.recv(4096)
-                if self._src_sock.send(data) <= 0:
-                    break
+        if self._udp:
+            self._udp.run(self._src_sock, config.config.get("udp_idle_timeout", 120))
+            self._traceRelay()
+            self._sent, self._received = self._udp.sent, self._udp.received
+            metrics.recordBytes(self._sent, self._received)
+            self.close()
+            return
+        sent = received = 0
+        firstByte = lambda: self._mark("first_byte")
+        try:
+            if self._early_data:
+                # The client did not wait for our reply before sending its payload
+                self._dst_sock.sendall(self._early_data)
+            sent, received = relay(self._src_sock, self._dst_sock, firstByte, self._counts)
+            sent += len(self._early_data)
+        except OSError:
+            pass
+        self._traceRelay()
+        self._sent, self._received = sent, received
+        metrics.recordBytes(sent, received)
         self.close()
 
+    def _mark(self, phase):
+        """Time a phase of the session that ended just now, in the metrics and the trace
+
+        Returns:
+            float: the current time.monotonic(), to start timing the next phase
+        """
+        now = metrics.phases[phase].time(self._phase)
+        if self._trace:
+            self._trace.span(phase, self._phase, now)
+        return now
+
+    def _traceRelay(self):
+        if self._trace:
+            self._trace.span("relay", self._phase, time.monotonic())
+
+    def expire(self, reason):
+        """Called by the session timer to end a session that is idle or too old. Shutting the
+        sockets down wakes the thread handling the session wherever it is blocked
+        """
+        for sock in (self._src_sock, self._dst_sock):
+            if sock:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
     def endSession(self, reason=0):
         """End the SOCKS session due to an error."""
         if reason == 0:
-            reply = struct.pack("!BB", 0, 255)  # Unsupported version or auth method
+            reply = struct.pack("!BB", VERSION, 255)  # Unsupported version or auth method
         self._src_sock.sendall(reply)
         self.close()
 
@@ -114,14 +361,28 @@ class SocksSession(StreamRequestHandler):
         """Try to connect to the remote client. This part is where we choose the outbound
         IP address and randomize the outgoing connection.
         """
-        self._dst_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # TODO: GET A RANDOM IP RIGHT HERE
-        try:
-            self._dst_sock.bind((self._outbound_ip, 0))
-            print(" => ({})".format(self._outbound_ip))
-        except:
-            pass
-        self._dst_sock.connect((self._remote_addr, self._remote_port))
+        # Hostnames are resolved (and cached) by the shared resolver
+        remote = (getResolver().resolve(self._remote_addr), self._remote_port)
+        family = socket.AF_INET6 if ":" in remote[0] else socket.AF_INET
+        self._outbound_ip = new_ip(self._remote_addr, family)
+        self._phase = self._mark("new_ip")
+        timeout = config.config.get("connect_timeout", 10)
+        if config.config.get("connect_strategy") == "race":
+            # The racer owns our lease now and gives us back the address that won
+            ip, self._outbound_ip = self._outbound_ip, None
+            self._dst_sock, self._outbound_ip = raceConnect(
+                remote, ip, attempts=config.config.get("connect_attempts", 2),
+                stagger=config.config.get("connect_stagger", 0.25), timeout=timeout)
+            self._source = self._outbound_ip
+            self._phase = self._mark("connect")
+            return
+        self._source = self._outbound_ip
+        self._dst_sock = outboundSocket(self._outbound_ip)
+        self._phase = self._mark("bind")
+        self._dst_sock.settimeout(timeout)
+        self._dst_sock.connect(remote)
+        self._dst_sock.settimeout(None)
+        self._phase = self._mark("connect")
 
     def close(self):
         """Clean up the sockets"""
@@ -129,6 +390,12 @@ class SocksSession(StreamRequestHandler):
             self._src_sock.close()
         if self._dst_sock:
             self._dst_sock.close()
+        if self._udp:
+            self._udp.close()
         if self._outbound_ip:
             cleanup_ip(self._outbound_ip) # Cleanup the extra IP address
+            self._outbound_ip = None
+        if self._outbound_ip6:
+            cleanup_ip(self._outbound_ip6)
+            self._outbound_ip6 = None
         self.server.close_request(self.request)
@@ -0,0 +1,182 @@
+# Author: Micah Martin (knif3)
+# sessionlog.py
+#
+# Log one record per session from a background writer so sessions never wait on the output
+#
+
+import atexit
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import deque
+
+from . import config, metrics
+
+
+class SessionLog(object):
+    """Queue session records in memory and write them in batches from one thread.
+
+    Sessions only append to a bounded queue: when it is full the record is dropped and counted
+    instead of making the session wait. Successful sessions can be sampled at high connection
+    rates; sessions that failed are always logged.
+
+    Args:
+        path (str, optional): the file to append to, "-" (the default) for stdout or "" to disable
+        fmt (str, optional): "text" for one readable line per session, "json" for JSON lines
+        sample (float, optional): the fraction of successful sessions to log
+        queue_size (int, optional): the most records waiting to be written
+        max_bytes (int, optional): rotate the file once it grows past this size (0 to never)
+        backups (int, optional): how many rotated files to keep
+        interval (float, optional): the most seconds a record waits before it is written
+    """
+    BATCH = 256  # Wake the writer early once this many records are waiting
+
+    def __init__(self, path="-", fmt="text", sample=1.0, queue_size=10000, max_bytes=0, backups=5,
+                 interval=0.5):
+        self.path = path
+        self.format = self._json if fmt == "json" else self._text
+        self.sample = sample
+        self.queue_size = queue_size
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.interval = interval
+        self.dropped = 0
+        self._queue = deque()
+        self._wake = threading.Event()
+        self._lock = threading.Lock()  # Held while writing, so close() can wait for the writer
+        self._file = None
+        self._size = 0  # Bytes in the file being written
+        self._thread = None
+
+    def record(self, client, destination=None, source=None, sent=0, received=0, duration=0,
+               error=None, command="connect"):
+        """Queue the record of a session that has ended. Never blocks
+
+        Args:
+            client (tuple): the client's (address, port)
+            destination (tuple, optional): the (host, port) the client asked for
+            source (str, optional): the outbound address the session used
+            sent (int, optional): bytes from the client to the remote host
+            received (int, optional): bytes from the remote host to the client
+            duration (float, optional): seconds the session was open
+            error (str, optional): why the session failed, if it did
+            command (str, optional): "connect" or "udp"
+        """
+        if not self.path:
+            return
+        if error is None and self.sample < 1 and random.random() >= self.sample:
+            return
+        if len(self._queue) >= self.queue_size:
+            self.dropped += 1
+            metrics.log_records_dropped.inc()
+            return
+        self._queue.append((time.time(), client, destination, source, sent, received, duration,
+                            error, command))
+        if self._thread is None:
+            self._start()
+        if len(self._queue) >= self.BATCH:
+            self._wake.set()
+
+    def close(self):
+        """Write out whatever is still queued"""
+        with self._lock:
+            self._flush()
+            if self._file and self._file is not sys.stdout:
+                self._file.close()
+            self._file = None
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="SessionLog", daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            with self._lock:
+                try:
+                    self._flush()
+                except OSError as E:
+                    print("WARN: Cannot write the session log {}: {}".format(self.path, E))
+
+    def _flush(self):
+        if not self._queue:
+            return
+        out = self._open()
+        while self._queue:
+            line = self.format(*self._queue.popleft())
+            if self.max_bytes and self._size and self._size + len(line) > self.max_bytes:
+                out = self._open(rotate=True)
+            out.write(line)
+            self._size += len(line)
+        out.flush()
+
+    def _open(self, rotate=False):
+        """Get the file to write to, rotating it first if asked to"""
+        if self.path == "-":
+            return sys.stdout
+        if rotate:
+            self._file.close()
+            self._file = None
+            self._rotate()
+        if self._file is None:
+            self._file = open(self.path, "a")
+            self._size = self._file.tell()
+        return self._file
+
+    def _rotate(self):
+        for index in range(self.backups - 1, 0, -1):
+            name = "{}.{}".format(self.path, index)
+            if os.path.exists(name):
+                os.replace(name, "{}.{}".format(self.path, index + 1))
+        if self.backups:
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+
+    @staticmethod
+    def _text(when, client, destination, source, sent, received, duration, error, command):
+        line = "{} {}:{} => {}{} from {} sent={} received={} duration={:.3f}".format(
+            time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(when)), client[0], client[1],
+            "{}:{}".format(*destination) if destination and destination[0] else "-",
+            " (udp)" if command == "udp" else "", source or "-", sent, received, duration)
+        if error:
+            line += " error={}".format(error)
+        return line + "\n"
+
+    @staticmethod
+    def _json(when, client, destination, source, sent, received, duration, error, command):
+        return json.dumps({
+            "time": round(when, 3), "client": client[0], "client_port": client[1],
+            "command": command, "host": destination[0] if destination else None,
+            "port": destination[1] if destination else None, "source": source, "sent": sent,
+            "received": received, "duration": round(duration, 6), "error": error,
+        }) + "\n"
+
+
+_log = None
+
+
+def getSessionLog(worker=None):
+    """Get the session log shared by every session, created from the config on first use
+
+    Args:
+        worker (int, optional): the worker process index, every worker writes its own file
+    """
+    global _log
+    if _log is None:
+        path = config.config.get("session_log", "-")
+        if path and path != "-" and worker is not None:
+            path = "{}.worker{}".format(path, worker)
+        _log = SessionLog(path, fmt=config.config.get("session_log_format", "text"),
+                          sample=config.config.get("session_log_sample", 1.0),
+                          queue_size=config.config.get("session_log_queue", 10000),
+                          max_bytes=config.config.get("session_log_max_bytes", 0),
+                          backups=config.config.get("session_log_backups", 5))
+    return _log
@@ -0,0 +1,216 @@
+# Author: Micah Martin (knif3)
+# tracing.py
+#
+# Find out where the time goes on a running proxy: per session phase tracing and a sampling
+# profiler, both switched on and off with signals
+#
+
+import functools
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+from . import config
+
+# Checked before anything else is done for tracing, so it costs next to nothing while off
+enabled = False
+_local = threading.local()  # The trace of the session the current thread is working for
+
+
+class SessionTrace(object):
+    """The phases of one session, as (name, start, end) spans in time.monotonic() seconds"""
+    __slots__ = ("client", "started", "spans")
+
+    def __init__(self, client, started):
+        self.client = client
+        self.started = started
+        self.spans = []
+
+    def span(self, name, start, end):
+        self.spans.append((name, start, end))
+
+    def toDict(self, destination=None, ended=None, error=None):
+        return {
+            "client": "{}:{}".format(*self.client[:2]) if self.client else None,
+            "destination": "{}:{}".format(*destination) if destination and destination[0]
+                           else None,
+            "duration": round((ended or time.monotonic()) - self.started, 6),
+            "error": error,
+            "phases": [(name, round(start - self.started, 6), round(end - start, 6))
+                       for name, start, end in self.spans],
+        }
+
+
+class Tracer(object):
+    """Keep the traces of the latest sessions in a ring buffer, and report the slow ones as they
+    finish. Nothing is recorded while tracing is off.
+
+    Args:
+        size (int, optional): how many finished sessions to keep
+        slow (float, optional): report sessions open at least this many seconds (0 to never)
+        directory (str, optional): where dumps and profiles are written
+    """
+    def __init__(self, size=1024, slow=1.0, directory="/tmp"):
+        self.slow = slow
+        self.directory = directory
+        self.traces = deque(maxlen=size)
+        self._profiling = False
+
+    def begin(self, client, started):
+        """Returns:
+            SessionTrace: the trace for a new session, or None while tracing is off
+        """
+        return SessionTrace(client, started) if enabled else None
+
+    def finish(self, trace, destination=None, ended=None, error=None):
+        """Keep the trace of a session that has ended"""
+        record = trace.toDict(destination, ended, error)
+        self.traces.append(record)
+        if self.slow and record["duration"] >= self.slow:
+            print("SLOW: {} => {} {:.3f}s {}".format(
+                  record["client"], record["destination"] or "-", record["duration"],
+                  " ".join("{}={:.3f}".format(name, took) for name, _, took in record["phases"])))
+
+    def toggle(self):
+        """Switch tracing on, or off and dump what was recorded"""
+        global enabled
+        enabled = not enabled
+        if enabled:
+            self.traces.clear()
+            print("Tracing sessions, slow above {}s".format(self.slow))
+        else:
+            self.dump()
+
+    def dump(self):
+        """Write the traces in the ring buffer to a file, one JSON object per line
+
+        Returns:
+            str: the file written
+        """
+        path = self._path("trace", "jsonl")
+        traces = list(self.traces)
+        with open(path, "w") as fil:
+            for record in traces:
+                fil.write(json.dumps(record) + "\n")
+        print("Wrote {} session traces to {}".format(len(traces), path))
+        return path
+
+    def profile(self, seconds=30, interval=0.005):
+        """Sample the stacks of every thread for a while from a background thread, then write
+        them in the collapsed format flame graph tools read. Ignored if already profiling
+        """
+        if self._profiling:
+            return
+        self._profiling = True
+        print("Profiling for {}s".format(seconds))
+        threading.Thread(target=self._profile, args=(seconds, interval), name="Profiler",
+                         daemon=True).start()
+
+    def _profile(self, seconds, interval):
+        stacks = Counter()
+        me = threading.get_ident()
+        names = {}
+        deadline = time.monotonic() + seconds
+        try:
+            while time.monotonic() < deadline:
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append("{} ({}:{})".format(code.co_name,
+                                     os.path.basename(code.co_filename), code.co_firstlineno))
+                        frame = frame.f_back
+                    if ident not in names:
+                        thread = threading._active.get(ident)
+                        names[ident] = thread.name.split("-")[0] if thread else "thread"
+                    stack.append(names[ident])
+                    stacks[";".join(reversed(stack))] += 1
+                time.sleep(interval)
+            path = self._path("profile", "folded")
+            with open(path, "w") as fil:
+                for stack, count in stacks.most_common():
+                    fil.write("{} {}\n".format(stack, count))
+            print("Wrote {} profile samples to {}".format(sum(stacks.values()), path))
+        except Exception as E:
+            print("WARN: Profiling failed: {}".format(E))
+        finally:
+            self._profiling = False
+
+    def _path(self, kind, extension):
+        return os.path.join(self.directory, "{}-{}-{}.{}".format(
+                            kind, os.getpid(), time.strftime("%Y%m%d-%H%M%S"), extension))
+
+
+def activate(trace):
+    """Attribute the traced calls this thread makes to a session's trace (None to stop)"""
+    _local.trace = trace
+
+
+def within(trace, func, *args):
+    """Call func(*args) with the trace active, for blocking calls made from a thread pool"""
+    if trace is None:
+        return func(*args)
+    _local.trace = trace
+    try:
+        return func(*args)
+    finally:
+        _local.trace = None
+
+
+def traced(name):
+    """Record the time calls to the decorated function take in the active session's trace"""
+    def decorate(func):
+        @functools.wraps(func)
+        def call(*args, **kwargs):
+            trace = getattr(_local, "trace", None) if enabled else None
+            if trace is None:
+                return func(*args, **kwargs)
+            start = time.monotonic()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                trace.span(name, start, time.monotonic())
+        return call
+    return decorate
+
+
+_tracer = None
+
+
+def getTracer():
+    """Get the tracer shared by every session, created from the config on first use"""
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer(size=config.config.get("trace_buffer", 1024),
+                         slow=config.config.get("trace_slow", 1.0),
+                         directory=config.config.get("trace_dir", "/tmp"))
+    return _tracer
+
+
+def installSignals():
+    """SIGUSR1 switches session tracing on and off, SIGUSR2 starts a profile. The work is done
+    on another thread so the handler returns straight away
+    """
+    def toggle(signum, frame):
+        threading.Thread(target=_safely, args=(getTracer().toggle,), daemon=True).start()
+
+    def profile(signum, frame):
+        getTracer().profile(config.config.get("profile_seconds", 30),
+                            config.config.get("profile_interval", 0.005))
+    signal.signal(signal.SIGUSR1, toggle)
+    signal.signal(signal.SIGUSR2, profile)
+    if config.config.get("trace"):
+        getTracer().toggle()
+
+
+def _safely(func):
+    try:
+        func()
+    except Exception as E:
+        print("WARN: Tracing failed: {}".format(E))
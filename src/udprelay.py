@@ -0,0 +1,213 @@
+# Author: Micah Martin (knif3)
+# udprelay.py
+#
+# Relay the datagrams of a SOCKS5 UDP ASSOCIATE (RFC1928 section 7)
+#
+
+import select
+import socket
+import struct
+import time
+from collections import OrderedDict
+
+from .networking import outboundSocket
+from .resolver import getResolver
+
+BATCH = 64  # Datagrams to move from one socket before checking the others
+IPV4_HEADER = struct.Struct("!HBB4sH")  # RSV, FRAG, ATYP, address, port
+IPV6_HEADER = struct.Struct("!HBB16sH")
+PORT = struct.Struct("!H")
+HEADROOM = IPV6_HEADER.size  # Room in front of a received datagram for the largest header
+SOCKET_BUFFER = 4194304  # Ask for deep socket buffers so bursts queue instead of dropping
+MAX_PEERS = 1024  # Remote hosts replies are accepted from, those sent to least recently are dropped
+
+
+class UdpRelay(object):
+    """Relay datagrams between one client and any number of remote hosts.
+
+    The client sends SOCKS-wrapped datagrams to `client_sock`. They are unwrapped and sent on from
+    `remote_sock`, which is bound to the outbound address of the association, or from
+    `remote_sock6` for IPv6 hosts. Replies from hosts the client has sent to are wrapped and
+    returned, for the last `max_peers` hosts it sent to. Each socket is drained of up to BATCH
+    datagrams per wakeup through one reusable buffer.
+
+    Args:
+        client_host (str): the address of the client, datagrams from anywhere else are dropped
+        client_port (int): the port the client said it will send from, 0 if it doesn't know
+        bind_host (str): the address to receive the client's datagrams on
+        outbound_ip (str): the address to send the datagrams to the remote hosts from
+        outbound_ip6 (str, optional): the address to send to IPv6 hosts from, which are
+            unreachable without one
+        max_peers (int, optional): the most remote hosts to accept replies from
+    """
+    def __init__(self, client_host, client_port, bind_host, outbound_ip, outbound_ip6=None,
+                 max_peers=MAX_PEERS):
+        self.client_host = client_host
+        self.client_port = client_port
+        self.client_addr = None  # Where to send replies, known once the client sends something
+        self.sent = 0  # Bytes from the client to remote hosts
+        self.received = 0  # Bytes from remote hosts to the client
+        self.last_active = time.monotonic()
+        self.max_peers = max_peers
+        self._peers = OrderedDict()  # Remote addresses the client has sent to, most recent last
+        self._buf = bytearray(HEADROOM + 65536)
+        self._view = memoryview(self._buf)
+        self.client_sock = socket.socket(socket.AF_INET6 if ":" in bind_host else socket.AF_INET,
+                                         socket.SOCK_DGRAM)
+        self.remote_sock = self.remote_sock6 = None
+        try:
+            self.client_sock.bind((bind_host, 0))
+            self.remote_sock = outboundSocket(outbound_ip, socket.SOCK_DGRAM)
+            if outbound_ip6:
+                self.remote_sock6 = outboundSocket(outbound_ip6, socket.SOCK_DGRAM)
+        except OSError:
+            self.close()
+            raise
+        self.remote_socks = [sock for sock in (self.remote_sock, self.remote_sock6) if sock]
+        for sock in [self.client_sock] + self.remote_socks:
+            sock.setblocking(False)
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER)
+            except OSError:
+                pass
+
+    @property
+    def address(self):
+        """Returns:
+            tuple: the (address, port) the client should send its datagrams to
+        """
+        return self.client_sock.getsockname()[:2]
+
+    def run(self, control, idle=120):
+        """Relay until the control connection closes or nothing is relayed for `idle` seconds
+
+        Args:
+            control (socket): the client's TCP connection that requested the association
+            idle (float, optional): seconds without datagrams before the association expires
+        """
+        poller = select.poll()
+        for sock in [control, self.client_sock] + self.remote_socks:
+            poller.register(sock, select.POLLIN)
+        control_fd = control.fileno()
+        client_fd = self.client_sock.fileno()
+        remotes = dict((sock.fileno(), sock) for sock in self.remote_socks)
+        while True:
+            remaining = self.last_active + idle - time.monotonic()
+            if remaining <= 0:
+                return
+            for fd, _ in poller.poll(remaining * 1000):
+                if fd == control_fd:
+                    try:
+                        if not control.recv(4096):
+                            return
+                    except OSError:
+                        return
+                elif fd == client_fd:
+                    self.drainClient()
+                else:
+                    self.drainRemote(remotes[fd])
+
+    def drainClient(self):
+        """Send on the datagrams the client has queued"""
+        buf, view = self._buf, self._view
+        for _ in range(BATCH):
+            try:
+                size, addr = self.client_sock.recvfrom_into(buf)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue
+            if addr[0] != self.client_host:
+                continue
+            if self.client_addr is None:
+                if self.client_port and addr[1] != self.client_port:
+                    continue
+                self.client_addr = addr
+            elif addr != self.client_addr:
+                continue
+            # Fragments are not supported, RFC1928 allows dropping them
+            if size < 10 or buf[2] != 0:
+                continue
+            atype = buf[3]
+            if atype == 1:
+                host, start = socket.inet_ntoa(buf[4:8]), 8
+            elif atype == 4 and size >= 22:
+                host, start = socket.inet_ntop(socket.AF_INET6, buf[4:20]), 20
+            elif atype == 3:
+                start = 5 + buf[4]
+                host = bytes(buf[5:start]).decode("utf-8", "replace")
+            else:
+                continue
+            if start + 2 > size:
+                continue
+            port = PORT.unpack_from(buf, start)[0]
+            self.last_active = time.monotonic()
+            if atype == 3:
+                self._sendResolved(host, port, bytes(view[start + 2:size]))
+            else:
+                self._sendRemote((host, port), view[start + 2:size])
+
+    def drainRemote(self, sock=None):
+        """Wrap the datagrams from remote hosts and return them to the client"""
+        sock = sock or self.remote_sock
+        buf, view = self._buf, self._view
+        for _ in range(BATCH):
+            try:
+                size, addr = sock.recvfrom_into(view[HEADROOM:])
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue
+            if self.client_addr is None or addr[0] not in self._peers:
+                continue
+            # Write the header just in front of the data so it goes out in one piece
+            if sock is self.remote_sock6:
+                start = HEADROOM - IPV6_HEADER.size
+                IPV6_HEADER.pack_into(buf, start, 0, 0, 4,
+                                      socket.inet_pton(socket.AF_INET6, addr[0]), addr[1])
+            else:
+                start = HEADROOM - IPV4_HEADER.size
+                IPV4_HEADER.pack_into(buf, start, 0, 0, 1, socket.inet_aton(addr[0]), addr[1])
+            try:
+                self.client_sock.sendto(view[start:HEADROOM + size], self.client_addr)
+                self.received += size
+            except OSError:
+                pass  # The client can't keep up, drop it like the network would
+            self.last_active = time.monotonic()
+
+    def _sendRemote(self, remote, data):
+        sock = self.remote_sock6 if ":" in remote[0] else self.remote_sock
+        if sock is None:
+            return  # No IPv6 address to send from, drop it
+        peers = self._peers
+        if remote[0] in peers:
+            peers.move_to_end(remote[0])
+        else:
+            peers[remote[0]] = None
+            if len(peers) > self.max_peers:
+                peers.popitem(last=False)
+        try:
+            sock.sendto(data, remote)
+            self.sent += len(data)
+        except OSError:
+            pass
+
+    def _sendResolved(self, host, port, data):
+        """Send to a hostname once the shared resolver knows its address"""
+        future = getResolver().lookup(host)
+
+        def send(future):
+            try:
+                self._sendRemote((future.result(), port), data)
+            except (OSError, ValueError):
+                pass  # It does not resolve, drop the datagram
+        if future.done():
+            send(future)
+        else:
+            future.add_done_callback(send)
+
+    def close(self):
+        for sock in (self.client_sock, self.remote_sock, self.remote_sock6):
+            if sock:
+                sock.close()
@@ -0,0 +1,113 @@
+# Author: Micah Martin (knif3)
+# workers.py
+#
+# Run several proxy processes on the same port and restart them when they die
+#
+
+import os
+import signal
+import time
+
+from . import networking
+
+RESTART_DELAY = 1  # Seconds to wait before restarting a crashed worker
+
+
+class Supervisor(object):
+    """Fork worker processes that each accept on the listening port (with SO_REUSEPORT), and
+    restart any that exit. The address pool must be a SharedAddressPool created before forking.
+
+    The supervisor runs no threads, so that it can fork whenever a worker has to be restarted:
+    it sweeps idle addresses from the pool itself, between checks on the workers, and the
+    background threads that watch the network run in a monitor process, forked and restarted
+    like the workers.
+
+    Args:
+        count (int): how many workers to run
+        serve (callable): called in each worker with its index, should serve until killed
+        monitor (callable, optional): called in the monitor process with the index after the
+            last worker's, should run until killed
+    """
+    def __init__(self, count, serve, monitor=None):
+        self.count = count
+        self.serve = serve
+        self.monitor = monitor
+        self.children = {}  # pid => worker index, self.count for the monitor
+        self.stopping = False
+
+    def run(self):
+        """Start the workers and watch them until we are told to stop"""
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        # Tracing and profiling happen in the workers
+        signal.signal(signal.SIGUSR1, self._forward)
+        signal.signal(signal.SIGUSR2, self._forward)
+        for index in range(self.count):
+            self._spawn(index)
+        if self.monitor:
+            self._spawn(self.count)
+        interval = max(networking.pool.linger / 2.0, 0.5)
+        swept = time.monotonic()
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                if not networking.pool.reserved and time.monotonic() - swept >= interval:
+                    networking.pool.sweep()
+                    swept = time.monotonic()
+                time.sleep(0.1 if self.stopping else 0.5)
+                continue
+            index = self.children.pop(pid, None)
+            if index is None:
+                continue
+            if index < self.count:
+                # Whatever the worker was using is free now
+                networking.pool.releaseWorker(index)
+            if not self.stopping:
+                print("WARN: {} (pid {}) exited with {}, restarting".format(
+                      "Worker {}".format(index) if index < self.count else "Monitor", pid,
+                      status))
+                time.sleep(RESTART_DELAY)
+                if not self.stopping:
+                    self._spawn(index)
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            # In the worker, let the supervisor handle the shutdown
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            # Until serve() sets up tracing, don't pass signals on to our siblings
+            signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+            signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+            code = 0
+            try:
+                if index < self.count:
+                    networking.pool.worker = index
+                    self.serve(index)
+                else:
+                    self.monitor(index)
+            except BaseException:
+                import traceback
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        self.children[pid] = index
+
+    def _forward(self, signum, frame):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass